@@ -0,0 +1,59 @@
+"""
+Side effects of activity writes.
+
+Every path that creates, changes or deletes activities (the viewset and the
+bulk ingestion endpoint) reports the affected rows here, and this module
+keeps the derived data in step: leaderboard totals and ranks, team points
+(the sum of the members' calories), the daily rollups, the in-memory
+period and team boards and the versions behind conditional GETs. Rows are
+dicts with ``user_email``, ``activity_type``, ``date``, ``duration`` and
+``calories``.
+"""
+from collections import defaultdict
+
+from pymongo import UpdateOne
+
+from .models import Activity, ActivityRollup, Leaderboard, Team
+from . import leaderboard, rollups, versions
+from .boards import boards
+from .user_directory import directory
+
+ROW_FIELDS = ('user_email', 'activity_type', 'date', 'duration', 'calories')
+
+
+def as_row(activity):
+    """The event row for an ``Activity`` instance"""
+    return {field: getattr(activity, field) for field in ROW_FIELDS}
+
+
+def activities_written(added=(), removed=()):
+    """Apply the rows that were ``added`` and ``removed`` to all derived data"""
+    added, removed = list(added), list(removed)
+    totals = defaultdict(lambda: [0, 0])
+    for row in added:
+        totals[row['user_email']][0] += row['calories']
+        totals[row['user_email']][1] += 1
+    for row in removed:
+        totals[row['user_email']][0] -= row['calories']
+        totals[row['user_email']][1] -= 1
+    if not totals:
+        return
+    users = directory.get_many(totals)
+    teams = {email: user.get('team', '') for email, user in users.items()}
+    team_points = defaultdict(int)
+    for user_email, (calories, count) in totals.items():
+        leaderboard.apply_delta(user_email, calories, count, users.get(user_email))
+        if teams.get(user_email):
+            team_points[teams[user_email]] += calories
+    rollups.apply(added, teams)
+    rollups.apply(removed, teams, sign=-1)
+    boards.activities_written(added, removed, teams)
+    operations = [
+        UpdateOne({'name': team}, {'$inc': {'total_points': points}})
+        for team, points in team_points.items() if points
+    ]
+    if operations:
+        Team.objects.mongo_bulk_write(operations, ordered=False)
+    versions.bump(
+        Activity._meta.db_table, Leaderboard._meta.db_table, Team._meta.db_table, ActivityRollup._meta.db_table
+    )
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, Team, Activity, Leaderboard, Workout
+from .models import User, Team, Activity, ActivityRollup, Leaderboard, Workout, Task
 
 
 @admin.register(User)
@@ -38,3 +38,19 @@ class WorkoutAdmin(admin.ModelAdmin):
     list_display = ('name', 'category', 'difficulty', 'duration', 'calories_per_session')
     search_fields = ('name', 'category')
     list_filter = ('category', 'difficulty')
+
+
+@admin.register(ActivityRollup)
+class ActivityRollupAdmin(admin.ModelAdmin):
+    list_display = ('day', 'user_email', 'team', 'activity_type', 'count', 'duration', 'calories')
+    search_fields = ('user_email', 'team')
+    list_filter = ('activity_type', 'team')
+    ordering = ('-day',)
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'attempts', 'created_at', 'finished_at')
+    search_fields = ('name',)
+    list_filter = ('status', 'name')
+    ordering = ('-created_at',)
@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+
+
+class OctofitTrackerConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'octofit_tracker'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+
+        from . import mongo_client, monitoring, versions
+        monitoring.install()
+        mongo_client.install_fork_handler()
+        # ORM writes outside the viewsets (the admin, scripts) move the ETags too
+        for model in self.get_models():
+            post_save.connect(versions.model_changed, sender=model)
+            post_delete.connect(versions.model_changed, sender=model)
@@ -13,4 +13,19 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'octofit_tracker.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported only now: the app registry has to be ready first
+from octofit_tracker.live import LIVE_PATH, stream  # noqa: E402
+from octofit_tracker.mongo_client import warm_up  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # The live leaderboard is a long-lived stream, served outside Django's
+    # request handling (see live.py)
+    if scope['type'] == 'http' and scope['path'] == LIVE_PATH:
+        return await stream(scope, receive, send)
+    return await django_application(scope, receive, send)
+
+
+warm_up()
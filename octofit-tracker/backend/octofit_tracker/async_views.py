@@ -0,0 +1,195 @@
+"""
+Async read endpoints, served under ``/api/async/`` when the app runs on ASGI.
+
+DRF views are synchronous, so under ASGI each request to them holds a
+worker thread for its whole duration. These handlers cover the read-heavy
+endpoints with native ``async def`` Django views that query MongoDB through
+motor, so a single worker process can keep thousands of mostly idle
+requests in flight. They return the same JSON as their DRF counterparts:
+the same compiled serializer representations (including
+``?fields=``/``?exclude=``), ranks from the same rank index, and the same
+cursor pagination envelope, whose cursors work on either endpoint. Under
+WSGI they still work, one request per thread.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.http import HttpResponse, HttpResponseNotAllowed
+from rest_framework import status
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor
+from rest_framework.request import Request
+
+from . import rank_index
+from .exports import parse_bound
+from .mongo_client import motor_database
+from .models import Activity, Leaderboard, User, Workout
+from .pagination import ActivityPagination
+from .renderers import FastJSONRenderer
+from .serializers import (
+    ActivitySerializer, LeaderboardSerializer, UserSerializer, WorkoutSerializer, fast_representation,
+)
+
+renderer = FastJSONRenderer()
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return HttpResponse(renderer.render(data), status=status_code, content_type='application/json')
+
+
+def error(message, status_code=status.HTTP_400_BAD_REQUEST):
+    return json_response({'error': message}, status_code)
+
+
+def get_only(view):
+    """``require_GET`` for async views (Django's decorators are sync-only here)"""
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return HttpResponseNotAllowed(['GET'])
+        return await view(request, *args, **kwargs)
+    wrapper.__name__ = view.__name__
+    wrapper.__qualname__ = view.__qualname__
+    wrapper.__module__ = view.__module__
+    return wrapper
+
+
+def representation(request, serializer_class):
+    """``(projection, represent)`` for a serializer with the request's sparse fieldset applied"""
+    sources, represent = fast_representation(serializer_class(context={'request': Request(request)}))
+
+    def convert(document):
+        return represent({source: document.get(source) for source in sources})
+    return {source: 1 for source in sources}, convert
+
+
+async def find_rows(request, model, serializer_class, query, sort=None, limit=0):
+    projection, convert = representation(request, serializer_class)
+    cursor = motor_database()[model._meta.db_table].find(query, projection, sort=sort, limit=limit)
+    return [convert(document) async for document in cursor]
+
+
+@get_only
+async def leaderboard_top(request):
+    """Get top users from leaderboard"""
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        limit = -1
+    if not 0 <= limit <= 1000:
+        return error('limit must be between 0 and 1000')
+    if limit == 0:
+        # A limit of 0 means no limit to MongoDB
+        return json_response([])
+    # The order and ranks come from the rank index, as in the DRF view; it
+    # loads through djongo the first time, which must not run on the loop
+    entries = await sync_to_async(rank_index.index.top)(limit)
+    projection, convert = representation(request, LeaderboardSerializer)
+    projection['user_email'] = 1
+    documents = await motor_database()[Leaderboard._meta.db_table].find(
+        {'user_email': {'$in': [entry['user_email'] for entry in entries]}}, projection
+    ).to_list(None)
+    by_email = {document['user_email']: document for document in documents}
+    rows = []
+    for entry in entries:
+        document = by_email.get(entry['user_email'])
+        if document is not None:
+            data = convert(document)
+            if 'rank' in data:
+                data['rank'] = entry['rank']
+            rows.append(data)
+    return json_response(rows)
+
+
+@get_only
+async def users_by_email(request):
+    """Get user by email"""
+    email = request.GET.get('email', None)
+    if not email:
+        return error('Email parameter required')
+    rows = await find_rows(request, User, UserSerializer, {'email': email}, limit=1)
+    if not rows:
+        return error('User not found', status.HTTP_404_NOT_FOUND)
+    return json_response(rows[0])
+
+
+def _position(cursor):
+    """The ``(date, _id)`` an ``ActivityPagination`` cursor points at, or None when it is not one"""
+    try:
+        date, _id = json.loads(cursor.position)
+        return parse_bound(date), ObjectId(_id)
+    except (TypeError, ValueError, InvalidId):
+        return None
+
+
+@get_only
+async def activities_by_user(request):
+    """
+    Get activities by user email, newest first, in the keyset-paginated
+    pages of ``ActivityPagination`` (same parameters, envelope and cursors)
+    """
+    email = request.GET.get('email', None)
+    if not email:
+        return error('Email parameter required')
+    paginator = ActivityPagination()
+    drf_request = Request(request)
+    paginator.base_url = request.build_absolute_uri()
+    page_size = paginator.get_page_size(drf_request)
+    try:
+        cursor = paginator.decode_cursor(drf_request)
+        position = None if cursor is None else _position(cursor)
+        if cursor is not None and position is None:
+            raise NotFound(paginator.invalid_cursor_message)
+    except NotFound as exception:
+        return json_response({'detail': str(exception.detail)}, status.HTTP_404_NOT_FOUND)
+    reverse = cursor is not None and cursor.reverse
+    query = {'user_email': email}
+    if position is not None:
+        date, _id = position
+        seek = '$gt' if reverse else '$lt'
+        query['$or'] = [{'date': {seek: date}}, {'date': date, '_id': {seek: _id}}]
+    direction = 1 if reverse else -1
+    projection, convert = representation(request, ActivitySerializer)
+    projection.update(date=1, _id=1)
+    documents = await motor_database()[Activity._meta.db_table].find(
+        query, projection, sort=[('date', direction), ('_id', direction)], limit=page_size + 1
+    ).to_list(None)
+    more = len(documents) > page_size
+    documents = documents[:page_size]
+    if reverse:
+        documents.reverse()
+    has_next = position is not None if reverse else more
+    has_previous = more if reverse else position is not None
+    
+    def link(document, reverse):
+        # From the edge row of the page, or from the cursor when the page is empty
+        if document is None:
+            position = cursor.position
+        else:
+            position = paginator._get_position_from_instance(document, paginator.ordering)
+        return paginator.encode_cursor(Cursor(offset=0, reverse=reverse, position=position))
+    return json_response({
+        'next': link(documents[-1] if documents else None, False) if has_next else None,
+        'previous': link(documents[0] if documents else None, True) if has_previous else None,
+        'results': [convert(document) for document in documents],
+    })
+
+
+async def _workouts_by(request, field, param):
+    value = request.GET.get(param, None)
+    if not value:
+        return error(f'{param.capitalize()} parameter required')
+    return json_response(await find_rows(request, Workout, WorkoutSerializer, {field: value}))
+
+
+@get_only
+async def workouts_by_category(request):
+    """Get workouts by category"""
+    return await _workouts_by(request, 'category', 'category')
+
+
+@get_only
+async def workouts_by_difficulty(request):
+    """Get workouts by difficulty level"""
+    return await _workouts_by(request, 'difficulty', 'difficulty')
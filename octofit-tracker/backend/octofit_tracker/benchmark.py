@@ -0,0 +1,255 @@
+"""
+API benchmark harness used by ``manage.py benchmark_api``.
+
+Every route registered on the API router is exercised in-process through
+Django's test ``Client``, so a run measures the full middleware, view,
+serializer and renderer stack against whatever database ``settings`` points
+at, without a web server in the way.
+
+``run_wsgi`` and ``run_asgi`` compare the two deployment models for the
+routes that have an async version under ``/api/async/``: the first serves
+the sync route from a fixed pool of worker threads, like a threaded WSGI
+worker, the second serves the async route through Django's ASGI handler on
+one event loop. Both keep ``concurrency`` clients in flight and time each
+request from the moment its client sends it, so queueing for a free
+thread counts against WSGI the way it would in production.
+"""
+import asyncio
+import json
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.test import AsyncClient, Client, override_settings
+
+from .models import Activity, Team, User, Workout
+from .monitoring import track_commands
+from .urls import async_urlpatterns, router
+
+# Write actions that can be repeated without changing the dataset
+IDEMPOTENT_WRITES = {'add_member'}
+# Read actions that need state a benchmark run does not create
+UNMEASURED = {'download'}
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not samples:
+        return 0.0
+    index = max(math.ceil(q / 100 * len(samples)) - 1, 0)
+    return samples[index]
+
+
+def discover_routes():
+    """
+    List the routes registered on the router as dicts with ``name``,
+    ``method``, ``prefix``, ``model``, ``detail`` and ``action`` keys.
+    """
+    routes = []
+    for prefix, viewset, basename in router.registry:
+        queryset = getattr(viewset, 'queryset', None)
+        model = queryset.model if queryset is not None else None
+        if hasattr(viewset, 'list'):
+            routes.append({'name': f'{basename}-list', 'method': 'get', 'prefix': prefix,
+                           'model': model, 'detail': False, 'action': 'list', 'url_path': ''})
+        if hasattr(viewset, 'retrieve'):
+            routes.append({'name': f'{basename}-detail', 'method': 'get', 'prefix': prefix,
+                           'model': model, 'detail': True, 'action': 'retrieve', 'url_path': ''})
+        for extra in viewset.get_extra_actions():
+            for method, action in extra.mapping.items():
+                routes.append({'name': f'{basename}-{extra.url_path}', 'method': method, 'prefix': prefix,
+                               'model': model, 'detail': extra.detail, 'action': action,
+                               'url_path': extra.url_path})
+    return routes
+
+
+class Samples:
+    """Real values from the dataset used to fill in route parameters"""
+
+    def __init__(self):
+        user = User.objects.mongo_find_one({}) or {}
+        activity = Activity.objects.mongo_find_one({}) or {}
+        team = Team.objects.mongo_find_one({}) or {}
+        workout = Workout.objects.mongo_find_one({}) or {}
+        self.user_email = user.get('email', '')
+        self.activity_email = activity.get('user_email', '')
+        self.member_email = (team.get('members') or [''])[0]
+        self.team = team.get('name', '')
+        self.category = workout.get('category', '')
+        self.difficulty = workout.get('difficulty', '')
+
+    def params(self, action):
+        """(query params, JSON body) for a custom action"""
+        return {
+            'by_email': ({'email': self.user_email}, None),
+            'by_emails': ({'emails': f'{self.user_email},{self.activity_email}'}, None),
+            'by_user': ({'email': self.activity_email}, None),
+            'top': ({'limit': 10}, None),
+            'board': ({'period': 'week', 'team': self.team}, None),
+            'rank_of': ({'email': self.user_email}, None),
+            'around': ({'email': self.user_email, 'k': 5}, None),
+            'by_category': ({'category': self.category}, None),
+            'by_difficulty': ({'difficulty': self.difficulty}, None),
+            'by_team': ({'team': self.team}, None),
+            'add_member': ({}, {'email': self.member_email}),
+        }.get(action, ({}, None))
+
+
+def build_requests(routes, samples):
+    """Resolve routes to concrete requests, skipping ones that would mutate data"""
+    requests, skipped = [], []
+    for route in routes:
+        if route['action'] in UNMEASURED or (route['method'] != 'get' and route['action'] not in IDEMPOTENT_WRITES):
+            skipped.append(route['name'])
+            continue
+        path = f"/api/{route['prefix']}/"
+        if route['detail']:
+            document = route['model'].objects.mongo_find_one({}, {'_id': 1})
+            if document is None:
+                skipped.append(route['name'])
+                continue
+            path += f"{document['_id']}/"
+        if route['url_path']:
+            path += f"{route['url_path']}/"
+        params, body = samples.params(route['action'])
+        requests.append({'name': route['name'], 'method': route['method'], 'path': path,
+                         'params': params, 'body': body})
+    return requests
+
+
+def _send(client, request):
+    if request['method'] == 'get':
+        return client.get(request['path'], request['params'])
+    return client.generic(
+        request['method'].upper(), request['path'],
+        json.dumps(request['body']), content_type='application/json'
+    )
+
+
+def _timed_call(request):
+    client = Client(HTTP_HOST='localhost')
+    with track_commands() as log:
+        started = time.perf_counter()
+        response = _send(client, request)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        elapsed = time.perf_counter() - started
+    return elapsed, log.count, response.status_code
+
+
+def unlimited():
+    """Settings override that turns off throttling and load shedding, which would refuse most benchmark requests"""
+    return override_settings(
+        REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={}),
+        OCTOFIT_SHED_MAX_IN_FLIGHT=0,
+    )
+
+
+def summarize(results, wall):
+    """Summarize ``(seconds, round trips, status code)`` samples taken over ``wall`` seconds"""
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in results)
+    counts = [count for _, count, _ in results if count is not None]
+    return {
+        'requests': len(results),
+        'throughput': len(results) / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'db_round_trips': sum(counts) / len(counts) if counts else None,
+        'errors': sum(1 for _, _, code in results if code >= 400),
+    }
+
+
+def run_request(request, iterations, warmup=5, concurrency=1):
+    """Measure one request ``iterations`` times and summarize the samples"""
+    for _ in range(warmup):
+        _timed_call(request)
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(_timed_call, [request] * iterations))
+    else:
+        results = [_timed_call(request) for _ in range(iterations)]
+    return summarize(results, time.perf_counter() - started)
+
+
+def async_requests(requests):
+    """Pair each request that has an async version with its ``/api/async/`` path"""
+    async_paths = {f'/api/{pattern.pattern}' for pattern in async_urlpatterns}
+    return [
+        (request, dict(request, path=request['path'].replace('/api/', '/api/async/', 1)))
+        for request in requests
+        if request['method'] == 'get' and request['path'] in async_paths
+    ]
+
+
+def _queued_call(request, sent):
+    _, count, code = _timed_call(request)
+    return time.perf_counter() - sent, count, code
+
+
+def run_wsgi(request, iterations, concurrency, threads, warmup=5):
+    """
+    Serve ``iterations`` requests from ``threads`` worker threads while
+    ``concurrency`` clients keep one request each in flight
+    """
+    for _ in range(warmup):
+        _timed_call(request)
+    results, pending, sent = [], set(), 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while sent < iterations or pending:
+            while sent < iterations and len(pending) < concurrency:
+                pending.add(pool.submit(_queued_call, request, time.perf_counter()))
+                sent += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            results.extend(future.result() for future in done)
+    return summarize(results, time.perf_counter() - started)
+
+
+async def _async_call(client, request, slots):
+    async with slots:
+        started = time.perf_counter()
+        response = await client.get(request['path'], request['params'])
+        return time.perf_counter() - started, None, response.status_code
+
+
+async def _run_asgi(request, iterations, concurrency, warmup):
+    client = AsyncClient(HTTP_HOST='localhost')
+    slots = asyncio.Semaphore(concurrency)
+    for _ in range(warmup):
+        await _async_call(client, request, slots)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_async_call(client, request, slots) for _ in range(iterations)))
+    return summarize(results, time.perf_counter() - started)
+
+
+def run_asgi(request, iterations, concurrency, warmup=5):
+    """
+    Serve ``iterations`` async requests on one event loop with up to
+    ``concurrency`` in flight. Motor runs its commands outside the request
+    context, so round trips are not counted.
+    """
+    return asyncio.run(_run_asgi(request, iterations, concurrency, warmup))
+
+
+def compare(results, baseline, threshold):
+    """
+    Yield (route, metric, baseline value, current value) for every route
+    whose p95 latency grew or throughput dropped by more than ``threshold``,
+    or that now makes more database round trips (when both runs counted them).
+    """
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+            yield name, 'p95_ms', previous['p95_ms'], current['p95_ms']
+        if current['throughput'] < previous['throughput'] * (1 - threshold):
+            yield name, 'throughput', previous['throughput'], current['throughput']
+        # Not counted for ASGI runs and for runs without samples
+        if None not in (current['db_round_trips'], previous.get('db_round_trips')) \
+                and current['db_round_trips'] > previous['db_round_trips']:
+            yield name, 'db_round_trips', previous['db_round_trips'], current['db_round_trips']
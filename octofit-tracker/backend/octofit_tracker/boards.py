@@ -0,0 +1,105 @@
+"""
+Leaderboards scoped by period and team.
+
+Each board is a ``RankIndex`` over one (period, team) pair: ``day``,
+``week`` (from Monday) and ``month`` boards cover the current UTC window and
+are loaded from the daily rollups, ``all`` boards are the all-time
+leaderboard (the global one is ``rank_index.index`` itself). Boards are
+created when first asked for and kept current from the activity write path.
+
+A board belongs to the window it was created in: boards whose window has
+closed are dropped on the next lookup and replaced by a board for the new
+window, and at most ``OCTOFIT_BOARDS_MAX`` boards are kept, least recently
+used first out, so memory stays bounded however many teams and periods are
+queried.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from .models import ActivityRollup, Leaderboard
+from . import rank_index
+from .rollups import bucket_day
+
+PERIODS = ('day', 'week', 'month', 'all')
+
+
+def period_window(period, now=None):
+    """``(start, end)`` of the current ``period`` as naive UTC datetimes; ``(None, None)`` for all"""
+    if period == 'all':
+        return None, None
+    day = bucket_day(now or datetime.utcnow())
+    if period == 'day':
+        return day, day + timedelta(days=1)
+    if period == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    start = day.replace(day=1)
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+def _loader(period, team, start, end):
+    def rollup_scores():
+        match = {'day': {'$gte': start, '$lt': end}}
+        if team:
+            match['team'] = team
+        pipeline = [
+            {'$match': match},
+            {'$group': {'_id': '$user_email', 'calories': {'$sum': '$calories'}}},
+        ]
+        return {row['_id']: row['calories'] for row in ActivityRollup.objects.mongo_aggregate(pipeline)}
+
+    def leaderboard_scores():
+        cursor = Leaderboard.objects.mongo_find({'team': team}, {'_id': 0, 'user_email': 1, 'total_calories': 1})
+        return {entry['user_email']: entry.get('total_calories', 0) for entry in cursor}
+
+    return leaderboard_scores if period == 'all' else rollup_scores
+
+
+class Boards:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boards = OrderedDict()
+
+    def get(self, period, team=''):
+        """``(window start, RankIndex)`` for the current window of ``period``, scoped to ``team``"""
+        if period == 'all' and not team:
+            return None, rank_index.index
+        now = datetime.utcnow()
+        start, end = period_window(period, now)
+        with self._lock:
+            for key, (_, expires, _) in list(self._boards.items()):
+                if expires is not None and expires <= now:
+                    del self._boards[key]
+            current = self._boards.get((period, team))
+            if current is None:
+                current = (start, end, rank_index.RankIndex(_loader(period, team, start, end)))
+                self._boards[(period, team)] = current
+            self._boards.move_to_end((period, team))
+            while len(self._boards) > settings.OCTOFIT_BOARDS_MAX:
+                self._boards.popitem(last=False)
+        return start, current[2]
+
+    def activities_written(self, added, removed, teams):
+        """Apply activity rows to every live board they fall in; ``teams`` maps emails to teams"""
+        with self._lock:
+            live = list(self._boards.items())
+        for (period, team), (start, end, board) in live:
+            for rows, sign in ((added, 1), (removed, -1)):
+                for row in rows:
+                    if team and teams.get(row['user_email']) != team:
+                        continue
+                    if start is not None and not start <= bucket_day(row['date']) < end:
+                        continue
+                    board.add(row['user_email'], sign * row['calories'])
+
+    def invalidate(self, period=None):
+        """Drop the boards of ``period``, or all of them, so they reload on next use"""
+        with self._lock:
+            for key in [key for key in self._boards if period in (None, key[0])]:
+                del self._boards[key]
+
+
+boards = Boards()
@@ -0,0 +1,128 @@
+"""
+Streaming exports.
+
+Documents are read from a server-side MongoDB cursor and written out as CSV
+or NDJSON by a generator, so an export holds one cursor batch in memory at a
+time. The first line is sent on its own, before the rest is batched into
+larger chunks, so clients see bytes immediately.
+"""
+import csv
+import io
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
+
+CURSOR_BATCH_SIZE = 1000
+LINES_PER_CHUNK = 500
+
+
+def export_value(value):
+    """Format a raw document value the way the API serializers do"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        value = value.isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return value
+
+
+def parse_bound(value):
+    """A date or datetime query parameter as the naive UTC datetime djongo stores, or None"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            return None
+        parsed = datetime(day.year, day.month, day.day)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def activity_query(email=None, since=None, until=None):
+    """
+    The activities filter for an email and a [since, until) date range given
+    as query parameter strings; raises ``ValueError`` for an invalid date
+    """
+    query = {}
+    if email:
+        query['user_email'] = email
+    for param, value, operator in (('since', since, '$gte'), ('until', until, '$lt')):
+        if value:
+            bound = parse_bound(value)
+            if bound is None:
+                raise ValueError(f'Invalid {param} date')
+            query.setdefault('date', {})[operator] = bound
+    return query
+
+
+def _chunked(lines):
+    chunk = []
+    first = True
+    for line in lines:
+        chunk.append(line)
+        if first or len(chunk) == LINES_PER_CHUNK:
+            yield ''.join(chunk)
+            chunk = []
+            first = False
+    if chunk:
+        yield ''.join(chunk)
+
+
+def csv_lines(documents, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield line(fields)
+    for document in documents:
+        yield line([export_value(document.get(field, '')) for field in fields])
+
+
+def ndjson_lines(documents, fields):
+    for document in documents:
+        yield json.dumps({field: export_value(document.get(field)) for field in fields}) + '\n'
+
+
+FORMATS = {
+    'csv': ('text/csv', csv_lines),
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+}
+
+
+def stream_export(model, query, fields, sort, output, filename):
+    """Stream the documents of ``model`` matching ``query`` as ``output`` (csv or ndjson)"""
+    content_type, writer = FORMATS[output]
+    projection = {field: 1 for field in fields}
+    cursor = model.objects.mongo_find(query, projection, sort=sort, batch_size=CURSOR_BATCH_SIZE)
+    response = StreamingHttpResponse(_chunked(writer(cursor, fields)), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{output}"'
+    return response
+
+
+def write_export(model, query, fields, sort, output, path):
+    """Write the documents of ``model`` matching ``query`` to ``path``; returns the number of rows"""
+    _, writer = FORMATS[output]
+    cursor = model.objects.mongo_find(query, {field: 1 for field in fields}, sort=sort, batch_size=CURSOR_BATCH_SIZE)
+    rows = 0
+    
+    def counted():
+        nonlocal rows
+        for document in cursor:
+            rows += 1
+            yield document
+    
+    with open(path, 'w', newline='') as handle:
+        for chunk in _chunked(writer(counted(), fields)):
+            handle.write(chunk)
+    return rows
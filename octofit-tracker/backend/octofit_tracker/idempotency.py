@@ -0,0 +1,110 @@
+"""
+Idempotent activity submission.
+
+Clients on flaky networks retry ``POST /api/activities/``. Each submission
+is identified by its ``Idempotency-Key`` header or, when the client sends
+none, by a hash of the activity's identifying content (``user_email``,
+``activity_type``, ``date``, ``duration``). The response to the first
+submission is stored under that identity in the ``idempotency`` alias of
+``CACHES``, a bounded store, and a repeat gets the same response back
+without another write. Keyed responses are kept for the alias's TTL;
+content identities only for ``OCTOFIT_IDEMPOTENCY_CONTENT_TTL`` seconds,
+the window in which an identical submission (``date`` is a full
+timestamp) is taken for a retry. Reusing a key for an activity with
+different identifying content is refused.
+
+A submission claims its identity with ``cache.add`` before writing, so two
+copies racing each other write once: the loser gets 409 until the winner
+has stored its response. Checking an identity is one cache lookup and
+never touches MongoDB. The default local-memory cache is per process;
+point the alias at a shared backend when several workers serve the API.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from rest_framework import status
+from rest_framework.response import Response
+
+IDEMPOTENCY_ALIAS = 'idempotency'
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+CONTENT_FIELDS = ('user_email', 'activity_type', 'date', 'duration')
+# How long a claimed identity waits for its response before it can be retried
+IN_FLIGHT_SECONDS = 30
+
+
+def _store():
+    return caches[IDEMPOTENCY_ALIAS]
+
+
+def fingerprint(data):
+    """Hash of the identifying fields of validated activity data"""
+    content = json.dumps([str(data.get(field)) for field in CONTENT_FIELDS])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def identity(request, digest):
+    """
+    ``(store key, timeout)`` for a submission, or ``ValueError`` if its
+    ``Idempotency-Key`` header is unusable
+    """
+    key = request.headers.get(HEADER)
+    if key is None:
+        return f'content:{digest}', settings.OCTOFIT_IDEMPOTENCY_CONTENT_TTL
+    if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+        raise ValueError(f'{HEADER} must be 1 to {MAX_KEY_LENGTH} printable characters')
+    return f'key:{hashlib.sha256(key.encode()).hexdigest()}', DEFAULT_TIMEOUT
+
+
+def _replay(entry, digest):
+    if entry['fingerprint'] != digest:
+        return Response(
+            {'error': f'{HEADER} was already used for a different activity'},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    if entry['status'] is None:
+        return Response(
+            {'error': 'An identical submission is still being processed'}, status=status.HTTP_409_CONFLICT
+        )
+    return Response(entry['data'], status=entry['status'], headers={'Idempotent-Replayed': 'true'})
+
+
+def submit(request, data, create):
+    """
+    Run ``create()`` (returning a ``Response``) once per submission of
+    ``data``; repeats get the stored response
+    """
+    digest = fingerprint(data)
+    try:
+        key, timeout = identity(request, digest)
+    except ValueError as error:
+        return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    store = _store()
+    pending = {'fingerprint': digest, 'status': None}
+    while not store.add(key, pending, timeout=IN_FLIGHT_SECONDS):
+        entry = store.get(key)
+        if entry is not None:
+            return _replay(entry, digest)
+        # Expired between add and get; claim it again
+    try:
+        response = create()
+    except BaseException:
+        store.delete(key)
+        raise
+    if status.is_success(response.status_code):
+        store.set(key, {
+            'fingerprint': digest,
+            'status': response.status_code,
+            # Serializer output keeps a reference to its serializer; store plain data
+            'data': dict(response.data),
+        }, timeout=timeout)
+    else:
+        store.delete(key)
+    return response
+
+
+def clear():
+    _store().clear()
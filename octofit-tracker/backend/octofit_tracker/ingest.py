@@ -0,0 +1,107 @@
+"""
+Batched activity ingestion used by ``ActivityViewSet.bulk``.
+
+Rows are validated with a single reused ``ActivitySerializer`` per batch and
+written with one ``insert_many`` per batch, so memory is bounded by the batch
+size rather than by the size of the upload. Derived data is updated once per
+batch through ``activity_events``.
+"""
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.db import connections
+from pymongo.errors import BulkWriteError
+from rest_framework import serializers
+
+from .models import Activity
+from .serializers import ActivitySerializer
+from . import activity_events
+
+
+class MalformedRow:
+    """Placeholder for an NDJSON line that is not valid JSON"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def iter_ndjson(stream):
+    """Yield one parsed object per non-blank line of ``stream``"""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            yield MalformedRow(str(exc))
+
+
+def to_document(instance):
+    """Convert an unsaved model instance to the document djongo would insert"""
+    connection = connections[instance._state.db or 'default']
+    document = {}
+    for field in instance._meta.concrete_fields:
+        if field.primary_key:
+            continue
+        document[field.column] = field.get_db_prep_save(getattr(instance, field.attname), connection)
+    return document
+
+
+def _validate(batch, serializer):
+    valid, errors = [], []
+    for row, data in batch:
+        if isinstance(data, MalformedRow):
+            errors.append((row, {'non_field_errors': [data.error]}))
+            continue
+        try:
+            valid.append((row, serializer.run_validation(data)))
+        except serializers.ValidationError as exc:
+            errors.append((row, exc.detail))
+    return valid, errors
+
+
+def _insert(valid):
+    """Insert a validated batch; return the rows that failed to write"""
+    documents = [to_document(Activity(**data)) for _, data in valid]
+    try:
+        Activity.objects.mongo_insert_many(documents, ordered=False)
+    except BulkWriteError as exc:
+        return {error['index']: error['errmsg'] for error in exc.details['writeErrors']}
+    return {}
+
+
+def ingest_activities(rows, batch_size=None):
+    """
+    Validate and insert an iterable of activity dicts in fixed-size batches.
+
+    Returns a summary with the number of created and failed rows and the
+    per-row errors (row numbers are zero based, capped at
+    ``OCTOFIT_BULK_MAX_ERRORS``).
+    """
+    batch_size = batch_size or settings.OCTOFIT_BULK_BATCH_SIZE
+    serializer = ActivitySerializer()
+    summary = {'created': 0, 'failed': 0, 'errors': []}
+    numbered = iter(enumerate(rows))
+    while True:
+        batch = list(islice(numbered, batch_size))
+        if not batch:
+            break
+        valid, errors = _validate(batch, serializer)
+        if valid:
+            write_errors = _insert(valid)
+            written = []
+            for index, (row, data) in enumerate(valid):
+                if index in write_errors:
+                    errors.append((row, {'non_field_errors': [write_errors[index]]}))
+                else:
+                    written.append(data)
+            activity_events.activities_written(added=written)
+            summary['created'] += len(valid) - len(write_errors)
+        summary['failed'] += len(errors)
+        room = max(settings.OCTOFIT_BULK_MAX_ERRORS - len(summary['errors']), 0)
+        summary['errors'].extend(
+            {'row': row, 'errors': detail} for row, detail in sorted(errors, key=lambda e: e[0])[:room]
+        )
+    return summary
@@ -0,0 +1,208 @@
+"""
+Incremental leaderboard maintenance.
+
+Ranks follow standard competition ranking: an entry's rank is one plus the
+number of entries with strictly more ``total_calories``. When one user's
+score moves from ``old`` to ``new`` only the entries whose score lies
+between the two change rank, so a write re-ranks just that range with one
+aggregation (``rerank``) instead of the whole collection. ``rebuild_ranks``
+is the same aggregation without bounds, for explicit repairs. Full
+recomputes (``rebuild_ranks``, ``recompute_team_points`` and
+``rebuild_leaderboard``) write their results back with ``$merge``, so no
+document leaves the server.
+
+Totals are exact: each write is one atomic ``$inc`` upsert on the entry,
+which the unique ``user_email`` index keeps to one entry per user. Ranks
+are exact once concurrent writes finish: every re-rank takes a number from
+the ``leaderboard`` counter after its totals are written and stamps the
+entries it ranks with it (``rank_stamp``). A re-rank therefore sees every
+write numbered before it, and an entry never takes a rank from a re-rank
+numbered before the one that last ranked it, so a slow re-rank that read
+the scores before a concurrent write cannot overwrite the ranks that write
+computed.
+"""
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .models import Activity, Leaderboard, Team, User
+from . import live, mongo_client, rank_index, result_cache, versions
+from .boards import boards
+
+COUNTERS_COLLECTION = 'counters'
+
+
+def _next_stamp():
+    """The next number of the leaderboard's re-rank counter"""
+    for attempt in range(2):
+        try:
+            return mongo_client.database()[COUNTERS_COLLECTION].find_one_and_update(
+                {'_id': 'leaderboard'}, {'$inc': {'stamp': 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )['stamp']
+        except DuplicateKeyError:
+            # A concurrent first use created the counter; the retry increments it
+            if attempt:
+                raise
+
+
+def rerank(low=None, high=None):
+    """
+    Recompute the rank of every entry scoring from ``low`` to ``high``
+    (inclusive; None leaves that side open) inside MongoDB; returns the
+    re-rank's stamp
+    """
+    stamp = _next_stamp()
+    scores, ahead = {}, 0
+    if low is not None:
+        scores['$gte'] = low
+    if high is not None:
+        scores['$lte'] = high
+        ahead = Leaderboard.objects.mongo_count_documents({'total_calories': {'$gt': high}})
+    current = {'$ifNull': ['$rank_stamp', 0]}
+    Leaderboard.objects.mongo_aggregate([
+        {'$match': {'total_calories': scores} if scores else {}},
+        {'$setWindowFields': {'sortBy': {'total_calories': -1}, 'output': {'rank': {'$rank': {}}}}},
+        {'$project': {'rank': {'$add': ['$rank', ahead]}, 'rank_stamp': {'$literal': stamp}}},
+        {'$merge': {
+            'into': Leaderboard._meta.db_table, 'on': '_id',
+            # Only a re-rank numbered after the one that last ranked the entry may change it
+            'whenMatched': [{'$set': {
+                'rank': {'$cond': [{'$gt': ['$$new.rank_stamp', current]}, '$$new.rank', '$rank']},
+                'rank_stamp': {'$max': ['$$new.rank_stamp', current]},
+            }}],
+            'whenNotMatched': 'discard',
+        }},
+    ])
+    return stamp
+
+
+def _increment(user_email, calories, activities, user):
+    """Add to a user's totals, creating the entry if needed; returns the entry as it was, or None"""
+    update = {
+        '$inc': {'total_calories': calories, 'total_activities': activities},
+        '$setOnInsert': {
+            'user_name': user['name'] if user else user_email,
+            'team': user.get('team', '') if user else '',
+            'rank': 0,
+        },
+    }
+    for attempt in range(2):
+        try:
+            return Leaderboard.objects.mongo_find_one_and_update(
+                {'user_email': user_email}, update,
+                projection={'total_calories': 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+        except DuplicateKeyError:
+            # A concurrent first write created the entry; the retry updates it
+            if attempt:
+                raise
+
+
+def apply_delta(user_email, calories, activities, user=None):
+    """
+    Add ``calories`` and ``activities`` (either may be negative) to a user's
+    leaderboard entry and re-rank the entries it passed. ``user`` is the user
+    document, used for the name and team of a new entry.
+    """
+    if not calories and not activities:
+        return
+    before = _increment(user_email, calories, activities, user)
+    old = None if before is None else before['total_calories']
+    new = (old or 0) + calories
+    if old is None:
+        # A new entry passes everyone scoring less
+        stamp = rerank(high=new)
+    elif new != old:
+        stamp = rerank(min(old, new), max(old, new))
+    else:
+        stamp = None
+    rank_index.index.update(user_email, new)
+    result_cache.invalidate('leaderboard.top')
+    if stamp is not None:
+        live.record(stamp, rank_index.index.rank_of(user_email))
+
+
+def rebuild_ranks():
+    """Recompute every rank inside MongoDB with one aggregation; returns its stamp"""
+    stamp = rerank()
+    result_cache.invalidate('leaderboard.top')
+    versions.bump(Leaderboard._meta.db_table)
+    return stamp
+
+
+def recompute_team_points():
+    """
+    Reset every team's ``total_points`` to the sum of its members' leaderboard
+    calories (0 for teams without any), dropping any drift
+    """
+    Team.objects.mongo_aggregate([
+        {'$lookup': {
+            'from': Leaderboard._meta.db_table, 'localField': 'name', 'foreignField': 'team',
+            'pipeline': [{'$group': {'_id': None, 'points': {'$sum': '$total_calories'}}}],
+            'as': 'totals',
+        }},
+        {'$project': {'total_points': {'$ifNull': [{'$first': '$totals.points'}, 0]}}},
+        {'$merge': {'into': Team._meta.db_table, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}},
+    ])
+    versions.bump(Team._meta.db_table)
+
+
+def rebuild_leaderboard():
+    """
+    Recompute the whole leaderboard and every team's points inside MongoDB,
+    under the rule ``apply_delta`` follows: every email with activities has
+    an entry, named and teamed from its user when there is one, and entries
+    are never deleted. Totals are summed per email from the activities
+    collection and upserted by email with ``$merge`` (so existing entries
+    keep their ids); entries whose activities are all gone are reset to
+    zero, then everything is re-ranked. Takes the same few round trips
+    however many users there are. Returns the number of entries reset.
+    """
+    # $merge on user_email needs its unique index, which nothing else may have created yet;
+    # named as sync_indexes names it, so this is a no-op once it exists
+    Leaderboard.objects.mongo_create_index(
+        [('user_email', ASCENDING)], name=f'{Leaderboard._meta.db_table}_user_email_uniq', unique=True,
+    )
+    Activity.objects.mongo_aggregate([
+        {'$group': {'_id': '$user_email', 'calories': {'$sum': '$calories'}, 'count': {'$sum': 1}}},
+        {'$lookup': {'from': User._meta.db_table, 'localField': '_id', 'foreignField': 'email', 'as': 'user'}},
+        {'$project': {
+            '_id': 0,
+            'user_email': '$_id',
+            'user_name': {'$ifNull': [{'$first': '$user.name'}, '$_id']},
+            'team': {'$ifNull': [{'$first': '$user.team'}, '']},
+            'total_calories': '$calories',
+            'total_activities': '$count',
+            'rank': {'$literal': 0},
+        }},
+        {'$merge': {
+            'into': Leaderboard._meta.db_table, 'on': 'user_email', 'whenMatched': 'merge', 'whenNotMatched': 'insert',
+        }},
+    ])
+    emptied = [
+        entry['_id'] for entry in Leaderboard.objects.mongo_aggregate([
+            {'$match': {'$or': [{'total_calories': {'$ne': 0}}, {'total_activities': {'$ne': 0}}]}},
+            {'$lookup': {
+                'from': Activity._meta.db_table, 'localField': 'user_email', 'foreignField': 'user_email',
+                'pipeline': [{'$limit': 1}, {'$project': {'_id': 1}}],
+                'as': 'activities',
+            }},
+            {'$match': {'activities': {'$size': 0}}},
+            {'$project': {'_id': 1}},
+        ])
+    ]
+    if emptied:
+        # Where deleting all of a user's activities one by one leaves them
+        Leaderboard.objects.mongo_update_many(
+            {'_id': {'$in': emptied}}, {'$set': {'total_calories': 0, 'total_activities': 0}},
+        )
+    stamp = rebuild_ranks()
+    recompute_team_points()
+    rank_index.index.invalidate()
+    boards.invalidate('all')
+    # Any total may have changed: the subscribers of every process reload the board
+    live.record(stamp)
+    return len(emptied)
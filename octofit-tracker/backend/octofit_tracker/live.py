@@ -0,0 +1,340 @@
+"""
+Live leaderboard over Server-Sent Events.
+
+``GET /api/leaderboard/live/`` keeps the response open and pushes each
+user's new total and rank as ``leaderboard.apply_delta`` records them, so
+clients no longer poll ``/api/leaderboard/top/``. A change moves the
+entries it passed by one rank; that follows from the totals and is not
+sent. A ``reset`` event tells the client to (re)load the board: it is the
+first event of a new connection, and it is sent after the leaderboard is
+rebuilt from the activities or when the client has fallen behind the
+changes still held.
+
+Changes are shared by every process through ``leaderboard_changes``, a
+capped collection of the last ``OCTOFIT_LIVE_BUFFER`` changes (``record``).
+Each is numbered with the stamp of the re-rank that produced it (see
+leaderboard.py), and those numbers are the event ids, so a reconnecting
+``EventSource`` resumes from its ``Last-Event-ID`` on any worker. While a
+process has subscribers it reads the new changes every
+``OCTOFIT_LIVE_POLL`` seconds (``LeaderboardHub.poll``). Stamps are taken
+before their change is recorded, so a change found after a gap in the
+numbers waits one more read for the gap to fill; numbers used by re-ranks
+that record nothing stay gaps.
+
+``LeaderboardHub`` keeps the last ``OCTOFIT_LIVE_BUFFER`` changes in a ring,
+each encoded once when it is published. A subscriber holds only its cursor
+into the ring; all of them wait on one shared event, set once per wake-up
+however many there are. A woken subscriber sends everything past its
+cursor as one message keeping only the latest change per user (the message
+is built once for all the subscribers at the same cursor), then waits its
+interval (``?interval=`` seconds, at least ``OCTOFIT_LIVE_MIN_INTERVAL``)
+before sending again, so a burst of writes costs each client one message.
+
+The stream is a plain ASGI app routed in ``asgi.py`` ahead of Django, so it
+holds no worker thread and is not counted by the load shedding middleware;
+``OCTOFIT_LIVE_MAX_SUBSCRIBERS`` caps it instead.
+"""
+import asyncio
+import json
+import threading
+from collections import deque
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+from . import metrics, mongo_client
+
+LIVE_PATH = '/api/leaderboard/live/'
+CHANGES_COLLECTION = 'leaderboard_changes'
+# Room per change in the capped collection, in bytes
+CHANGE_SIZE = 256
+ENTRY_FIELDS = ('user_email', 'total_calories', 'rank')
+
+# Stands for a reset in the ring and for "reload the board" to subscribers
+RESET = object()
+
+
+class MongoChanges:
+    """The changes shared by every process: ``{_id: stamp, user_email, total_calories, rank}``"""
+
+    def __init__(self):
+        self._created = False
+
+    def _collection(self):
+        database = mongo_client.database()
+        if not self._created:
+            try:
+                database.create_collection(
+                    CHANGES_COLLECTION, capped=True,
+                    size=settings.OCTOFIT_LIVE_BUFFER * CHANGE_SIZE, max=settings.OCTOFIT_LIVE_BUFFER,
+                )
+            except CollectionInvalid:
+                # Created by another process
+                pass
+            self._created = True
+        return database[CHANGES_COLLECTION]
+
+    def append(self, stamp, entry):
+        """Add ``entry`` (None for a reset) as change number ``stamp``"""
+        self._collection().insert_one({'_id': stamp, **(entry or {'user_email': None})})
+
+    def latest(self):
+        """The number of the last change, 0 without any"""
+        document = self._collection().find_one({}, sort=[('_id', -1)])
+        return document['_id'] if document else 0
+
+    def since(self, stamp):
+        """The changes numbered after ``stamp``, in order"""
+        return list(self._collection().find({'_id': {'$gt': stamp}}, sort=[('_id', 1)]))
+
+
+changes = MongoChanges()
+
+
+def record(stamp, entry=None):
+    """
+    Publish ``{'user_email', 'total_calories', 'rank'}`` as change number
+    ``stamp`` to the subscribers of every process, or with no ``entry`` tell
+    them all to reload the board
+    """
+    changes.append(stamp, entry)
+
+
+class LeaderboardHub:
+    def __init__(self):
+        self._changes = deque()
+        self._sequence = 0
+        # Every change after this number is in the ring
+        self._floor = 0
+        self._synced = False
+        self._held = set()
+        self._lock = threading.Lock()
+        self._polling = threading.Lock()
+        self._loop = None
+        self._changed = None
+        self._wake_scheduled = False
+        self._message = None
+        self._follower = None
+        self.subscribers = 0
+
+    @property
+    def sequence(self):
+        return self._sequence
+
+    @property
+    def synced(self):
+        return self._synced
+
+    def publish(self, sequence, entry):
+        """Add ``{'user_email', 'total_calories', 'rank'}`` as change ``sequence``; callable from any thread"""
+        self._append(sequence, entry['user_email'], json.dumps(entry, separators=(',', ':')))
+
+    def reset(self, sequence):
+        """Tell every subscriber to reload the board"""
+        self._append(sequence, RESET, None)
+
+    def poll(self, source=None):
+        """Add the changes ``source`` (the shared ones by default) recorded since the last poll"""
+        with self._polling:
+            self._poll(source or changes)
+
+    def _poll(self, source):
+        if not self._synced:
+            with self._lock:
+                self._sequence = self._floor = source.latest()
+            self._synced = True
+            return
+        found = source.since(self._sequence)
+        if len(found) >= settings.OCTOFIT_LIVE_BUFFER:
+            # Changes may have left the capped collection unread
+            self._held = set()
+            return self.reset(found[-1]['_id'])
+        expected = self._sequence + 1
+        for index, change in enumerate(found):
+            if change['_id'] != expected and change['_id'] not in self._held:
+                self._held = {later['_id'] for later in found[index:]}
+                return
+            if change['user_email'] is None:
+                self.reset(change['_id'])
+            else:
+                self.publish(change['_id'], {field: change[field] for field in ENTRY_FIELDS})
+            expected = change['_id'] + 1
+        self._held = set()
+
+    async def follow(self):
+        """Poll until ``stop()``"""
+        while True:
+            try:
+                await asyncio.to_thread(self.poll)
+            except PyMongoError:
+                # Retried on the next poll; subscribers keep the changes they have
+                pass
+            await asyncio.sleep(settings.OCTOFIT_LIVE_POLL)
+
+    def stop(self):
+        """Stop polling once the last subscriber has gone"""
+        follower, self._follower = self._follower, None
+        if follower is not None:
+            follower.cancel()
+        # Changes recorded meanwhile are not read; the next subscriber starts from the last one
+        self._synced = False
+
+    def _append(self, sequence, email, encoded):
+        with self._lock:
+            self._sequence = sequence
+            self._changes.append((sequence, email, encoded))
+            while len(self._changes) > settings.OCTOFIT_LIVE_BUFFER:
+                self._floor = self._changes.popleft()[0]
+            loop = self._loop
+            if loop is None or self._wake_scheduled:
+                return
+            self._wake_scheduled = True
+        try:
+            loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            # The loop the subscribers ran on has been closed
+            with self._lock:
+                self._loop, self._wake_scheduled = None, False
+
+    def _wake(self):
+        # Runs on the subscribers' loop
+        with self._lock:
+            self._wake_scheduled = False
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def attach(self):
+        """Deliver wake-ups to the running loop, and follow the shared changes on it"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._loop is not loop:
+                self._loop, self._changed, self._wake_scheduled = loop, asyncio.Event(), False
+                self._follower = None
+        if self._follower is None or self._follower.done():
+            self._follower = loop.create_task(self.follow())
+
+    def changed(self):
+        """The event set on the next wake-up"""
+        return self._changed
+
+    def changes_since(self, cursor):
+        """
+        ``(sequence, message)`` for a subscriber at ``cursor``: the changes
+        after it as one JSON list with the latest change per user, RESET when
+        they are not all held or include a reset, or None when there are none
+        """
+        with self._lock:
+            sequence = self._sequence
+            if cursor == sequence:
+                return sequence, None
+            if self._message is not None and self._message[:2] == (cursor, sequence):
+                return sequence, self._message[2]
+            latest = {}
+            if cursor > sequence or cursor < self._floor:
+                message = RESET
+            else:
+                for number, email, encoded in reversed(self._changes):
+                    if number <= cursor:
+                        break
+                    if email is RESET:
+                        latest = None
+                        break
+                    latest.setdefault(email, encoded)
+                message = RESET if latest is None else '[' + ','.join(reversed(latest.values())) + ']'
+            self._message = (cursor, sequence, message)
+        return sequence, message
+
+
+hub = LeaderboardHub()
+
+
+def _event(sequence, message):
+    name, data = ('reset', '{}') if message is RESET else ('ranks', message)
+    return f'id: {sequence}\nevent: {name}\ndata: {data}\n\n'.encode()
+
+
+async def _respond(send, status, body, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(body).encode()})
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def _cursor(headers, params):
+    value = dict(headers).get(b'last-event-id', b'').decode('latin-1') or params.get('last_event_id', [''])[0]
+    return int(value) if value.isdigit() else None
+
+
+async def stream(scope, receive, send):
+    """ASGI app for ``LIVE_PATH``"""
+    if scope['method'] != 'GET':
+        return await _respond(send, 405, {'error': 'Method not allowed'}, [(b'allow', b'GET')])
+    params = parse_qs(scope['query_string'].decode('latin-1'))
+    try:
+        interval = float(params.get('interval', [settings.OCTOFIT_LIVE_MIN_INTERVAL])[0])
+    except ValueError:
+        return await _respond(send, 400, {'error': 'interval must be a number of seconds'})
+    interval = min(max(interval, settings.OCTOFIT_LIVE_MIN_INTERVAL), 3600)
+    if hub.subscribers >= settings.OCTOFIT_LIVE_MAX_SUBSCRIBERS:
+        metrics.LIVE_REFUSED.inc()
+        retry_after = str(settings.OCTOFIT_SHED_RETRY_AFTER).encode()
+        return await _respond(send, 503, {'error': 'Too many live subscribers'}, [(b'retry-after', retry_after)])
+
+    hub.subscribers += 1
+    disconnected = asyncio.ensure_future(_disconnected(receive))
+    try:
+        if not hub.synced:
+            # The first subscriber of the process starts from the last shared change
+            try:
+                await asyncio.to_thread(hub.poll)
+            except PyMongoError:
+                # The follower syncs once MongoDB answers; this subscriber is then told to reload
+                pass
+        hub.attach()
+        cursor = _cursor(scope['headers'], params)
+        headers = [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no'),
+        ]
+        if settings.CORS_ALLOW_ALL_ORIGINS:
+            headers.append((b'access-control-allow-origin', b'*'))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        if cursor is None:
+            cursor = hub.sequence
+            first = _event(cursor, RESET)
+        else:
+            first = b''
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n' + first, 'more_body': True})
+
+        while not disconnected.done():
+            sequence, message = hub.changes_since(cursor)
+            if message is None:
+                changed = asyncio.ensure_future(hub.changed().wait())
+                done, _ = await asyncio.wait(
+                    {changed, disconnected}, timeout=settings.OCTOFIT_LIVE_HEARTBEAT,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                changed.cancel()
+                if not done:
+                    # Keeps proxies from closing the connection and finds dead clients
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                continue
+            cursor = sequence
+            await send({'type': 'http.response.body', 'body': _event(sequence, message), 'more_body': True})
+            metrics.LIVE_MESSAGES.inc()
+            # The rate cap: changes arriving meanwhile go out together next time
+            await asyncio.wait({disconnected}, timeout=interval)
+    except OSError:
+        pass
+    finally:
+        hub.subscribers -= 1
+        disconnected.cancel()
+        if not hub.subscribers:
+            hub.stop()
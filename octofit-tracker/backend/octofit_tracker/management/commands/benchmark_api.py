@@ -0,0 +1,92 @@
+import json
+import platform
+from datetime import datetime
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark every API route in-process and report throughput, latency '
+        'percentiles and MongoDB round trips per request'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=None,
+            help='Repopulate the database with this many synthetic users first (destroys existing data)'
+        )
+        parser.add_argument('--activities-per-user', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per route')
+        parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests per route')
+        parser.add_argument('--concurrency', type=int, default=1, help='Client threads per route')
+        parser.add_argument('--route', action='append', default=[], help='Only run routes containing this text')
+        parser.add_argument('--save', help='Write the results to this JSON baseline file')
+        parser.add_argument('--compare', help='Compare against a saved JSON baseline')
+        parser.add_argument(
+            '--threshold', type=float, default=0.2,
+            help='Allowed relative regression before --compare fails (default: 0.2)'
+        )
+
+    def handle(self, *args, **options):
+        if options['users'] is not None:
+            call_command(
+                'populate_db', users=options['users'], seed=options['seed'],
+                activities_per_user=options['activities_per_user'], stdout=self.stdout
+            )
+
+        routes = benchmark.discover_routes()
+        if options['route']:
+            routes = [route for route in routes if any(text in route['name'] for text in options['route'])]
+        requests, skipped = benchmark.build_requests(routes, benchmark.Samples())
+        for name in skipped:
+            self.stdout.write(f'skipped {name} (writes data or no sample document)')
+
+        header = f"{'route':<28}{'method':>7}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db/req':>8}{'errors':>8}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        results = {}
+        for request in requests:
+            with benchmark.unlimited():
+                summary = benchmark.run_request(
+                    request, options['requests'], options['warmup'], options['concurrency']
+                )
+            key = f"{request['method'].upper()} {request['name']}"
+            results[key] = summary
+            round_trips = summary['db_round_trips']
+            round_trips = f'{round_trips:>8.1f}' if round_trips is not None else f"{'-':>8}"
+            self.stdout.write(
+                f"{request['name']:<28}{request['method'].upper():>7}{summary['throughput']:>10.1f}"
+                f"{summary['p50_ms']:>9.2f}{summary['p95_ms']:>9.2f}{summary['p99_ms']:>9.2f}"
+                f"{round_trips}{summary['errors']:>8}"
+            )
+
+        if options['save']:
+            with open(options['save'], 'w') as handle:
+                json.dump({
+                    'meta': {
+                        'created': datetime.utcnow().isoformat(),
+                        'python': platform.python_version(),
+                        'requests': options['requests'],
+                        'concurrency': options['concurrency'],
+                        'users': options['users'],
+                        'activities_per_user': options['activities_per_user'],
+                        'seed': options['seed'],
+                    },
+                    'routes': results,
+                }, handle, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {options['save']}"))
+
+        if options['compare']:
+            with open(options['compare']) as handle:
+                baseline = json.load(handle)['routes']
+            regressions = list(benchmark.compare(results, baseline, options['threshold']))
+            for name, metric, before, after in regressions:
+                self.stdout.write(self.style.ERROR(f'{name}: {metric} {before:.2f} -> {after:.2f}'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regression(s) against {options["compare"]}')
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
@@ -0,0 +1,65 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the sync API routes served by a pool of WSGI worker threads with '
+        'their /api/async/ versions served on one ASGI event loop, at high concurrency'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=None,
+            help='Repopulate the database with this many synthetic users first (destroys existing data)'
+        )
+        parser.add_argument('--activities-per-user', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--requests', type=int, default=2000, help='Measured requests per route and server')
+        parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per route and server')
+        parser.add_argument('--concurrency', type=int, default=200, help='Clients kept in flight')
+        parser.add_argument('--threads', type=int, default=16, help='WSGI worker threads')
+        parser.add_argument('--route', action='append', default=[], help='Only run routes containing this text')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['threads'] < 1:
+            raise CommandError('--concurrency and --threads must be at least 1')
+        if options['users'] is not None:
+            call_command(
+                'populate_db', users=options['users'], seed=options['seed'],
+                activities_per_user=options['activities_per_user'], stdout=self.stdout
+            )
+
+        routes = benchmark.discover_routes()
+        if options['route']:
+            routes = [route for route in routes if any(text in route['name'] for text in options['route'])]
+        requests, _ = benchmark.build_requests(routes, benchmark.Samples())
+        pairs = benchmark.async_requests(requests)
+        if not pairs:
+            raise CommandError('No routes with an async version matched')
+
+        self.stdout.write(
+            f"{options['concurrency']} concurrent clients; WSGI on {options['threads']} threads, "
+            f"ASGI on one event loop"
+        )
+        header = f"{'route':<28}{'server':>7}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for sync_request, async_request in pairs:
+            with benchmark.unlimited():
+                wsgi = benchmark.run_wsgi(
+                    sync_request, options['requests'], options['concurrency'], options['threads'], options['warmup']
+                )
+                asgi = benchmark.run_asgi(
+                    async_request, options['requests'], options['concurrency'], options['warmup']
+                )
+            for server, summary in (('wsgi', wsgi), ('asgi', asgi)):
+                self.stdout.write(
+                    f"{sync_request['name']:<28}{server:>7}{summary['throughput']:>10.1f}"
+                    f"{summary['p50_ms']:>9.2f}{summary['p95_ms']:>9.2f}{summary['p99_ms']:>9.2f}"
+                    f"{summary['errors']:>8}"
+                )
+            if wsgi['throughput']:
+                self.stdout.write(f"{'':<28}{'':>7}{asgi['throughput'] / wsgi['throughput']:>9.2f}x")
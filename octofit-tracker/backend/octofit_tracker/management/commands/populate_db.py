@@ -1,257 +1,286 @@
-from django.core.management.base import BaseCommand
-from octofit_tracker.models import User, Team, Activity, Leaderboard, Workout
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from octofit_tracker.models import User, Team, Activity, ActivityRollup, Leaderboard, Workout
+from octofit_tracker import leaderboard, rollups, versions
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from itertools import islice
+import multiprocessing
 import random
 
 
+MARVEL_HEROES = [
+    {'name': 'Iron Man', 'email': 'tony.stark@marvel.com'},
+    {'name': 'Captain America', 'email': 'steve.rogers@marvel.com'},
+    {'name': 'Thor', 'email': 'thor.odinson@marvel.com'},
+    {'name': 'Black Widow', 'email': 'natasha.romanoff@marvel.com'},
+    {'name': 'Hulk', 'email': 'bruce.banner@marvel.com'},
+    {'name': 'Spider-Man', 'email': 'peter.parker@marvel.com'},
+]
+
+DC_HEROES = [
+    {'name': 'Batman', 'email': 'bruce.wayne@dc.com'},
+    {'name': 'Superman', 'email': 'clark.kent@dc.com'},
+    {'name': 'Wonder Woman', 'email': 'diana.prince@dc.com'},
+    {'name': 'The Flash', 'email': 'barry.allen@dc.com'},
+    {'name': 'Aquaman', 'email': 'arthur.curry@dc.com'},
+    {'name': 'Green Lantern', 'email': 'hal.jordan@dc.com'},
+]
+
+ACTIVITY_TYPES = [
+    {'type': 'Running', 'cal_per_min': 10},
+    {'type': 'Swimming', 'cal_per_min': 12},
+    {'type': 'Cycling', 'cal_per_min': 8},
+    {'type': 'Weightlifting', 'cal_per_min': 6},
+    {'type': 'Yoga', 'cal_per_min': 4},
+    {'type': 'Boxing', 'cal_per_min': 11},
+]
+
+WORKOUTS = [
+    {
+        'name': 'Super Soldier Cardio',
+        'category': 'Cardio',
+        'description': 'High-intensity cardio workout inspired by Captain America training',
+        'difficulty': 'Hard',
+        'duration': 45,
+        'calories_per_session': 450
+    },
+    {
+        'name': 'Asgardian Strength Training',
+        'category': 'Strength',
+        'description': 'Heavy weightlifting routine worthy of the God of Thunder',
+        'difficulty': 'Hard',
+        'duration': 60,
+        'calories_per_session': 360
+    },
+    {
+        'name': 'Web-Slinger Flexibility',
+        'category': 'Flexibility',
+        'description': 'Dynamic stretching and mobility exercises',
+        'difficulty': 'Medium',
+        'duration': 30,
+        'calories_per_session': 120
+    },
+    {
+        'name': 'Bat-Training Combat',
+        'category': 'Martial Arts',
+        'description': 'Intensive combat training and boxing drills',
+        'difficulty': 'Hard',
+        'duration': 50,
+        'calories_per_session': 550
+    },
+    {
+        'name': 'Kryptonian Power Workout',
+        'category': 'Full Body',
+        'description': 'Complete body workout combining strength and cardio',
+        'difficulty': 'Hard',
+        'duration': 55,
+        'calories_per_session': 500
+    },
+    {
+        'name': 'Amazonian Warrior Training',
+        'category': 'Strength',
+        'description': 'Functional strength training with warrior spirit',
+        'difficulty': 'Medium',
+        'duration': 40,
+        'calories_per_session': 320
+    },
+    {
+        'name': 'Speed Force Sprint',
+        'category': 'Cardio',
+        'description': 'Sprint intervals and speed training',
+        'difficulty': 'Hard',
+        'duration': 35,
+        'calories_per_session': 400
+    },
+    {
+        'name': 'Atlantean Swimming',
+        'category': 'Swimming',
+        'description': 'Aquatic endurance and strength training',
+        'difficulty': 'Medium',
+        'duration': 45,
+        'calories_per_session': 540
+    },
+    {
+        'name': 'Willpower Yoga',
+        'category': 'Yoga',
+        'description': 'Mind and body alignment through yoga practice',
+        'difficulty': 'Easy',
+        'duration': 30,
+        'calories_per_session': 120
+    },
+    {
+        'name': 'Arc Reactor Core',
+        'category': 'Core',
+        'description': 'Core strengthening exercises for stability',
+        'difficulty': 'Medium',
+        'duration': 25,
+        'calories_per_session': 150
+    },
+]
+
+# Team.members is a single array, so keep every team document well below
+# MongoDB's 16MB limit
+MAX_MEMBERS_PER_TEAM = 200000
+
+# Activities are generated in chunks of users, each with its own seeded RNG,
+# so the dataset only depends on --seed and not on the number of workers
+USERS_PER_CHUNK = 1000
+
+
+def insert_batches(model, documents, batch_size):
+    """Write an iterable of documents with one insert_many per batch"""
+    documents = iter(documents)
+    inserted = 0
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            return inserted
+        model.objects.mongo_insert_many(batch, ordered=False)
+        inserted += len(batch)
+
+
+def generate_activities(emails, seed, activities_per_user, days, end):
+    """Yield activity documents for ``emails`` from a deterministic RNG"""
+    rng = random.Random(seed)
+    for email in emails:
+        # Superhero mode keeps the original 5-10 activities per user
+        count = activities_per_user if activities_per_user is not None else rng.randint(5, 10)
+        for i in range(count):
+            activity_type = rng.choice(ACTIVITY_TYPES)
+            duration = rng.randint(20, 90)
+            yield {
+                'user_email': email,
+                'activity_type': activity_type['type'],
+                'duration': duration,
+                'calories': duration * activity_type['cal_per_min'],
+                'date': end - timedelta(days=rng.randint(0, days), seconds=rng.randint(0, 86399)),
+            }
+
+
+def populate_chunk(task):
+    """
+    Generate and insert the activities for one chunk of users.
+
+    Runs in a worker process when --workers > 1. Returns the number of
+    activities inserted.
+    """
+    emails, seed, activities_per_user, days, end, batch_size = task
+    return insert_batches(Activity, generate_activities(emails, seed, activities_per_user, days, end), batch_size)
+
+
 class Command(BaseCommand):
     help = 'Populate the octofit_db database with test data'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+        parser.add_argument(
+            '--users', type=int, default=None,
+            help='Generate this many synthetic users instead of the 12 superheroes'
+        )
+        parser.add_argument('--teams', type=int, default=2, help='Number of synthetic teams (default: 2)')
+        parser.add_argument(
+            '--activities-per-user', type=int, default=None,
+            help='Activities per user (default: 5-10 for superheroes, 10 for synthetic users)'
+        )
+        parser.add_argument('--days', type=int, default=30, help='Spread activities over this many past days')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Documents per insert_many call')
+        parser.add_argument('--workers', type=int, default=1, help='Processes generating activities')
+
+    def handle(self, *args, **options):
         self.stdout.write('Clearing existing data...')
         
         # Delete existing data
-        User.objects.all().delete()
-        Team.objects.all().delete()
-        Activity.objects.all().delete()
-        Leaderboard.objects.all().delete()
-        Workout.objects.all().delete()
+        for model in (User, Team, Activity, ActivityRollup, Leaderboard, Workout):
+            model.objects.mongo_delete_many({})
         
         self.stdout.write(self.style.SUCCESS('Existing data cleared'))
         
-        # Create teams
-        self.stdout.write('Creating teams...')
-        team_marvel = Team.objects.create(
-            name='Team Marvel',
-            members=[],
-            total_points=0
-        )
-        team_dc = Team.objects.create(
-            name='Team DC',
-            members=[],
-            total_points=0
-        )
-        self.stdout.write(self.style.SUCCESS('Teams created'))
-        
-        # Create Marvel users
-        self.stdout.write('Creating Marvel superheroes...')
-        marvel_heroes = [
-            {'name': 'Iron Man', 'email': 'tony.stark@marvel.com'},
-            {'name': 'Captain America', 'email': 'steve.rogers@marvel.com'},
-            {'name': 'Thor', 'email': 'thor.odinson@marvel.com'},
-            {'name': 'Black Widow', 'email': 'natasha.romanoff@marvel.com'},
-            {'name': 'Hulk', 'email': 'bruce.banner@marvel.com'},
-            {'name': 'Spider-Man', 'email': 'peter.parker@marvel.com'},
-        ]
-        
-        marvel_users = []
-        for hero in marvel_heroes:
-            user = User.objects.create(
-                name=hero['name'],
-                email=hero['email'],
-                team='Team Marvel'
-            )
-            marvel_users.append(user)
-        
-        # Create DC users
-        self.stdout.write('Creating DC superheroes...')
-        dc_heroes = [
-            {'name': 'Batman', 'email': 'bruce.wayne@dc.com'},
-            {'name': 'Superman', 'email': 'clark.kent@dc.com'},
-            {'name': 'Wonder Woman', 'email': 'diana.prince@dc.com'},
-            {'name': 'The Flash', 'email': 'barry.allen@dc.com'},
-            {'name': 'Aquaman', 'email': 'arthur.curry@dc.com'},
-            {'name': 'Green Lantern', 'email': 'hal.jordan@dc.com'},
-        ]
-        
-        dc_users = []
-        for hero in dc_heroes:
-            user = User.objects.create(
-                name=hero['name'],
-                email=hero['email'],
-                team='Team DC'
-            )
-            dc_users.append(user)
-        
-        self.stdout.write(self.style.SUCCESS('Users created'))
+        if options['users'] is None:
+            users = self.superhero_users()
+            activities_per_user = options['activities_per_user']
+        else:
+            if options['users'] > options['teams'] * MAX_MEMBERS_PER_TEAM:
+                raise CommandError(
+                    f'At most {MAX_MEMBERS_PER_TEAM} users per team; pass a larger --teams'
+                )
+            users = self.synthetic_users(options['users'], options['teams'])
+            activities_per_user = 10 if options['activities_per_user'] is None else options['activities_per_user']
+        batch_size = options['batch_size']
         
-        # Update team members
-        team_marvel.members = [user.email for user in marvel_users]
-        team_marvel.save()
-        team_dc.members = [user.email for user in dc_users]
-        team_dc.save()
+        # Create users and teams
+        self.stdout.write('Creating users and teams...')
+        insert_batches(User, ({'name': name, 'email': email, 'team': team} for email, name, team in users), batch_size)
+        members = defaultdict(list)
+        for email, name, team in users:
+            members[team].append(email)
+        insert_batches(
+            Team,
+            ({'name': team, 'members': emails, 'total_points': 0} for team, emails in members.items()),
+            batch_size
+        )
+        self.stdout.write(self.style.SUCCESS(f'{len(users)} users in {len(members)} teams created'))
         
         # Create activities
         self.stdout.write('Creating activities...')
-        activity_types = [
-            {'type': 'Running', 'cal_per_min': 10},
-            {'type': 'Swimming', 'cal_per_min': 12},
-            {'type': 'Cycling', 'cal_per_min': 8},
-            {'type': 'Weightlifting', 'cal_per_min': 6},
-            {'type': 'Yoga', 'cal_per_min': 4},
-            {'type': 'Boxing', 'cal_per_min': 11},
+        end = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        emails = [email for email, name, team in users]
+        tasks = [
+            (emails[start:start + USERS_PER_CHUNK], f"{options['seed']}:{start}",
+             activities_per_user, options['days'], end, batch_size)
+            for start in range(0, len(emails), USERS_PER_CHUNK)
         ]
+        if options['workers'] > 1:
+            # Forked workers must open their own MongoDB connections
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=options['workers'], mp_context=context) as pool:
+                activity_count = sum(pool.map(populate_chunk, tasks))
+        else:
+            activity_count = sum(populate_chunk(task) for task in tasks)
+        self.stdout.write(self.style.SUCCESS(f'{activity_count} activities created'))
         
-        all_users = marvel_users + dc_users
-        for user in all_users:
-            # Create 5-10 activities per user
-            num_activities = random.randint(5, 10)
-            for i in range(num_activities):
-                activity_type = random.choice(activity_types)
-                duration = random.randint(20, 90)
-                calories = duration * activity_type['cal_per_min']
-                days_ago = random.randint(0, 30)
-                activity_date = datetime.now() - timedelta(days=days_ago)
-                
-                Activity.objects.create(
-                    user_email=user.email,
-                    activity_type=activity_type['type'],
-                    duration=duration,
-                    calories=calories,
-                    date=activity_date
-                )
-        
-        self.stdout.write(self.style.SUCCESS('Activities created'))
+        # Build the daily rollups behind the stats API
+        self.stdout.write('Building activity rollups...')
+        rollups.rebuild()
+        self.stdout.write(self.style.SUCCESS('Activity rollups built'))
         
-        # Create leaderboard entries
+        # Create leaderboard entries, ranked by total calories, and team points
         self.stdout.write('Creating leaderboard entries...')
-        for user in all_users:
-            user_activities = Activity.objects.filter(user_email=user.email)
-            total_calories = sum(activity.calories for activity in user_activities)
-            total_activities = user_activities.count()
-            
-            Leaderboard.objects.create(
-                user_email=user.email,
-                user_name=user.name,
-                team=user.team,
-                total_calories=total_calories,
-                total_activities=total_activities,
-                rank=0  # Will be updated after all entries are created
-            )
-        
-        # Update ranks based on total calories
-        leaderboard_entries = Leaderboard.objects.all().order_by('-total_calories')
-        for idx, entry in enumerate(leaderboard_entries, start=1):
-            entry.rank = idx
-            entry.save()
-        
+        leaderboard.rebuild_leaderboard()
         self.stdout.write(self.style.SUCCESS('Leaderboard entries created'))
         
         # Create workouts
         self.stdout.write('Creating workouts...')
-        workouts = [
-            {
-                'name': 'Super Soldier Cardio',
-                'category': 'Cardio',
-                'description': 'High-intensity cardio workout inspired by Captain America training',
-                'difficulty': 'Hard',
-                'duration': 45,
-                'calories_per_session': 450
-            },
-            {
-                'name': 'Asgardian Strength Training',
-                'category': 'Strength',
-                'description': 'Heavy weightlifting routine worthy of the God of Thunder',
-                'difficulty': 'Hard',
-                'duration': 60,
-                'calories_per_session': 360
-            },
-            {
-                'name': 'Web-Slinger Flexibility',
-                'category': 'Flexibility',
-                'description': 'Dynamic stretching and mobility exercises',
-                'difficulty': 'Medium',
-                'duration': 30,
-                'calories_per_session': 120
-            },
-            {
-                'name': 'Bat-Training Combat',
-                'category': 'Martial Arts',
-                'description': 'Intensive combat training and boxing drills',
-                'difficulty': 'Hard',
-                'duration': 50,
-                'calories_per_session': 550
-            },
-            {
-                'name': 'Kryptonian Power Workout',
-                'category': 'Full Body',
-                'description': 'Complete body workout combining strength and cardio',
-                'difficulty': 'Hard',
-                'duration': 55,
-                'calories_per_session': 500
-            },
-            {
-                'name': 'Amazonian Warrior Training',
-                'category': 'Strength',
-                'description': 'Functional strength training with warrior spirit',
-                'difficulty': 'Medium',
-                'duration': 40,
-                'calories_per_session': 320
-            },
-            {
-                'name': 'Speed Force Sprint',
-                'category': 'Cardio',
-                'description': 'Sprint intervals and speed training',
-                'difficulty': 'Hard',
-                'duration': 35,
-                'calories_per_session': 400
-            },
-            {
-                'name': 'Atlantean Swimming',
-                'category': 'Swimming',
-                'description': 'Aquatic endurance and strength training',
-                'difficulty': 'Medium',
-                'duration': 45,
-                'calories_per_session': 540
-            },
-            {
-                'name': 'Willpower Yoga',
-                'category': 'Yoga',
-                'description': 'Mind and body alignment through yoga practice',
-                'difficulty': 'Easy',
-                'duration': 30,
-                'calories_per_session': 120
-            },
-            {
-                'name': 'Arc Reactor Core',
-                'category': 'Core',
-                'description': 'Core strengthening exercises for stability',
-                'difficulty': 'Medium',
-                'duration': 25,
-                'calories_per_session': 150
-            },
-        ]
-        
-        for workout_data in workouts:
-            Workout.objects.create(**workout_data)
-        
+        insert_batches(Workout, (dict(workout) for workout in WORKOUTS), batch_size)
         self.stdout.write(self.style.SUCCESS('Workouts created'))
         
-        # Calculate and update team points
-        marvel_calories = sum(
-            entry.total_calories 
-            for entry in Leaderboard.objects.filter(team='Team Marvel')
-        )
-        dc_calories = sum(
-            entry.total_calories 
-            for entry in Leaderboard.objects.filter(team='Team DC')
-        )
-        
-        team_marvel.total_points = marvel_calories
-        team_marvel.save()
-        team_dc.total_points = dc_calories
-        team_dc.save()
+        # Retires every server's ETags and cached responses; their in-memory
+        # rank indexes, boards and user directories catch up on their next
+        # refresh (OCTOFIT_RANK_INDEX_REFRESH, OCTOFIT_USER_DIRECTORY_TTL)
+        versions.bump_all()
         
         # Display summary
         self.stdout.write('\n' + '='*50)
         self.stdout.write(self.style.SUCCESS('Database populated successfully!'))
         self.stdout.write('='*50)
-        self.stdout.write(f'Users created: {User.objects.count()}')
-        self.stdout.write(f'Teams created: {Team.objects.count()}')
-        self.stdout.write(f'Activities created: {Activity.objects.count()}')
-        self.stdout.write(f'Leaderboard entries: {Leaderboard.objects.count()}')
-        self.stdout.write(f'Workouts created: {Workout.objects.count()}')
+        for label, model in (('Users', User), ('Teams', Team), ('Activities', Activity),
+                             ('Leaderboard entries', Leaderboard), ('Workouts', Workout)):
+            self.stdout.write(f'{label}: {model.objects.mongo_estimated_document_count()}')
         self.stdout.write('='*50)
-        self.stdout.write(f'Team Marvel total points: {team_marvel.total_points}')
-        self.stdout.write(f'Team DC total points: {team_dc.total_points}')
+        for team in Team.objects.mongo_find({}, {'name': 1, 'total_points': 1}).sort('total_points', -1).limit(10):
+            self.stdout.write(f"{team['name']} total points: {team['total_points']}")
         self.stdout.write('='*50)
+
+    def superhero_users(self):
+        return (
+            [(hero['email'], hero['name'], 'Team Marvel') for hero in MARVEL_HEROES]
+            + [(hero['email'], hero['name'], 'Team DC') for hero in DC_HEROES]
+        )
+
+    def synthetic_users(self, count, teams):
+        return [
+            (f'user{n:08d}@octofit.test', f'User {n}', f'Team {n % teams + 1}')
+            for n in range(count)
+        ]
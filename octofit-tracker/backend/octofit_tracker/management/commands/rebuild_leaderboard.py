@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import leaderboard
+from octofit_tracker.models import Leaderboard
+
+
+class Command(BaseCommand):
+    help = 'Recompute the leaderboard and team points from the activities and users collections'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding leaderboard...')
+        reset = leaderboard.rebuild_leaderboard()
+        count = Leaderboard.objects.mongo_estimated_document_count()
+        self.stdout.write(self.style.SUCCESS(f'{count} leaderboard entries, {reset} reset to zero'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import rollups
+from octofit_tracker.models import ActivityRollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily activity rollups from the activities collection'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilding activity rollups...')
+        rollups.rebuild()
+        count = ActivityRollup.objects.mongo_estimated_document_count()
+        self.stdout.write(self.style.SUCCESS(f'{count} rollup buckets written'))
@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import tasks
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=max(settings.OCTOFIT_TASK_WORKERS, 1),
+                            help='Worker threads to run (default: OCTOFIT_TASK_WORKERS, at least 1)')
+        parser.add_argument('--once', action='store_true',
+                            help='Run the tasks that are due now in this thread, then exit')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            requeued = tasks.requeue_stale()
+            ran = tasks.run_pending()
+            self.stdout.write(self.style.SUCCESS(f'Ran {ran} tasks ({requeued} stale tasks requeued)'))
+            return
+        tasks.runner.start(options['workers'])
+        self.stdout.write(f"Running tasks with {options['workers']} workers, press Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping after the running tasks finish...')
+            tasks.runner.stop()
@@ -0,0 +1,142 @@
+from datetime import datetime
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import models
+from pymongo import ASCENDING, DESCENDING
+
+from octofit_tracker.models import Activity, ActivityRollup, Leaderboard, Task, User, Workout
+
+
+# Queries behind the hot endpoints, as (label, model, filter, sort)
+HOT_QUERIES = [
+    ('activities list', Activity, {}, [('date', DESCENDING), ('_id', DESCENDING)]),
+    ('activities by_user', Activity, {'user_email': 'user@example.com'}, [('date', DESCENDING), ('_id', DESCENDING)]),
+    ('leaderboard list', Leaderboard, {}, [('rank', ASCENDING), ('_id', ASCENDING)]),
+    ('leaderboard top/around', Leaderboard, {'user_email': {'$in': ['user@example.com']}}, None),
+    ('leaderboard rerank', Leaderboard, {'total_calories': {'$gte': 0, '$lte': 100}}, [('total_calories', DESCENDING)]),
+    ('users by_email', User, {'email': 'user@example.com'}, None),
+    ('users directory', User, {'email': {'$in': ['user@example.com', 'other@example.com']}}, None),
+    ('workouts by_category', Workout, {'category': 'Cardio'}, None),
+    ('workouts by_difficulty', Workout, {'difficulty': 'Hard'}, None),
+    ('stats by_user', ActivityRollup, {'user_email': 'user@example.com', 'day': {'$gte': datetime(2024, 1, 1)}}, None),
+    ('stats by_team', ActivityRollup, {'team': 'Team', 'day': {'$gte': datetime(2024, 1, 1)}}, None),
+    ('tasks claim', Task, {'status': 'queued', 'run_after': {'$lte': datetime(2024, 1, 1)}}, [('run_after', ASCENDING)]),
+    ('tasks list', Task, {}, [('created_at', DESCENDING), ('_id', DESCENDING)]),
+    ('tasks dedupe', Task, {'dedupe_key': 'leaderboard.rebuild_ranks:{}', 'status': 'queued'}, None),
+]
+
+
+def partial_filter(model, condition):
+    """The ``partialFilterExpression`` for a constraint ``condition`` of field equalities, as sorted items"""
+    if condition is None:
+        return None
+    if condition.connector != 'AND' or condition.negated:
+        raise ValueError(f'Unsupported constraint condition {condition}')
+    return tuple(sorted((model._meta.get_field(name).column, value) for name, value in condition.children))
+
+
+def declared_indexes(model):
+    """
+    Index specs declared on ``model`` (indexes, unique fields, and unique
+    constraints in ``Meta`` or in the model's ``mongo_constraints``) as
+    {(key, unique, partial filter): name}
+    """
+    declared = {}
+    for index in model._meta.indexes:
+        key = tuple(
+            (model._meta.get_field(name.lstrip('-')).column, DESCENDING if name.startswith('-') else ASCENDING)
+            for name in index.fields
+        )
+        declared[(key, False, None)] = index.name
+    for constraint in [*model._meta.constraints, *getattr(model, 'mongo_constraints', ())]:
+        if isinstance(constraint, models.UniqueConstraint):
+            key = tuple((model._meta.get_field(name).column, ASCENDING) for name in constraint.fields)
+            declared[(key, True, partial_filter(model, constraint.condition))] = constraint.name
+    for field in model._meta.concrete_fields:
+        if field.unique and not field.primary_key:
+            declared[(((field.column, ASCENDING),), True, None)] = f'{model._meta.db_table}_{field.column}_uniq'
+    return declared
+
+
+def existing_indexes(model):
+    """Indexes present on the collection of ``model`` as {(key, unique, partial filter): name}, ``_id`` excluded"""
+    existing = {}
+    for name, info in model.objects.mongo_index_information().items():
+        key = tuple(
+            (column, direction if isinstance(direction, str) else int(direction))
+            for column, direction in info['key']
+        )
+        if key == (('_id', ASCENDING),):
+            continue
+        partial = info.get('partialFilterExpression')
+        partial = tuple(sorted(partial.items())) if partial else None
+        existing[(key, bool(info.get('unique', False)), partial)] = name
+    return existing
+
+
+def winning_index(explanation):
+    """Name of the index chosen by the query planner, or COLLSCAN"""
+    stages = [explanation['queryPlanner']['winningPlan']]
+    while stages:
+        stage = stages.pop()
+        if stage.get('stage') == 'IXSCAN':
+            return stage['indexName']
+        if 'inputStage' in stage:
+            stages.append(stage['inputStage'])
+        stages.extend(stage.get('inputStages', []))
+    return 'COLLSCAN'
+
+
+class Command(BaseCommand):
+    help = (
+        'Create the MongoDB indexes declared on the models and report undeclared ones '
+        '(dropped only with --drop-extra)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the differences')
+        parser.add_argument('--drop-extra', action='store_true', help='Drop indexes not declared on any model')
+        parser.add_argument('--explain', action='store_true', help='Report which index each hot endpoint query uses')
+
+    def handle(self, *args, **options):
+        for model in apps.get_app_config('octofit_tracker').get_models():
+            self.sync_model(model, options['dry_run'], options['drop_extra'])
+        if options['explain']:
+            self.explain()
+
+    def sync_model(self, model, dry_run, drop_extra):
+        declared = declared_indexes(model)
+        existing = existing_indexes(model)
+        table = model._meta.db_table
+
+        for spec, name in declared.items():
+            if spec in existing:
+                continue
+            key, unique, partial = spec
+            options = {'partialFilterExpression': dict(partial)} if partial else {}
+            details = (' unique' if unique else '') + (f' where {dict(partial)}' if partial else '')
+            self.stdout.write(f'{table}: create {name} {list(key)}{details}')
+            if not dry_run:
+                model.objects.mongo_create_index(list(key), name=name, unique=unique, **options)
+
+        for spec, name in existing.items():
+            if spec in declared:
+                continue
+            if not drop_extra:
+                # Possibly added by hand for a reason the models do not know about
+                self.stdout.write(self.style.WARNING(f'{table}: undeclared {name} {list(spec[0])}'))
+                continue
+            self.stdout.write(f'{table}: drop {name} {list(spec[0])}')
+            if not dry_run:
+                model.objects.mongo_drop_index(name)
+
+    def explain(self):
+        self.stdout.write('\nIndex usage of hot endpoint queries:')
+        for label, model, query, sort in HOT_QUERIES:
+            cursor = model.objects.mongo_find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            index = winning_index(cursor.limit(100).explain())
+            line = f'  {label:<26} {index}'
+            self.stdout.write(self.style.WARNING(line) if index == 'COLLSCAN' else line)
@@ -0,0 +1,188 @@
+"""
+In-process request metrics in the Prometheus text exposition format.
+
+``PerformanceMiddleware`` observes every request into the histograms below,
+labelled with the view that handled it (``ActivityViewSet.by_user``), and
+``/metrics`` renders them together with the throttling, load shedding,
+write-behind and live leaderboard series and the MongoDB connection pool
+counters from ``monitoring.pool_stats``. Values are per process: when the
+app runs under several workers each one exposes its own series, which
+Prometheus sums.
+"""
+import bisect
+import threading
+
+from .monitoring import pool_stats
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+BATCH_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram:
+    """A labelled histogram with cumulative buckets, safe to observe from any thread"""
+
+    def __init__(self, name, help_text, buckets, labels=('view',)):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            if index < len(self.buckets):
+                series['counts'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def _sample(self, suffix, key, **extra):
+        pairs = [*zip(self.labels, key), *extra.items()]
+        labels = ','.join(f'{name}="{_escape(value)}"' for name, value in pairs)
+        return f'{self.name}{suffix}{{{labels}}}' if labels else f'{self.name}{suffix}'
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, dict(value, counts=list(value['counts']))) for key, value in self._series.items())
+        for key, value in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, value['counts']):
+                cumulative += count
+                lines.append(f'{self._sample("_bucket", key, le=_number(bound))} {cumulative}')
+            lines.append(f'{self._sample("_bucket", key, le="+Inf")} {value["count"]}')
+            lines.append(f'{self._sample("_sum", key)} {_number(value["sum"])}')
+            lines.append(f'{self._sample("_count", key)} {value["count"]}')
+        return '\n'.join(lines)
+
+
+class Counter:
+    """A labelled counter, safe to increment from any thread"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            labels = ','.join(f'{name}="{_escape(label)}"' for name, label in zip(self.labels, key))
+            lines.append(f'{self.name}{{{labels}}} {_number(value)}' if labels else f'{self.name} {_number(value)}')
+        return '\n'.join(lines)
+
+
+class Gauge:
+    """A single unlabelled value read from ``read`` when metrics are scraped"""
+
+    def __init__(self, name, help_text, read, kind='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.kind = kind
+
+    def clear(self):
+        pass
+
+    def exposition(self):
+        return '\n'.join([
+            f'# HELP {self.name} {self.help_text}',
+            f'# TYPE {self.name} {self.kind}',
+            f'{self.name} {_number(self.read())}',
+        ])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REQUEST_SECONDS = Histogram(
+    'octofit_request_duration_seconds', 'Total time spent handling the request.', SECONDS_BUCKETS)
+DB_SECONDS = Histogram(
+    'octofit_request_db_seconds', 'Time spent waiting on MongoDB.', SECONDS_BUCKETS)
+DB_ROUND_TRIPS = Histogram(
+    'octofit_request_db_round_trips', 'MongoDB commands issued per request.', COUNT_BUCKETS)
+SERIALIZE_SECONDS = Histogram(
+    'octofit_request_serialize_seconds', 'Time spent in the view outside MongoDB, mostly serialization.',
+    SECONDS_BUCKETS)
+RENDER_SECONDS = Histogram(
+    'octofit_request_render_seconds', 'Time spent rendering the response body.', SECONDS_BUCKETS)
+
+THROTTLED_REQUESTS = Counter(
+    'octofit_requests_throttled_total', 'Requests refused with 429 by the rate limiter.', labels=('scope',))
+SHED_REQUESTS = Counter(
+    'octofit_requests_shed_total', 'Requests refused with 503 because too many were in flight.')
+
+WRITE_BEHIND_FLUSH_SIZE = Histogram(
+    'octofit_write_behind_flush_size', 'Activities written per write-behind flush.', BATCH_BUCKETS, labels=())
+WRITE_BEHIND_FLUSH_SECONDS = Histogram(
+    'octofit_write_behind_flush_seconds', 'Time spent writing one write-behind batch.', SECONDS_BUCKETS, labels=())
+WRITE_BEHIND_REJECTED = Counter(
+    'octofit_write_behind_rejected_total', 'Activities refused with 503 because the write-behind buffer was full.')
+WRITE_BEHIND_FAILED = Counter(
+    'octofit_write_behind_failed_total', 'Buffered activities dropped because MongoDB rejected them.')
+
+LIVE_MESSAGES = Counter(
+    'octofit_live_messages_total', 'Messages sent to live leaderboard subscribers.')
+LIVE_REFUSED = Counter(
+    'octofit_live_refused_total', 'Live leaderboard subscriptions refused with 503.')
+
+POOL_METRICS = [
+    Gauge('octofit_mongo_pool_open_connections', 'MongoDB connections currently open.',
+          lambda: pool_stats.open),
+    Gauge('octofit_mongo_pool_in_use_connections', 'MongoDB connections checked out of the pool.',
+          lambda: pool_stats.in_use),
+    Gauge('octofit_mongo_pool_waiting', 'Threads waiting to check out a MongoDB connection.',
+          lambda: pool_stats.waiting),
+    Gauge('octofit_mongo_pool_created_connections_total', 'MongoDB connections created.',
+          lambda: pool_stats.created, kind='counter'),
+    Gauge('octofit_mongo_pool_checkout_failures_total', 'MongoDB connection checkouts that failed or timed out.',
+          lambda: pool_stats.checkout_failures, kind='counter'),
+    Gauge('octofit_mongo_pool_cleared_total', 'Times the pool was cleared after a network error.',
+          lambda: pool_stats.pools_cleared, kind='counter'),
+]
+
+REGISTRY = [
+    REQUEST_SECONDS, DB_SECONDS, DB_ROUND_TRIPS, SERIALIZE_SECONDS, RENDER_SECONDS,
+    THROTTLED_REQUESTS, SHED_REQUESTS,
+    WRITE_BEHIND_FLUSH_SIZE, WRITE_BEHIND_FLUSH_SECONDS, WRITE_BEHIND_REJECTED, WRITE_BEHIND_FAILED,
+    LIVE_MESSAGES, LIVE_REFUSED,
+    *POOL_METRICS,
+]
+
+
+def exposition():
+    """Every registered metric in the Prometheus text format"""
+    return '\n'.join(metric.exposition() for metric in REGISTRY) + '\n'
+
+
+def clear():
+    for metric in REGISTRY:
+        metric.clear()
@@ -0,0 +1,225 @@
+"""
+Per-request performance instrumentation and load shedding.
+
+``PerformanceMiddleware`` splits every request into the time spent in
+MongoDB, in the view outside MongoDB (for these views that is almost all
+serialization), and rendering the response body. The split is returned in a
+``Server-Timing`` header, observed into the histograms in ``metrics``, and
+requests slower than ``OCTOFIT_SLOW_REQUEST_MS`` are logged with the
+commands they issued.
+
+Streaming responses (the exports) read their cursor after the response
+leaves the middleware, so only the work done before the first byte is
+counted for them. The middleware runs natively in both WSGI and ASGI
+stacks; under ASGI the commands of the async views (which go through
+motor's own thread pool) are not counted.
+
+``LoadSheddingMiddleware`` refuses requests with 503 and ``Retry-After``
+once ``OCTOFIT_SHED_MAX_IN_FLIGHT`` are already being handled by the
+process, so a burst is turned away quickly instead of queueing behind the
+connection pool until every request is slow.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from . import metrics
+from .monitoring import track_commands
+
+logger = logging.getLogger('octofit_tracker.performance')
+
+
+def view_label(request, view_func):
+    """``ViewSet.action`` for API views, the dotted function name otherwise"""
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return f'{view_func.__module__}.{view_func.__qualname__}'
+    action = (getattr(view_func, 'actions', None) or {}).get(request.method.lower())
+    return f'{view_class.__name__}.{action}' if action else view_class.__name__
+
+
+class RequestTiming:
+    def __init__(self, log):
+        self.log = log
+        self.view = '<unresolved>'
+        self.started = time.perf_counter()
+        self.view_started = self.view_finished = self.rendered = None
+        self.db_before_view = self.db_after_view = 0.0
+
+    def view_called(self, view):
+        self.view = view
+        self.view_started = time.perf_counter()
+        self.db_before_view = self.log.duration
+
+    def view_returned(self):
+        if self.view_finished is None:
+            self.view_finished = time.perf_counter()
+            self.db_after_view = self.log.duration
+
+    def render_finished(self, response):
+        self.rendered = time.perf_counter()
+
+    def phases(self):
+        """Seconds spent in total, db, serialize and render"""
+        finished = time.perf_counter()
+        self.view_returned()
+        serialize = 0.0
+        if self.view_started is not None:
+            view_time = self.view_finished - self.view_started
+            serialize = max(view_time - (self.db_after_view - self.db_before_view), 0.0)
+        render = (self.rendered - self.view_finished) if self.rendered is not None else 0.0
+        return {
+            'total': finished - self.started,
+            'db': self.log.duration,
+            'serialize': serialize,
+            'render': render,
+        }
+
+
+def _as_coroutine(hook):
+    async def run(*args):
+        return hook(*args)
+    return run
+
+
+class PerformanceMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_seconds = settings.OCTOFIT_SLOW_REQUEST_MS / 1000
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Mark the instance as a coroutine function and give Django async
+            # hooks, so the ASGI handler never hops to a thread for us
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+            self.process_view = _as_coroutine(self.process_view)
+            self.process_template_response = _as_coroutine(self.process_template_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with track_commands() as log:
+            timing = request.performance_timing = RequestTiming(log)
+            response = self.get_response(request)
+            phases = timing.phases()
+        return self.finish(request, response, timing, phases)
+
+    async def __acall__(self, request):
+        with track_commands() as log:
+            timing = request.performance_timing = RequestTiming(log)
+            response = await self.get_response(request)
+            phases = timing.phases()
+        return self.finish(request, response, timing, phases)
+
+    def finish(self, request, response, timing, phases):
+        log = timing.log
+        response['Server-Timing'] = server_timing(phases, log.count)
+        self.observe(timing.view, phases, log.count)
+        if phases['total'] >= self.slow_seconds:
+            self.log_slow_request(request, timing.view, phases, log)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.performance_timing.view_called(view_label(request, view_func))
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the template response middleware
+        # runs; the callback fires once the body exists
+        request.performance_timing.view_returned()
+        response.add_post_render_callback(request.performance_timing.render_finished)
+        return response
+
+    def observe(self, view, phases, round_trips):
+        metrics.REQUEST_SECONDS.observe(phases['total'], view=view)
+        metrics.DB_SECONDS.observe(phases['db'], view=view)
+        metrics.DB_ROUND_TRIPS.observe(round_trips, view=view)
+        metrics.SERIALIZE_SECONDS.observe(phases['serialize'], view=view)
+        metrics.RENDER_SECONDS.observe(phases['render'], view=view)
+
+    def log_slow_request(self, request, view, phases, log):
+        commands = sorted(log.breakdown().items(), key=lambda item: item[1][1], reverse=True)
+        logger.warning(
+            'Slow request %s %s (%s): %.1fms total, %.1fms db in %d commands, %.1fms serialize, '
+            '%.1fms render; commands: %s',
+            request.method, request.get_full_path(), view, phases['total'] * 1000, phases['db'] * 1000,
+            log.count, phases['serialize'] * 1000, phases['render'] * 1000,
+            ', '.join(
+                f'{name} {collection or "-"} x{count} {seconds * 1000:.1f}ms'
+                for (name, collection), (count, seconds) in commands
+            ) or 'none',
+        )
+
+
+class LoadSheddingMiddleware:
+    sync_capable = True
+    async_capable = True
+    # Monitoring must answer while the process is overloaded
+    exempt_paths = ('/metrics',)
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.max_in_flight = settings.OCTOFIT_SHED_MAX_IN_FLIGHT
+        self.retry_after = settings.OCTOFIT_SHED_RETRY_AFTER
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.limited(request):
+            return self.get_response(request)
+        if not self.enter():
+            return self.shed()
+        try:
+            return self.get_response(request)
+        finally:
+            self.leave()
+
+    async def __acall__(self, request):
+        if not self.limited(request):
+            return await self.get_response(request)
+        if not self.enter():
+            return self.shed()
+        try:
+            return await self.get_response(request)
+        finally:
+            self.leave()
+
+    def limited(self, request):
+        return self.max_in_flight > 0 and request.path not in self.exempt_paths
+
+    def enter(self):
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def shed(self):
+        metrics.SHED_REQUESTS.inc()
+        response = JsonResponse({'error': 'Server busy, retry later'}, status=503)
+        response['Retry-After'] = str(self.retry_after)
+        return response
+
+
+def server_timing(phases, round_trips):
+    """The ``Server-Timing`` header value for the measured phases"""
+    return ', '.join([
+        f'db;dur={phases["db"] * 1000:.2f};desc="{round_trips} queries"',
+        f'serialize;dur={phases["serialize"] * 1000:.2f}',
+        f'render;dur={phases["render"] * 1000:.2f}',
+        f'total;dur={phases["total"] * 1000:.2f}',
+    ])
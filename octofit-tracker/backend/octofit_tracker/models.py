@@ -8,6 +8,8 @@ class User(models.Model):
     email = models.EmailField(unique=True)
     team = models.CharField(max_length=100, blank=True)
     
+    objects = djongo_models.DjongoManager()
+    
     class Meta:
         db_table = 'users'
     
@@ -21,6 +23,8 @@ class Team(models.Model):
     members = djongo_models.JSONField(default=list)
     total_points = models.IntegerField(default=0)
     
+    objects = djongo_models.DjongoManager()
+    
     class Meta:
         db_table = 'teams'
     
@@ -36,9 +40,15 @@ class Activity(models.Model):
     calories = models.IntegerField()
     date = models.DateTimeField()
     
+    objects = djongo_models.DjongoManager()
+    
     class Meta:
         db_table = 'activities'
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['user_email', '-date', '-_id'], name='activity_user_date_id_idx'),
+            models.Index(fields=['-date', '-_id'], name='activity_date_id_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user_email} - {self.activity_type}"
@@ -46,16 +56,23 @@ class Activity(models.Model):
 
 class Leaderboard(models.Model):
     _id = djongo_models.ObjectIdField(primary_key=True)
-    user_email = models.EmailField()
+    user_email = models.EmailField(unique=True)
     user_name = models.CharField(max_length=200)
     team = models.CharField(max_length=100)
     total_calories = models.IntegerField(default=0)
     total_activities = models.IntegerField(default=0)
     rank = models.IntegerField(default=0)
     
+    objects = djongo_models.DjongoManager()
+    
     class Meta:
         db_table = 'leaderboard'
         ordering = ['rank']
+        indexes = [
+            models.Index(fields=['rank', '_id'], name='leaderboard_rank_id_idx'),
+            models.Index(fields=['-total_calories'], name='leaderboard_calories_idx'),
+            models.Index(fields=['team', 'rank'], name='leaderboard_team_rank_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user_name} - Rank {self.rank}"
@@ -70,8 +87,85 @@ class Workout(models.Model):
     duration = models.IntegerField()  # in minutes
     calories_per_session = models.IntegerField()
     
+    objects = djongo_models.DjongoManager()
+    
     class Meta:
         db_table = 'workouts'
+        indexes = [
+            models.Index(fields=['category'], name='workout_category_idx'),
+            models.Index(fields=['difficulty'], name='workout_difficulty_idx'),
+        ]
     
     def __str__(self):
         return self.name
+
+
+class ActivityRollup(models.Model):
+    """Per-user, per-day, per-activity-type totals maintained on every activity write"""
+    _id = djongo_models.ObjectIdField(primary_key=True)
+    user_email = models.EmailField()
+    team = models.CharField(max_length=100, blank=True)
+    day = models.DateTimeField()  # midnight UTC
+    activity_type = models.CharField(max_length=100)
+    count = models.IntegerField(default=0)
+    duration = models.IntegerField(default=0)  # in minutes
+    calories = models.IntegerField(default=0)
+    
+    objects = djongo_models.DjongoManager()
+    
+    class Meta:
+        db_table = 'activity_rollups'
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(fields=['user_email', 'day', 'activity_type'], name='rollup_bucket_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['team', 'day'], name='rollup_team_day_idx'),
+            models.Index(fields=['day'], name='rollup_day_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_email} - {self.activity_type} on {self.day:%Y-%m-%d}"
+
+
+class Task(models.Model):
+    """A unit of background work queued for the task runner"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+    
+    _id = djongo_models.ObjectIdField(primary_key=True)
+    name = models.CharField(max_length=100)
+    args = djongo_models.JSONField(default=dict)
+    dedupe_key = models.CharField(max_length=200, blank=True, default='')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    result = djongo_models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField()
+    run_after = models.DateTimeField()
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = djongo_models.DjongoManager()
+    
+    # At most one queued task per dedupe key, so identical enqueues coalesce.
+    # Created by sync_indexes only: djongo drops the condition of a partial
+    # index and would make dedupe_key unique across every task ever queued.
+    mongo_constraints = [
+        models.UniqueConstraint(fields=['dedupe_key'], condition=models.Q(status=QUEUED), name='task_dedupe_uniq'),
+    ]
+    
+    class Meta:
+        db_table = 'tasks'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='task_claim_idx'),
+            models.Index(fields=['-created_at', '-_id'], name='task_created_id_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.name} ({self.status})"
@@ -0,0 +1,121 @@
+"""
+MongoDB client lifecycle.
+
+djongo keeps one ``MongoClient`` per database name for the whole process
+and Django hands it out through ``connections``. A ``MongoClient`` must not
+be used on both sides of a fork (its sockets and monitor threads belong to
+the parent), so when a server such as gunicorn forks workers from a
+process that already connected, ``reset_after_fork`` makes the child drop
+every inherited client reference and build its own on first use. The async
+views use one motor client per event loop (``motor_database``), configured
+from the same ``CLIENT`` options and dropped after fork too.
+
+``warm_up`` is called from ``wsgi.py``/``asgi.py`` once the application is
+loaded: it resolves the URLconf, opens a pooled connection, compiles the
+read serializers, loads the leaderboard rank index and warms the user
+directory, so the first request a worker serves does not pay for any of
+that. When it runs in a parent that forks afterwards, each child opens its
+own connection again in the background.
+"""
+import asyncio
+import logging
+import os
+import threading
+
+import djongo.database
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver
+
+from . import monitoring, rank_index, user_directory
+
+logger = logging.getLogger(__name__)
+
+_fork_handler_installed = False
+_motor_clients = {}
+
+
+def client():
+    """The process's ``MongoClient`` for the default database"""
+    connection = connections['default']
+    connection.ensure_connection()
+    return connection.client_connection
+
+
+def database():
+    """The default database on the process's ``MongoClient``"""
+    return client()[settings.DATABASES['default']['NAME']]
+
+
+def motor_database():
+    """
+    The default database through motor, for the async views. Motor clients
+    are bound to an event loop, so there is one per running loop. Motor is
+    imported here so the sync stack never depends on it.
+    """
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    loop = asyncio.get_running_loop()
+    motor_client = _motor_clients.get(loop)
+    if motor_client is None:
+        for stale in [other for other in _motor_clients if other.is_closed()]:
+            _motor_clients.pop(stale).close()
+        motor_client = _motor_clients[loop] = AsyncIOMotorClient(
+            **settings.DATABASES['default'].get('CLIENT', {}), io_loop=loop
+        )
+    return motor_client[settings.DATABASES['default']['NAME']]
+
+
+def reset_after_fork():
+    """Forget the clients inherited from the parent process; run in the child after fork"""
+    djongo.database.clients.clear()
+    _motor_clients.clear()
+    for connection in connections.all(initialized_only=True):
+        connection.connection = None
+        connection.client_connection = None
+        connection.djongo_connection = None
+    monitoring.pool_stats.reset()
+
+
+def install_fork_handler():
+    global _fork_handler_installed
+    if not _fork_handler_installed:
+        os.register_at_fork(after_in_child=reset_after_fork)
+        _fork_handler_installed = True
+
+
+def connect():
+    """Open a pooled connection and check the server answers"""
+    client().admin.command('ping')
+
+
+def warm_up():
+    """Prime the worker before it takes traffic; failures are logged, never raised"""
+    if not settings.OCTOFIT_WARMUP:
+        return
+    try:
+        from .views import FastReadMixin
+        from .serializers import fast_representation
+        from .urls import router
+
+        get_resolver().url_patterns
+        for _, viewset, _ in router.registry:
+            serializer_class = getattr(viewset, 'serializer_class', None)
+            if issubclass(viewset, FastReadMixin) and serializer_class is not None:
+                fast_representation(serializer_class())
+        connect()
+        rank_index.index.load()
+        user_directory.directory.warm()
+    except Exception:
+        logger.warning('Warmup failed; the worker will connect on its first request', exc_info=True)
+        return
+    os.register_at_fork(after_in_child=_connect_in_background)
+
+
+def _connect_in_background():
+    def run():
+        try:
+            connect()
+        except Exception:
+            logger.warning('Could not connect to MongoDB after fork', exc_info=True)
+    threading.Thread(target=run, name='octofit-warmup', daemon=True).start()
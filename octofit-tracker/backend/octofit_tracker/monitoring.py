@@ -0,0 +1,154 @@
+"""
+MongoDB command and connection pool monitoring.
+
+A pymongo ``CommandListener`` and ``ConnectionPoolListener`` are registered
+when the app is loaded, before djongo creates its client. Code that wants to
+know how many round trips a block of work made wraps it in
+``track_commands()``; commands issued in the same context are recorded on
+the returned ``CommandLog``. Active logs live in a context variable, so
+synchronous code Django runs in a worker thread under ASGI is tracked too.
+``pool_stats`` counts connections for the process and is exported on
+``/metrics``.
+"""
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+_logs = ContextVar('octofit_command_logs', default=())
+_local = threading.local()
+_installed = False
+
+
+class CommandLog:
+    """
+    Commands issued while a ``track_commands()`` block was active, as
+    ``(command name, collection, seconds)`` tuples
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    @property
+    def count(self):
+        return len(self.commands)
+
+    @property
+    def duration(self):
+        """Total time spent in MongoDB, in seconds"""
+        return sum(duration for _, _, duration in self.commands)
+
+    def breakdown(self):
+        """``{(command name, collection): [count, seconds]}``"""
+        totals = {}
+        for name, collection, duration in self.commands:
+            total = totals.setdefault((name, collection), [0, 0.0])
+            total[0] += 1
+            total[1] += duration
+        return totals
+
+
+class CommandTracker(monitoring.CommandListener):
+    def started(self, event):
+        # The collection is only on the command document, which the
+        # succeeded/failed events do not carry
+        if _logs.get():
+            if not hasattr(_local, 'collections'):
+                _local.collections = {}
+            target = event.command.get(event.command_name)
+            _local.collections[event.request_id] = target if isinstance(target, str) else ''
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        collection = getattr(_local, 'collections', {}).pop(event.request_id, '')
+        for log in _logs.get():
+            log.commands.append((event.command_name, collection, event.duration_micros / 1e6))
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool counters for this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.created = self.closed = 0
+            self.checkouts_started = self.checked_out = self.checked_in = self.checkout_failures = 0
+            self.pools_cleared = 0
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @property
+    def open(self):
+        return self.created - self.closed
+
+    @property
+    def in_use(self):
+        return self.checked_out - self.checked_in
+
+    @property
+    def waiting(self):
+        return self.checkouts_started - self.checked_out - self.checkout_failures
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count('pools_cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count('closed')
+
+    def connection_check_out_started(self, event):
+        self._count('checkouts_started')
+
+    def connection_check_out_failed(self, event):
+        self._count('checkout_failures')
+
+    def connection_checked_out(self, event):
+        self._count('checked_out')
+
+    def connection_checked_in(self, event):
+        self._count('checked_in')
+
+
+pool_stats = PoolStats()
+
+
+def install():
+    """Register the listeners once per process"""
+    global _installed
+    if not _installed:
+        monitoring.register(CommandTracker())
+        monitoring.register(pool_stats)
+        _installed = True
+
+
+@contextmanager
+def track_commands():
+    """Record the commands issued in this context; blocks may be nested"""
+    log = CommandLog()
+    token = _logs.set(_logs.get() + (log,))
+    try:
+        yield log
+    finally:
+        _logs.reset(token)
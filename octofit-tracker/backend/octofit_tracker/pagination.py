@@ -0,0 +1,101 @@
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, _reverse_ordering
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination on a unique field (``_id``). Each page seeks past the
+    previous page's last value with a range filter, so every page costs the
+    same no matter how deep the client has paged. DRF only offsets within
+    ties of the ordering field, and a unique field has none; orderings on
+    fields that tie use ``CompoundKeysetPagination``.
+    """
+    ordering = '_id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class CompoundKeysetPagination(KeysetPagination):
+    """
+    Keyset pagination over several fields, the last of which is unique. The
+    cursor holds the last row's value of every field and the next page seeks
+    past that tuple, so ties on the leading fields keep a stable order and
+    never need an offset.
+    """
+    
+    def _get_position_from_instance(self, instance, ordering):
+        names = [order.lstrip('-') for order in ordering]
+        values = [instance[name] if isinstance(instance, dict) else getattr(instance, name) for name in names]
+        return json.dumps([str(value) for value in values])
+    
+    def _seek(self, ordering, position):
+        """The filter for rows after ``position`` in ``ordering``"""
+        try:
+            values = json.loads(position)
+        except ValueError:
+            values = None
+        if not isinstance(values, list) or len(values) != len(ordering):
+            return None
+        condition = Q()
+        for index, order in enumerate(ordering):
+            equal = {name.lstrip('-'): value for name, value in zip(ordering[:index], values)}
+            lookup = '__lt' if order.startswith('-') else '__gt'
+            condition |= Q(**equal, **{order.lstrip('-') + lookup: values[index]})
+        return condition
+    
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        position = self.cursor.position if self.cursor is not None else None
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            condition = self._seek(ordering, position)
+            if condition is None:
+                raise NotFound(self.invalid_cursor_message)
+            queryset = queryset.filter(condition)
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        more = len(results) > self.page_size
+        if reverse:
+            self.page.reverse()
+        self.has_next = position is not None if reverse else more
+        self.has_previous = more if reverse else position is not None
+        self.display_page_controls = self.has_previous or self.has_next
+        return self.page
+    
+    def _link(self, row, reverse):
+        position = self._get_position_from_instance(row, self.ordering) if row is not None else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=reverse, position=position))
+    
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self._link(self.page[-1] if self.page else None, reverse=False)
+    
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self._link(self.page[0] if self.page else None, reverse=True)
+
+
+class ActivityPagination(CompoundKeysetPagination):
+    # Activities logged at the same time tie on date
+    ordering = ('-date', '-_id')
+
+
+class LeaderboardPagination(CompoundKeysetPagination):
+    # Ranks tie and shift as scores change; _id keeps the order total
+    ordering = ('rank', '_id')
+
+
+class TaskPagination(CompoundKeysetPagination):
+    ordering = ('-created_at', '-_id')
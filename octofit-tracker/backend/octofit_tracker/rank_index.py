@@ -0,0 +1,299 @@
+"""
+In-memory order-statistic index over the leaderboard.
+
+Entries are kept in an indexable skip list ordered by ``(-total_calories,
+user_email)``, so the position of a score, the entry at a position and the
+entries next to it are all O(log n) without touching MongoDB. Ranks use the
+same competition ranking as ``leaderboard``: one plus the number of entries
+with strictly more calories, which is the position of the first key with
+that score.
+
+The index is loaded from the ``leaderboard`` collection on first use and
+kept current by ``leaderboard.apply_delta`` and the leaderboard views. Writes
+made by other processes are picked up by reloading every
+``OCTOFIT_RANK_INDEX_REFRESH`` seconds. The reload runs in a background
+thread while reads keep using the current snapshot; updates made meanwhile
+are recorded and replayed onto the new snapshot before it is swapped in.
+"""
+import logging
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Leaderboard
+
+logger = logging.getLogger(__name__)
+
+MAX_LEVEL = 32
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+
+def _random_level():
+    return min(MAX_LEVEL, 1 - int(math.log(1.0 - random.random(), 2)))
+
+
+class IndexableSkiplist:
+    """
+    A sorted sequence of unique keys with O(log n) insert, remove, lookup by
+    position and ``bisect_left``. ``width[level]`` is the number of positions
+    a link skips; links off the end count up to one past the last key.
+    """
+
+    def __init__(self, keys=()):
+        """Build from keys that are already sorted, in linear time"""
+        self.head = _Node(None, MAX_LEVEL)
+        self.size = 0
+        last = [self.head] * MAX_LEVEL
+        last_position = [0] * MAX_LEVEL
+        for position, key in enumerate(keys, start=1):
+            node = _Node(key, _random_level())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = position - last_position[level]
+                last[level] = node
+                last_position[level] = position
+            self.size = position
+        for level in range(MAX_LEVEL):
+            last[level].width[level] = self.size + 1 - last_position[level]
+
+    def __len__(self):
+        return self.size
+
+    def _path(self, key):
+        """The last node before ``key`` on every level and the position of each"""
+        chain = [None] * MAX_LEVEL
+        positions = [0] * MAX_LEVEL
+        node, position = self.head, 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            positions[level] = position
+        return chain, positions
+
+    def bisect_left(self, key):
+        """Number of keys smaller than ``key``"""
+        _, positions = self._path(key)
+        return positions[0]
+
+    def insert(self, key):
+        chain, positions = self._path(key)
+        node = _Node(key, _random_level())
+        position = positions[0] + 1
+        for level in range(len(node.next)):
+            previous = chain[level]
+            skipped = position - positions[level]
+            node.next[level] = previous.next[level]
+            node.width[level] = previous.width[level] - skipped + 1
+            previous.next[level] = node
+            previous.width[level] = skipped
+        for level in range(len(node.next), MAX_LEVEL):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain, _ = self._path(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for level in range(len(node.next)):
+            previous = chain[level]
+            previous.width[level] += node.width[level] - 1
+            previous.next[level] = node.next[level]
+        for level in range(len(node.next), MAX_LEVEL):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def slice(self, start, stop):
+        """Keys at positions ``start`` (0-based, inclusive) to ``stop`` (exclusive)"""
+        start, stop = max(start, 0), min(stop, self.size)
+        if start >= stop:
+            return []
+        node, remaining = self.head, start + 1
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        keys = []
+        for _ in range(stop - start):
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise IndexError(position)
+        return self.slice(position, position + 1)[0]
+
+
+def leaderboard_scores():
+    """All-time calories by email from the leaderboard collection"""
+    cursor = Leaderboard.objects.mongo_find({}, {'_id': 0, 'user_email': 1, 'total_calories': 1})
+    return {entry['user_email']: entry.get('total_calories', 0) for entry in cursor}
+
+
+class RankIndex:
+    """
+    Scores by email plus the skip list ordering them. ``loader`` returns the
+    ``{email: calories}`` the index is (re)built from.
+    """
+
+    def __init__(self, loader=leaderboard_scores):
+        self._loader = loader
+        self._lock = threading.RLock()
+        self._ordered = None
+        self._scores = {}
+        self._loaded_at = 0.0
+        # Bumped by every load and invalidation, so a refresh that started
+        # before one of them is discarded
+        self._generation = 0
+        # (email, calories or None for removed) since a refresh read the loader
+        self._journal = None
+        self._refresher = None
+
+    @staticmethod
+    def _build(scores):
+        return IndexableSkiplist(sorted((-calories, email) for email, calories in scores.items()))
+
+    def _ensure_loaded(self):
+        # Called with the lock held
+        if self._ordered is None:
+            self.load()
+        elif time.monotonic() - self._loaded_at > settings.OCTOFIT_RANK_INDEX_REFRESH:
+            self.refresh()
+
+    def load(self):
+        """(Re)build the index from its loader; updates wait until it is done"""
+        with self._lock:
+            scores = self._loader()
+            self._scores, self._ordered = scores, self._build(scores)
+            self._loaded_at = time.monotonic()
+            self._generation += 1
+
+    def refresh(self):
+        """Reload in a background thread unless one is already running"""
+        with self._lock:
+            if self._refresher is not None and self._refresher.is_alive():
+                return
+            self._refresher = threading.Thread(target=self._refresh, name='octofit-rank-index', daemon=True)
+            self._refresher.start()
+
+    def _refresh(self):
+        with self._lock:
+            generation, journal = self._generation, []
+            self._journal = journal
+        try:
+            scores = self._loader()
+            ordered = self._build(scores)
+        except Exception:
+            logger.exception('Rank index refresh failed')
+            with self._lock:
+                # Keep the current snapshot and try again after the next period
+                self._journal = None
+                self._loaded_at = time.monotonic()
+            return
+        with self._lock:
+            self._journal = None
+            if generation != self._generation:
+                return
+            for email, calories in journal:
+                old = scores.pop(email, None)
+                if old is not None:
+                    ordered.remove((-old, email))
+                if calories is not None:
+                    ordered.insert((-calories, email))
+                    scores[email] = calories
+            self._scores, self._ordered = scores, ordered
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._ordered = None
+            self._generation += 1
+
+    def update(self, user_email, calories):
+        """Record a user's new total; a no-op until the index has been loaded"""
+        with self._lock:
+            if self._ordered is None:
+                return
+            if self._journal is not None:
+                self._journal.append((user_email, calories))
+            old = self._scores.get(user_email)
+            if old is not None:
+                self._ordered.remove((-old, user_email))
+            self._ordered.insert((-calories, user_email))
+            self._scores[user_email] = calories
+
+    def add(self, user_email, calories):
+        """Add ``calories`` (possibly negative) to a user's score; a no-op until loaded"""
+        with self._lock:
+            if self._ordered is not None:
+                self.update(user_email, self._scores.get(user_email, 0) + calories)
+
+    def remove(self, user_email):
+        with self._lock:
+            if self._ordered is None:
+                return
+            if self._journal is not None:
+                self._journal.append((user_email, None))
+            old = self._scores.pop(user_email, None)
+            if old is not None:
+                self._ordered.remove((-old, user_email))
+
+    def _rank(self, calories):
+        return self._ordered.bisect_left((-calories, '')) + 1
+
+    def _entries(self, start, stop):
+        entries, rank, previous = [], None, None
+        for position, (score, email) in enumerate(self._ordered.slice(start, stop), start=start):
+            if score != previous:
+                rank = position + 1 if rank is not None else self._rank(-score)
+                previous = score
+            entries.append({'user_email': email, 'total_calories': -score, 'rank': rank})
+        return entries
+
+    def size(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._ordered)
+
+    def rank_of(self, user_email):
+        """``{'user_email', 'total_calories', 'rank'}`` for a user, or None when not ranked"""
+        with self._lock:
+            self._ensure_loaded()
+            calories = self._scores.get(user_email)
+            if calories is None:
+                return None
+            return {'user_email': user_email, 'total_calories': calories, 'rank': self._rank(calories)}
+
+    def top(self, count):
+        """The first ``count`` entries in rank order"""
+        with self._lock:
+            self._ensure_loaded()
+            return self._entries(0, count)
+
+    def around(self, user_email, count):
+        """A user's entry with up to ``count`` entries on either side, or None when not ranked"""
+        with self._lock:
+            self._ensure_loaded()
+            calories = self._scores.get(user_email)
+            if calories is None:
+                return None
+            position = self._ordered.bisect_left((-calories, user_email))
+            # Near the top there are fewer than ``count`` entries above
+            return self._entries(max(position - count, 0), position + count + 1)
+
+
+index = RankIndex()
@@ -0,0 +1,69 @@
+"""
+Result cache for read-mostly endpoints.
+
+Responses are stored in the ``results`` alias of ``CACHES``, so the backend,
+size bound and TTL are configured in settings like any other Django cache.
+Every cached endpoint belongs to a namespace (``workouts.by_category``) and a
+partition within it (the category). The partition's generation number is
+part of each key, so invalidating a partition is a single increment and the
+orphaned entries simply age out of the LRU. The generations are per
+process; the epoch from ``versions``, which every process shares, is part
+of each key too, so repopulating the database (``versions.bump_all``)
+retires the cached responses of every running server.
+"""
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.core.cache import caches
+from rest_framework.response import Response
+
+from . import versions
+
+RESULTS_ALIAS = 'results'
+
+
+def _results():
+    return caches[RESULTS_ALIAS]
+
+
+def _generation_key(namespace, partition):
+    return f'gen:{namespace}:{partition}'
+
+
+def _generation(namespace, partition):
+    # Seeded from the clock so an evicted generation never restarts at a
+    # value that older entries were stored under
+    return _results().get_or_set(_generation_key(namespace, partition), time.time_ns(), timeout=None)
+
+
+def cached_response(request, namespace, partition, compute):
+    """
+    Return the cached data for this endpoint and query string, or call
+    ``compute()`` (which should return serialized data) and cache it.
+    """
+    params = urlencode(sorted(request.query_params.lists()), doseq=True)
+    digest = hashlib.md5(params.encode()).hexdigest()
+    (epoch,), _ = versions.current([])
+    key = f'{namespace}:{partition}:{epoch}:{_generation(namespace, partition)}:{digest}'
+    data = _results().get(key)
+    if data is None:
+        data = compute()
+        # Serializer output keeps a reference to its serializer; store plain data
+        data = list(data) if isinstance(data, list) else dict(data)
+        _results().set(key, data)
+    return Response(data)
+
+
+def invalidate(namespace, partition=''):
+    """Drop every cached response in one partition of ``namespace``"""
+    try:
+        _results().incr(_generation_key(namespace, partition))
+    except ValueError:
+        # No generation yet, so nothing has been cached for this partition
+        pass
+
+
+def clear():
+    """Drop every cached response, e.g. after the database is repopulated"""
+    _results().clear()
@@ -0,0 +1,111 @@
+"""
+Daily activity rollups.
+
+Each ``ActivityRollup`` document is one (user, day, activity type) bucket
+holding count, duration and calories. Buckets are updated with ``$inc``
+upserts as activities are written, so range statistics read at most
+``days x activity types`` documents per user no matter how many activities
+are behind them.
+"""
+from datetime import datetime, timedelta, timezone
+
+from pymongo import UpdateOne
+
+from .models import Activity, ActivityRollup
+from . import versions
+
+GROUPINGS = {
+    'type': '$activity_type',
+    'day': '$day',
+}
+
+
+def bucket_day(date):
+    """Midnight UTC of ``date`` as the naive datetime djongo stores"""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def apply(rows, teams, sign=1):
+    """
+    Add (``sign=1``) or subtract (``sign=-1``) activity rows to their
+    buckets with a single bulk write. ``teams`` maps user emails to the team
+    recorded on newly created buckets.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    operations = [
+        UpdateOne(
+            {'user_email': row['user_email'], 'day': bucket_day(row['date']), 'activity_type': row['activity_type']},
+            {
+                '$inc': {'count': sign, 'duration': sign * row['duration'], 'calories': sign * row['calories']},
+                '$setOnInsert': {'team': teams.get(row['user_email'], '')},
+            },
+            upsert=True,
+        )
+        for row in rows
+    ]
+    ActivityRollup.objects.mongo_bulk_write(operations, ordered=False)
+
+
+def summarize(match, days, group_by='type'):
+    """
+    Totals over the last ``days`` days for the buckets matching ``match``,
+    grouped by activity type or by day.
+    """
+    since = bucket_day(datetime.utcnow()) - timedelta(days=days - 1)
+    pipeline = [
+        {'$match': dict(match, day={'$gte': since})},
+        {'$group': {
+            '_id': GROUPINGS[group_by],
+            'count': {'$sum': '$count'},
+            'duration': {'$sum': '$duration'},
+            'calories': {'$sum': '$calories'},
+        }},
+        {'$sort': {'_id': 1}},
+    ]
+    buckets = []
+    for bucket in ActivityRollup.objects.mongo_aggregate(pipeline):
+        key = bucket.pop('_id')
+        if group_by == 'day':
+            key = key.date().isoformat()
+        buckets.append({'activity_type' if group_by == 'type' else 'day': key, **bucket})
+    return {
+        'since': since.date().isoformat(),
+        'days': days,
+        'count': sum(bucket['count'] for bucket in buckets),
+        'duration': sum(bucket['duration'] for bucket in buckets),
+        'calories': sum(bucket['calories'] for bucket in buckets),
+        'buckets': buckets,
+    }
+
+
+def rebuild():
+    """Recompute every bucket from the activities collection inside MongoDB"""
+    Activity.objects.mongo_aggregate([
+        {'$group': {
+            '_id': {
+                'user_email': '$user_email',
+                'day': {'$dateTrunc': {'date': '$date', 'unit': 'day'}},
+                'activity_type': '$activity_type',
+            },
+            'count': {'$sum': 1},
+            'duration': {'$sum': '$duration'},
+            'calories': {'$sum': '$calories'},
+        }},
+        {'$lookup': {'from': 'users', 'localField': '_id.user_email', 'foreignField': 'email', 'as': 'user'}},
+        {'$project': {
+            '_id': 0,
+            'user_email': '$_id.user_email',
+            'team': {'$ifNull': [{'$first': '$user.team'}, '']},
+            'day': '$_id.day',
+            'activity_type': '$_id.activity_type',
+            'count': 1,
+            'duration': 1,
+            'calories': 1,
+        }},
+        {'$out': ActivityRollup._meta.db_table},
+    ])
+    versions.bump(ActivityRollup._meta.db_table)
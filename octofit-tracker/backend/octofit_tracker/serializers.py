@@ -1,15 +1,95 @@
+from django.utils.encoding import is_protected_type
 from rest_framework import serializers
-from .models import User, Team, Activity, Leaderboard, Workout
+from rest_framework.permissions import SAFE_METHODS
+from .models import User, Team, Activity, Leaderboard, Workout, Task
 
 
-class UserSerializer(serializers.ModelSerializer):
+def requested_fields(request, available):
+    """
+    The subset of ``available`` selected by ``?fields=a,b`` and/or
+    ``?exclude=c`` on a read request, in declaration order.
+    """
+    if request is None or request.method not in SAFE_METHODS:
+        return list(available)
+    fields = request.query_params.get('fields', None)
+    exclude = request.query_params.get('exclude', None)
+    selected = set(fields.split(',')) if fields else set(available)
+    if exclude:
+        selected -= set(exclude.split(','))
+    return [name for name in available if name in selected]
+
+
+def _model_field_representation(value):
+    # ModelField returns protected types (numbers, dates) as-is and stringifies
+    # the rest, which is how ObjectId primary keys become strings
+    return value if is_protected_type(value) else str(value)
+
+
+def _list_representation(field):
+    child = _value_converter(field.child)
+    
+    def represent(value):
+        return [None if item is None else child(item) for item in value]
+    return represent
+
+
+# Per-type shortcuts that produce exactly what the field's to_representation() would
+FAST_CONVERTERS = (
+    (serializers.BooleanField, lambda field: bool),
+    (serializers.IntegerField, lambda field: int),
+    (serializers.CharField, lambda field: str),
+    (serializers.ListField, _list_representation),
+    (serializers.ModelField, lambda field: _model_field_representation),
+)
+
+
+def _value_converter(field):
+    for field_class, factory in FAST_CONVERTERS:
+        if isinstance(field, field_class):
+            return factory(field)
+    return field.to_representation
+
+
+def fast_representation(serializer):
+    """
+    Compile ``serializer``'s readable fields into a function that turns a raw
+    ``QuerySet.values()`` row into the same primitives ``serializer.data``
+    would produce for the model instance, without building the instance.
+    Returns ``(sources, represent)``; ``sources`` are the columns to select.
+    """
+    converters = [
+        (name, field.source, _value_converter(field))
+        for name, field in serializer.fields.items()
+        if not field.write_only
+    ]
+    
+    def represent(row):
+        data = {}
+        for name, source, convert in converters:
+            value = row[source]
+            data[name] = None if value is None else convert(value)
+        return data
+    return [source for _, source, _ in converters], represent
+
+
+class SparseFieldsetMixin:
+    """Drop the fields not selected by the request's ``fields``/``exclude`` parameters"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        selected = set(requested_fields(self.context.get('request'), self.Meta.fields))
+        for name in set(self.fields) - selected:
+            self.fields.pop(name)
+
+
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['_id', 'name', 'email', 'team']
         read_only_fields = ['_id']
 
 
-class TeamSerializer(serializers.ModelSerializer):
+class TeamSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     members = serializers.ListField(child=serializers.CharField(), required=False)
     
     class Meta:
@@ -18,22 +98,38 @@ class TeamSerializer(serializers.ModelSerializer):
         read_only_fields = ['_id']
 
 
-class ActivitySerializer(serializers.ModelSerializer):
+class ActivitySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Activity
         fields = ['_id', 'user_email', 'activity_type', 'duration', 'calories', 'date']
         read_only_fields = ['_id']
 
 
-class LeaderboardSerializer(serializers.ModelSerializer):
+class LeaderboardSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Leaderboard
         fields = ['_id', 'user_email', 'user_name', 'team', 'total_calories', 'total_activities', 'rank']
         read_only_fields = ['_id']
 
 
-class WorkoutSerializer(serializers.ModelSerializer):
+class WorkoutSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Workout
         fields = ['_id', 'name', 'category', 'description', 'difficulty', 'duration', 'calories_per_session']
         read_only_fields = ['_id']
+
+
+class TaskSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    args = serializers.JSONField(required=False)
+    result = serializers.JSONField(read_only=True)
+    
+    class Meta:
+        model = Task
+        fields = [
+            '_id', 'name', 'args', 'status', 'attempts', 'max_attempts', 'result', 'error',
+            'created_at', 'run_after', 'started_at', 'finished_at',
+        ]
+        read_only_fields = [
+            '_id', 'status', 'attempts', 'max_attempts', 'error', 'created_at', 'run_after', 'started_at',
+            'finished_at',
+        ]
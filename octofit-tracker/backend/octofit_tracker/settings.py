@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 from pathlib import Path
+import importlib.util
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -62,8 +63,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its total covers the rest of the stack
+    'octofit_tracker.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    # After CORS, so browsers can read the 503
+    'octofit_tracker.middleware.LoadSheddingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -101,14 +106,65 @@ DATABASES = {
         'ENGINE': 'djongo',
         'NAME': 'octofit_db',
         'ENFORCE_SCHEMA': False,
+        # Passed to pymongo's MongoClient (djongo always adds connect=False,
+        # so nothing connects until the first query). Pool limits apply per
+        # worker process.
         'CLIENT': {
-            'host': 'localhost',
-            'port': 27017,
+            'host': os.getenv('OCTOFIT_MONGO_HOST', 'localhost'),
+            'port': int(os.getenv('OCTOFIT_MONGO_PORT', 27017)),
+            'maxPoolSize': int(os.getenv('OCTOFIT_MONGO_MAX_POOL_SIZE', 100)),
+            'minPoolSize': int(os.getenv('OCTOFIT_MONGO_MIN_POOL_SIZE', 0)),
+            'maxIdleTimeMS': int(os.getenv('OCTOFIT_MONGO_MAX_IDLE_MS', 300000)),
+            'waitQueueTimeoutMS': int(os.getenv('OCTOFIT_MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+            'connectTimeoutMS': int(os.getenv('OCTOFIT_MONGO_CONNECT_TIMEOUT_MS', 5000)),
+            'serverSelectionTimeoutMS': int(os.getenv('OCTOFIT_MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+            'socketTimeoutMS': int(os.getenv('OCTOFIT_MONGO_SOCKET_TIMEOUT_MS', 30000)),
         }
     }
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# 'results' backs the leaderboard/workout result cache (octofit_tracker.result_cache).
+# LocMemCache evicts least recently used entries past MAX_ENTRIES and expires
+# them after TIMEOUT seconds; point it at a shared backend when running
+# several workers so invalidations reach all of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'octofit-results',
+        'TIMEOUT': int(os.getenv('OCTOFIT_RESULT_CACHE_TTL', 300)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('OCTOFIT_RESULT_CACHE_SIZE', 1000)),
+        },
+    },
+    # Responses to activity submissions, replayed for retries (see idempotency.py)
+    'idempotency': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'octofit-idempotency',
+        'TIMEOUT': int(os.getenv('OCTOFIT_IDEMPOTENCY_TTL', 86400)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('OCTOFIT_IDEMPOTENCY_SIZE', 10000)),
+        },
+    },
+    # Collection and object versions behind ETags, held for a few seconds in
+    # front of the shared versions collection (see versions.py)
+    'versions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'octofit-versions',
+        'TIMEOUT': float(os.getenv('OCTOFIT_VERSIONS_TTL', 1)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('OCTOFIT_VERSIONS_SIZE', 100000)),
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -166,6 +222,9 @@ CORS_ALLOW_HEADERS = [
     'authorization',
     'content-type',
     'dnt',
+    'idempotency-key',
+    'if-modified-since',
+    'if-none-match',
     'origin',
     'user-agent',
     'x-csrftoken',
@@ -173,9 +232,84 @@ CORS_ALLOW_HEADERS = [
 ]
 
 # REST Framework configuration
+# MessagePack responses (Accept: application/msgpack or ?format=msgpack) are
+# offered when the optional msgpack package is installed.
+RENDERER_CLASSES = ['octofit_tracker.renderers.FastJSONRenderer']
+if importlib.util.find_spec('msgpack'):
+    RENDERER_CLASSES.append('octofit_tracker.renderers.MessagePackRenderer')
+RENDERER_CLASSES.append('rest_framework.renderers.BrowsableAPIRenderer')
+
 REST_FRAMEWORK = {
-    'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
-    ]
+    'DEFAULT_RENDERER_CLASSES': RENDERER_CLASSES,
+    'DEFAULT_PAGINATION_CLASS': 'octofit_tracker.pagination.KeysetPagination',
+    'PAGE_SIZE': 100,
+    # Token buckets per client: list/export calls draw on 'expensive', the
+    # rest on 'standard' (see throttling.py)
+    'DEFAULT_THROTTLE_CLASSES': ['octofit_tracker.throttling.TokenBucketThrottle'],
+    'DEFAULT_THROTTLE_RATES': {
+        'standard': os.getenv('OCTOFIT_THROTTLE_STANDARD', '1200/min'),
+        'expensive': os.getenv('OCTOFIT_THROTTLE_EXPENSIVE', '60/min'),
+    },
 }
+
+# Write-behind for POST /api/activities/ (see write_behind.py): activities
+# are acknowledged with 202 and inserted in batches of up to _BATCH, at least
+# every _INTERVAL seconds; at most _MAX wait in memory before clients get 503
+OCTOFIT_WRITE_BEHIND = os.getenv('OCTOFIT_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes')
+OCTOFIT_WRITE_BEHIND_BATCH = int(os.getenv('OCTOFIT_WRITE_BEHIND_BATCH', 500))
+OCTOFIT_WRITE_BEHIND_INTERVAL = float(os.getenv('OCTOFIT_WRITE_BEHIND_INTERVAL', 0.5))
+OCTOFIT_WRITE_BEHIND_MAX = int(os.getenv('OCTOFIT_WRITE_BEHIND_MAX', 10000))
+
+# Most clients whose throttle buckets are kept in memory
+OCTOFIT_THROTTLE_MAX_CLIENTS = int(os.getenv('OCTOFIT_THROTTLE_MAX_CLIENTS', 10000))
+
+# Requests handled at once per process before new ones are refused with 503
+# (0 disables shedding), and the Retry-After sent with the refusal
+OCTOFIT_SHED_MAX_IN_FLIGHT = int(os.getenv('OCTOFIT_SHED_MAX_IN_FLIGHT', 256))
+OCTOFIT_SHED_RETRY_AFTER = int(os.getenv('OCTOFIT_SHED_RETRY_AFTER', 1))
+
+# Live leaderboard stream (see live.py): changes kept for reconnecting
+# clients, the shortest interval between messages to one subscriber, the
+# keepalive period, how often the shared changes are read (seconds) and the
+# most subscribers per process
+OCTOFIT_LIVE_BUFFER = int(os.getenv('OCTOFIT_LIVE_BUFFER', 10000))
+OCTOFIT_LIVE_MIN_INTERVAL = float(os.getenv('OCTOFIT_LIVE_MIN_INTERVAL', 1.0))
+OCTOFIT_LIVE_HEARTBEAT = float(os.getenv('OCTOFIT_LIVE_HEARTBEAT', 15))
+OCTOFIT_LIVE_POLL = float(os.getenv('OCTOFIT_LIVE_POLL', 0.5))
+OCTOFIT_LIVE_MAX_SUBSCRIBERS = int(os.getenv('OCTOFIT_LIVE_MAX_SUBSCRIBERS', 10000))
+
+# Bulk activity ingestion (/api/activities/bulk/)
+OCTOFIT_BULK_BATCH_SIZE = int(os.getenv('OCTOFIT_BULK_BATCH_SIZE', 500))
+OCTOFIT_BULK_MAX_ERRORS = 100
+
+# Requests slower than this are logged with their MongoDB command breakdown
+OCTOFIT_SLOW_REQUEST_MS = int(os.getenv('OCTOFIT_SLOW_REQUEST_MS', 500))
+
+# Seconds before the in-memory leaderboard rank index is reloaded (in a
+# background thread), to pick up writes made by other processes
+OCTOFIT_RANK_INDEX_REFRESH = int(os.getenv('OCTOFIT_RANK_INDEX_REFRESH', 60))
+
+# Most period/team leaderboards kept in memory at once
+OCTOFIT_BOARDS_MAX = int(os.getenv('OCTOFIT_BOARDS_MAX', 64))
+
+# Seconds an activity submitted without an Idempotency-Key is replayed to
+# identical submissions, which are taken for retries (see idempotency.py)
+OCTOFIT_IDEMPOTENCY_CONTENT_TTL = int(os.getenv('OCTOFIT_IDEMPOTENCY_CONTENT_TTL', 600))
+
+# Users kept in the in-memory directory by email, and seconds before an
+# entry is fetched again to pick up writes made by other processes
+OCTOFIT_USER_DIRECTORY_SIZE = int(os.getenv('OCTOFIT_USER_DIRECTORY_SIZE', 50000))
+OCTOFIT_USER_DIRECTORY_TTL = int(os.getenv('OCTOFIT_USER_DIRECTORY_TTL', 300))
+
+# Background tasks: worker threads started in the web process on first use
+# (0 leaves the queue to `manage.py run_tasks`), retry policy, and where
+# export tasks write their files
+OCTOFIT_TASK_WORKERS = int(os.getenv('OCTOFIT_TASK_WORKERS', 2))
+OCTOFIT_TASK_POLL_SECONDS = float(os.getenv('OCTOFIT_TASK_POLL_SECONDS', 1))
+OCTOFIT_TASK_MAX_ATTEMPTS = 3
+OCTOFIT_TASK_RETRY_SECONDS = 5
+OCTOFIT_TASK_STALE_SECONDS = int(os.getenv('OCTOFIT_TASK_STALE_SECONDS', 600))
+OCTOFIT_EXPORT_DIR = os.getenv('OCTOFIT_EXPORT_DIR', str(BASE_DIR / 'exports'))
+
+# Prime each worker (connections, URLconf, rank index) when wsgi.py/asgi.py load
+OCTOFIT_WARMUP = os.getenv('OCTOFIT_WARMUP', 'true').lower() in ('1', 'true', 'yes')
@@ -0,0 +1,276 @@
+"""
+Background tasks.
+
+Work that is too slow for a request is queued as a ``Task`` document and run
+by a pool of worker threads, either inside the web process (started on the
+first enqueue when ``OCTOFIT_TASK_WORKERS`` is above zero) or in a separate
+``manage.py run_tasks`` process. The ``tasks`` collection is the queue, so
+nothing is lost when a process restarts and any number of processes can
+share it: workers claim a task with one atomic ``find_one_and_update``.
+
+Enqueueing a task that is already queued with the same name and arguments
+returns the queued one instead, so a burst of identical requests (say, many
+rank refreshes) runs once. The unique partial index on ``dedupe_key`` for
+queued tasks guarantees it under concurrency: an upsert that loses the race
+fails with a duplicate key and is retried, which finds the winner. Failed tasks are retried with exponential
+backoff up to ``max_attempts``, and tasks left ``running`` by a worker that
+died are requeued after ``OCTOFIT_TASK_STALE_SECONDS``.
+"""
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from .models import Activity, Leaderboard, Task
+from .serializers import ActivitySerializer, LeaderboardSerializer
+from . import exports, leaderboard, rollups, versions
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def register(name):
+    """Register a task function under ``name``; its keyword arguments are the task's args"""
+    def decorator(func):
+        TASKS[name] = func
+        return func
+    return decorator
+
+
+def check_args(name, args):
+    """Raise ``ValueError`` unless ``name`` is a task that accepts ``args``"""
+    if name not in TASKS:
+        raise ValueError(f'Unknown task {name}')
+    try:
+        inspect.signature(TASKS[name]).bind(**args)
+    except TypeError as error:
+        raise ValueError(str(error))
+
+
+def dedupe_key(name, args):
+    return f'{name}:{json.dumps(args, sort_keys=True)}'
+
+
+def enqueue(name, args=None, max_attempts=None):
+    """
+    Queue a task, or find the identical one already queued. Returns
+    ``(task id, created)``.
+    """
+    args = args or {}
+    check_args(name, args)
+    now = datetime.utcnow()
+    task_id = ObjectId()
+    key = dedupe_key(name, args)
+    update = {'$setOnInsert': {
+        '_id': task_id,
+        'name': name,
+        'args': args,
+        'attempts': 0,
+        'max_attempts': max_attempts or settings.OCTOFIT_TASK_MAX_ATTEMPTS,
+        'result': None,
+        'error': '',
+        'created_at': now,
+        'run_after': now,
+        'started_at': None,
+        'finished_at': None,
+    }}
+    for attempt in range(2):
+        try:
+            task = Task.objects.mongo_find_one_and_update(
+                {'dedupe_key': key, 'status': Task.QUEUED}, update,
+                projection={'_id': 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            break
+        except DuplicateKeyError:
+            # A concurrent enqueue inserted the same task; the retry finds it
+            if attempt:
+                raise
+    versions.bump(Task._meta.db_table)
+    if settings.OCTOFIT_TASK_WORKERS:
+        runner.start(settings.OCTOFIT_TASK_WORKERS)
+    runner.wake()
+    return task['_id'], task['_id'] == task_id
+
+
+def claim():
+    """Atomically take the next due task and mark it running, or return None"""
+    now = datetime.utcnow()
+    task = Task.objects.mongo_find_one_and_update(
+        {'status': Task.QUEUED, 'run_after': {'$lte': now}},
+        {'$set': {'status': Task.RUNNING, 'started_at': now}, '$inc': {'attempts': 1}},
+        sort=[('run_after', 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+    if task is not None:
+        versions.bump(Task._meta.db_table)
+    return task
+
+
+def execute(task):
+    """Run a claimed task and record its result, scheduling a retry if it failed"""
+    try:
+        result = TASKS[task['name']](**task['args'])
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning('Task %s (%s) failed on attempt %d', task['name'], task['_id'], task['attempts'])
+        update = {'error': error, 'finished_at': datetime.utcnow()}
+        if task['attempts'] < task['max_attempts']:
+            delay = settings.OCTOFIT_TASK_RETRY_SECONDS * 2 ** (task['attempts'] - 1)
+            update.update(status=Task.QUEUED, run_after=datetime.utcnow() + timedelta(seconds=delay))
+        else:
+            update['status'] = Task.FAILED
+        _set_status({'_id': task['_id']}, update)
+        versions.bump(Task._meta.db_table)
+        return False
+    Task.objects.mongo_update_one({'_id': task['_id']}, {'$set': {
+        'status': Task.DONE, 'result': result, 'error': '', 'finished_at': datetime.utcnow(),
+    }})
+    versions.bump(Task._meta.db_table)
+    return True
+
+
+def _set_status(query, update):
+    """
+    Apply ``update`` to the task matching ``query``; returns whether one
+    matched. A task that goes back to the queue while an identical one was
+    queued in the meantime fails instead: the queued one will do the work.
+    """
+    try:
+        return Task.objects.mongo_update_one(query, {'$set': update}).matched_count
+    except DuplicateKeyError:
+        error = '\n'.join(filter(None, [update.get('error'), 'Superseded by an identical queued task']))
+        update = dict(update, status=Task.FAILED, error=error)
+        return Task.objects.mongo_update_one(query, {'$set': update}).matched_count
+
+
+def requeue_stale():
+    """Put tasks whose worker stopped responding back in the queue"""
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=settings.OCTOFIT_TASK_STALE_SECONDS)
+    query = {'status': Task.RUNNING, 'started_at': {'$lt': cutoff}}
+    requeued = 0
+    # One at a time, so a duplicate of one queued task does not stop the rest
+    for task in Task.objects.mongo_find(query, {'_id': 1}):
+        requeued += _set_status(dict(query, _id=task['_id']), {'status': Task.QUEUED, 'run_after': now})
+    if requeued:
+        versions.bump(Task._meta.db_table)
+    return requeued
+
+
+def run_pending(limit=None):
+    """Run due tasks in this thread until none are left (or ``limit`` ran); returns how many ran"""
+    ran = 0
+    while limit is None or ran < limit:
+        task = claim()
+        if task is None:
+            break
+        execute(task)
+        ran += 1
+    return ran
+
+
+class TaskRunner:
+    """A pool of daemon threads polling the task queue"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._threads = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pid = None
+
+    def start(self, workers):
+        """Start ``workers`` threads unless this process already runs them"""
+        with self._lock:
+            # Threads do not survive fork, so a child process starts its own
+            if self._pid == os.getpid() and any(thread.is_alive() for thread in self._threads):
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            requeue_stale()
+            self._threads = [
+                threading.Thread(target=self._work, name=f'octofit-task-{number}', daemon=True)
+                for number in range(workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        last_sweep = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                if run_pending(limit=1):
+                    continue
+                if time.monotonic() - last_sweep > settings.OCTOFIT_TASK_STALE_SECONDS:
+                    requeue_stale()
+                    last_sweep = time.monotonic()
+            except Exception:
+                logger.exception('Task worker error')
+            self._wake.wait(settings.OCTOFIT_TASK_POLL_SECONDS)
+            self._wake.clear()
+
+
+runner = TaskRunner()
+
+
+@register('leaderboard.rebuild_ranks')
+def rebuild_ranks():
+    leaderboard.rebuild_ranks()
+
+
+@register('leaderboard.rebuild')
+def rebuild_leaderboard():
+    return {'entries_reset': leaderboard.rebuild_leaderboard()}
+
+
+@register('teams.recompute_points')
+def recompute_team_points():
+    leaderboard.recompute_team_points()
+
+
+@register('rollups.rebuild')
+def rebuild_rollups():
+    rollups.rebuild()
+
+
+def _export(model, query, fields, sort, output, filename):
+    if output not in exports.FORMATS:
+        raise ValueError(f'Unknown export format {output}')
+    os.makedirs(settings.OCTOFIT_EXPORT_DIR, exist_ok=True)
+    name = f'{filename}-{uuid.uuid4().hex}.{output}'
+    rows = exports.write_export(model, query, fields, sort, output, os.path.join(settings.OCTOFIT_EXPORT_DIR, name))
+    return {'file': name, 'rows': rows}
+
+
+@register('exports.activities')
+def export_activities(output='csv', email=None, since=None, until=None):
+    query = exports.activity_query(email, since, until)
+    return _export(Activity, query, ActivitySerializer.Meta.fields, [('date', -1), ('_id', -1)], output, 'activities')
+
+
+@register('exports.leaderboard')
+def export_leaderboard(output='csv', team=None):
+    query = {'team': team} if team else {}
+    return _export(Leaderboard, query, LeaderboardSerializer.Meta.fields, [('rank', 1)], output, 'leaderboard')
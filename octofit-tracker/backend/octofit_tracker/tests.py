@@ -1,8 +1,77 @@
-from django.test import TestCase
-from rest_framework.test import APITestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db.models import Q
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, APITestCase
 from rest_framework import status
-from .models import User, Team, Activity, Leaderboard, Workout
-from datetime import datetime
+from .models import User, Team, Activity, Leaderboard, Workout, Task
+from .management.commands.sync_indexes import declared_indexes
+from .serializers import ActivitySerializer, TeamSerializer, WorkoutSerializer, fast_representation, requested_fields
+from .pagination import ActivityPagination, LeaderboardPagination
+from .renderers import FastJSONRenderer
+from rest_framework.pagination import Cursor
+from rest_framework.renderers import JSONRenderer
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+from .management.commands.populate_db import generate_activities
+from . import (
+    async_views, benchmark, boards, exports, idempotency, leaderboard, live, metrics, mongo_client, monitoring,
+    rank_index, result_cache, rollups, tasks, throttling, user_directory, versions, write_behind,
+)
+from unittest import mock
+from datetime import datetime, timedelta
+import asyncio
+import io
+import json
+import threading
+
+
+class ProcessStateMixin:
+    """Resets the per-process stores that outlive each test's database"""
+    def setUp(self):
+        super().setUp()
+        idempotency.clear()
+        user_directory.directory.clear()
+        throttling.buckets.clear()
+        result_cache.clear()
+        rank_index.index.invalidate()
+        boards.boards.invalidate()
+
+
+class ProcessStateAPITestCase(ProcessStateMixin, APITestCase):
+    pass
+
+
+class LocalVersions:
+    """The versions store in a dict, for tests that run without MongoDB"""
+    def __init__(self):
+        self.versions = {}
+    
+    def get_many(self, keys):
+        return {key: self.versions[key] for key in keys if key in self.versions}
+    
+    def seed(self, keys, now):
+        for key in keys:
+            self.versions.setdefault(key, (now, now))
+        return self.get_many(keys)
+    
+    def advance(self, keys, now):
+        for key in keys:
+            version, modified = self.versions.get(key, (now, now))
+            self.versions[key] = (version + 1, max(modified, now))
+    
+    def install(self, test):
+        """Use this store for the rest of ``test``"""
+        caches[versions.VERSIONS_ALIAS].clear()
+        patcher = mock.patch.object(versions, 'store', self)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+        return self
 
 
 class UserModelTest(TestCase):
@@ -59,7 +128,7 @@ class WorkoutModelTest(TestCase):
         self.assertEqual(workout.difficulty, "Beginner")
 
 
-class UserAPITest(APITestCase):
+class UserAPITest(ProcessStateAPITestCase):
     def test_user_list(self):
         response = self.client.get('/api/users/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -70,7 +139,7 @@ class UserAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
 
-class TeamAPITest(APITestCase):
+class TeamAPITest(ProcessStateAPITestCase):
     def test_team_list(self):
         response = self.client.get('/api/teams/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -81,19 +150,1066 @@ class TeamAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
 
-class ActivityAPITest(APITestCase):
+class ActivityAPITest(ProcessStateAPITestCase):
     def test_activity_list(self):
         response = self.client.get('/api/activities/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
-class LeaderboardAPITest(APITestCase):
+class LeaderboardAPITest(ProcessStateAPITestCase):
     def test_leaderboard_list(self):
         response = self.client.get('/api/leaderboard/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
-class WorkoutAPITest(APITestCase):
+class WorkoutAPITest(ProcessStateAPITestCase):
     def test_workout_list(self):
         response = self.client.get('/api/workouts/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class LeaderboardMaintenanceTest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.create(name="Runner", email="runner@example.com", team="Team A")
+        User.objects.create(name="Walker", email="walker@example.com", team="Team B")
+    
+    def post_activity(self, email, calories):
+        data = {
+            "user_email": email,
+            "activity_type": "Running",
+            "duration": 30,
+            "calories": calories,
+            "date": "2024-01-01T10:00:00Z",
+        }
+        return self.client.post('/api/activities/', data, format='json')
+    
+    def test_create_updates_totals_and_ranks(self):
+        self.post_activity("walker@example.com", 100)
+        self.post_activity("runner@example.com", 300)
+        runner = Leaderboard.objects.get(user_email="runner@example.com")
+        walker = Leaderboard.objects.get(user_email="walker@example.com")
+        self.assertEqual(runner.total_calories, 300)
+        self.assertEqual(runner.total_activities, 1)
+        self.assertEqual(runner.rank, 1)
+        self.assertEqual(walker.rank, 2)
+    
+    def test_delete_reverts_delta(self):
+        self.post_activity("walker@example.com", 100)
+        response = self.post_activity("runner@example.com", 300)
+        self.client.delete(f"/api/activities/{response.data['_id']}/")
+        runner = Leaderboard.objects.get(user_email="runner@example.com")
+        walker = Leaderboard.objects.get(user_email="walker@example.com")
+        self.assertEqual(runner.total_calories, 0)
+        self.assertEqual(runner.total_activities, 0)
+        self.assertEqual(walker.rank, 1)
+        self.assertEqual(runner.rank, 2)
+    
+    def test_rerank_numbered_earlier_never_overwrites_a_later_one(self):
+        self.post_activity("walker@example.com", 100)
+        self.post_activity("runner@example.com", 300)
+        Leaderboard.objects.mongo_update_one({'user_email': "walker@example.com"}, {'$set': {'total_calories': 500}})
+        # A re-rank that read the scores before the walker's last write
+        with mock.patch.object(leaderboard, '_next_stamp', return_value=1):
+            leaderboard.rerank()
+        self.assertEqual(Leaderboard.objects.get(user_email="walker@example.com").rank, 2)
+        leaderboard.rerank(100, 500)
+        self.assertEqual(Leaderboard.objects.get(user_email="walker@example.com").rank, 1)
+        self.assertEqual(Leaderboard.objects.get(user_email="runner@example.com").rank, 2)
+
+
+class BulkIngestAPITest(ProcessStateAPITestCase):
+    def activity(self, calories):
+        return {
+            "user_email": "bulk@example.com",
+            "activity_type": "Cycling",
+            "duration": 45,
+            "calories": calories,
+            "date": "2024-01-02T08:00:00Z",
+        }
+    
+    def test_json_array_reports_row_errors(self):
+        rows = [self.activity(200), {"user_email": "bulk@example.com"}, self.activity(300)]
+        response = self.client.post('/api/activities/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['failed'], 1)
+        self.assertEqual(response.data['errors'][0]['row'], 1)
+        self.assertEqual(Activity.objects.filter(user_email="bulk@example.com").count(), 2)
+        self.assertEqual(Leaderboard.objects.get(user_email="bulk@example.com").total_calories, 500)
+    
+    def test_ndjson_stream(self):
+        body = "\n".join(json.dumps(self.activity(100)) for _ in range(3))
+        response = self.client.post('/api/activities/bulk/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 3)
+
+
+class ActivityPaginationTest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        for day in range(1, 6):
+            Activity.objects.create(
+                user_email="pager@example.com",
+                activity_type="Yoga",
+                duration=20,
+                calories=80,
+                date=datetime(2024, 1, day, 7, 0)
+            )
+    
+    def test_cursor_pages_follow_date_order(self):
+        response = self.client.get('/api/activities/by_user/', {'email': 'pager@example.com', 'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        first_page = [row['date'] for row in response.data['results']]
+        self.assertEqual(len(first_page), 2)
+        self.assertIsNotNone(response.data['next'])
+        second = self.client.get(response.data['next'])
+        second_page = [row['date'] for row in second.data['results']]
+        self.assertEqual(len(second_page), 2)
+        self.assertGreater(first_page[-1], second_page[0])
+    
+    def test_activities_at_the_same_time_page_without_offsets(self):
+        for _ in range(3):
+            Activity.objects.create(user_email="pager@example.com", activity_type="Yoga", duration=20, calories=80,
+                                    date=datetime(2024, 1, 3, 7, 0))
+        seen, url = [], '/api/activities/by_user/?email=pager@example.com&page_size=2'
+        while url:
+            response = self.client.get(url)
+            seen += [row['_id'] for row in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(len(seen), 8)
+        self.assertEqual(len(set(seen)), 8)
+    
+    def test_leaderboard_pages_through_tied_ranks(self):
+        for number in range(5):
+            Leaderboard.objects.create(user_email=f"tie{number}@example.com", user_name="Tie", team="Team A",
+                                       total_calories=100, rank=1)
+        seen, url = [], '/api/leaderboard/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            seen += [row['user_email'] for row in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(sorted(seen), [f"tie{number}@example.com" for number in range(5)])
+        previous = self.client.get(response.data['previous'])
+        self.assertEqual([row['user_email'] for row in previous.data['results']], seen[2:4])
+
+
+class CompoundKeysetTest(SimpleTestCase):
+    def test_seek_past_the_cursor_tuple(self):
+        paginator = LeaderboardPagination()
+        condition = paginator._seek(('rank', '_id'), json.dumps(['2', 'abc']))
+        self.assertEqual(condition, Q(rank__gt='2') | Q(rank='2', _id__gt='abc'))
+        condition = paginator._seek(('-rank', '-_id'), json.dumps(['2', 'abc']))
+        self.assertEqual(condition, Q(rank__lt='2') | Q(rank='2', _id__lt='abc'))
+        self.assertIsNone(paginator._seek(('rank', '_id'), '2'))
+        position = paginator._get_position_from_instance({'rank': 2, '_id': 'abc', 'team': 'A'}, ('rank', '_id'))
+        self.assertEqual(json.loads(position), ['2', 'abc'])
+
+
+class DeclaredIndexTest(SimpleTestCase):
+    def test_compound_index_keeps_direction(self):
+        declared = declared_indexes(Activity)
+        self.assertIn(((('user_email', 1), ('date', -1), ('_id', -1)), False, None), declared)
+    
+    def test_unique_fields_are_declared(self):
+        declared = declared_indexes(Leaderboard)
+        self.assertEqual(declared[((('user_email', 1),), True, None)], 'leaderboard_user_email_uniq')
+    
+    def test_partial_unique_constraint(self):
+        declared = declared_indexes(Task)
+        self.assertEqual(declared[((('dedupe_key', 1),), True, (('status', 'queued'),))], 'task_dedupe_uniq')
+    
+    def test_extra_indexes_are_only_dropped_on_request(self):
+        from .management.commands import sync_indexes
+        model = mock.Mock()
+        model._meta.db_table = 'things'
+        extra = {((('legacy', 1),), False, None): 'legacy_idx'}
+        with mock.patch.object(sync_indexes, 'declared_indexes', return_value={}), \
+                mock.patch.object(sync_indexes, 'existing_indexes', return_value=extra):
+            command = sync_indexes.Command(stdout=io.StringIO())
+            command.sync_model(model, dry_run=False, drop_extra=False)
+            model.objects.mongo_drop_index.assert_not_called()
+            self.assertIn('undeclared legacy_idx', command.stdout.getvalue())
+            command.sync_model(model, dry_run=False, drop_extra=True)
+            model.objects.mongo_drop_index.assert_called_once_with('legacy_idx')
+
+
+class ResultCacheTest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        Workout.objects.create(
+            name="Hill Sprints",
+            category="Cardio",
+            description="Short uphill sprints",
+            difficulty="Hard",
+            duration=25,
+            calories_per_session=300
+        )
+    
+    def test_hit_skips_query_until_write_invalidates(self):
+        first = self.client.get('/api/workouts/by_category/', {'category': 'Cardio'})
+        self.assertEqual(len(first.data), 1)
+        # Written behind the viewset's back, so the cached result is still served
+        Workout.objects.create(
+            name="Rowing Intervals",
+            category="Cardio",
+            description="Rowing machine intervals",
+            difficulty="Medium",
+            duration=30,
+            calories_per_session=280
+        )
+        cached = self.client.get('/api/workouts/by_category/', {'category': 'Cardio'})
+        self.assertEqual(len(cached.data), 1)
+        data = {
+            "name": "Jump Rope",
+            "category": "Cardio",
+            "description": "Skipping rounds",
+            "difficulty": "Easy",
+            "duration": 15,
+            "calories_per_session": 180,
+        }
+        self.client.post('/api/workouts/', data, format='json')
+        fresh = self.client.get('/api/workouts/by_category/', {'category': 'Cardio'})
+        self.assertEqual(len(fresh.data), 3)
+    
+    def test_new_epoch_retires_every_cached_result(self):
+        self.client.get('/api/workouts/by_category/', {'category': 'Cardio'})
+        Workout.objects.mongo_delete_many({})
+        # What populate_db does, from whichever process runs it
+        versions.bump_all()
+        fresh = self.client.get('/api/workouts/by_category/', {'category': 'Cardio'})
+        self.assertEqual(len(fresh.data), 0)
+
+
+class SyntheticDataTest(SimpleTestCase):
+    def test_generator_is_deterministic(self):
+        end = datetime(2024, 6, 1)
+        emails = ['a@example.com', 'b@example.com']
+        first = list(generate_activities(emails, '42:0', 3, 30, end))
+        second = list(generate_activities(emails, '42:0', 3, 30, end))
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), 6)
+        self.assertTrue(all(end - row['date'] <= timedelta(days=31) for row in first))
+
+
+class BenchmarkHarnessTest(SimpleTestCase):
+    def test_percentile_nearest_rank(self):
+        samples = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(samples, 50), 50)
+        self.assertEqual(benchmark.percentile(samples, 99), 99)
+        self.assertEqual(benchmark.percentile([], 95), 0.0)
+    
+    def test_routes_include_custom_actions(self):
+        actions = {route['action'] for route in benchmark.discover_routes()}
+        for action in ('by_email', 'by_user', 'top', 'by_category', 'by_difficulty', 'add_member'):
+            self.assertIn(action, actions)
+    
+    def test_compare_flags_regressions(self):
+        baseline = {'GET x': {'p95_ms': 10.0, 'throughput': 100.0, 'db_round_trips': 1.0}}
+        current = {'GET x': {'p95_ms': 15.0, 'throughput': 100.0, 'db_round_trips': 1.0}}
+        regressions = list(benchmark.compare(current, baseline, 0.2))
+        self.assertEqual([metric for _, metric, _, _ in regressions], ['p95_ms'])
+        # Round trips are not counted for every run
+        current['GET x'].update(p95_ms=10.0, db_round_trips=None)
+        self.assertEqual(list(benchmark.compare(current, baseline, 0.2)), [])
+        self.assertEqual(list(benchmark.compare(baseline, current, 0.2)), [])
+
+
+class ActivityRollupTest(SimpleTestCase):
+    def test_bucket_day_is_naive_utc_midnight(self):
+        aware = datetime(2024, 3, 10, 1, 30, tzinfo=timezone.get_fixed_timezone(180))
+        self.assertEqual(rollups.bucket_day(aware), datetime(2024, 3, 9))
+        self.assertEqual(rollups.bucket_day(datetime(2024, 3, 10, 23, 59)), datetime(2024, 3, 10))
+
+
+class StatsAPITest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.create(name="Swimmer", email="swimmer@example.com", team="Team A")
+        for activity_type, calories in (("Swimming", 400), ("Swimming", 200), ("Yoga", 80)):
+            data = {
+                "user_email": "swimmer@example.com",
+                "activity_type": activity_type,
+                "duration": 30,
+                "calories": calories,
+                "date": timezone.now().isoformat(),
+            }
+            self.client.post('/api/activities/', data, format='json')
+    
+    def test_user_stats_by_type(self):
+        response = self.client.get('/api/stats/by_user/', {'email': 'swimmer@example.com', 'days': 7})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(response.data['calories'], 680)
+        swimming = next(b for b in response.data['buckets'] if b['activity_type'] == 'Swimming')
+        self.assertEqual(swimming['count'], 2)
+    
+    def test_team_stats_by_day(self):
+        response = self.client.get('/api/stats/by_team/', {'team': 'Team A', 'group_by': 'day'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['buckets']), 1)
+        self.assertEqual(response.data['duration'], 90)
+
+
+class TeamMembershipAPITest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.team = Team.objects.create(name="Team Atomic", members=["first@example.com"], total_points=10)
+    
+    def test_add_and_remove_member(self):
+        url = f"/api/teams/{self.team._id}/"
+        self.client.post(url + "add_member/", {"email": "second@example.com"}, format='json')
+        self.client.post(url + "add_member/", {"email": "second@example.com"}, format='json')
+        self.assertEqual(Team.objects.get(name="Team Atomic").members, ["first@example.com", "second@example.com"])
+        self.client.post(url + "remove_member/", {"email": "first@example.com"}, format='json')
+        self.assertEqual(Team.objects.get(name="Team Atomic").members, ["second@example.com"])
+    
+    def test_add_points_increments(self):
+        response = self.client.post(f"/api/teams/{self.team._id}/add_points/", {"points": 15}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Team.objects.get(name="Team Atomic").total_points, 25)
+    
+    def test_unknown_team(self):
+        response = self.client.post("/api/teams/not-an-id/add_member/", {"email": "x@example.com"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ExportFormatTest(SimpleTestCase):
+    def test_values_match_serializer_output(self):
+        self.assertEqual(exports.export_value(datetime(2024, 1, 1, 10, 0)), '2024-01-01T10:00:00Z')
+        self.assertEqual(exports.parse_bound('2024-01-02'), datetime(2024, 1, 2))
+        self.assertIsNone(exports.parse_bound('yesterday'))
+    
+    def test_csv_header_comes_first(self):
+        chunks = exports._chunked(exports.csv_lines(iter([{'a': 1, 'b': 'x'}]), ['a', 'b']))
+        self.assertEqual(next(chunks), 'a,b\r\n')
+        self.assertEqual(next(chunks), '1,x\r\n')
+
+
+class ExportAPITest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        for day in (1, 2, 3):
+            Activity.objects.create(
+                user_email="export@example.com",
+                activity_type="Boxing",
+                duration=40,
+                calories=440,
+                date=datetime(2024, 2, day, 18, 0)
+            )
+    
+    def test_ndjson_export_with_date_range(self):
+        response = self.client.get('/api/activities/export/', {
+            'format': 'ndjson', 'email': 'export@example.com', 'since': '2024-02-02',
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([row['date'] for row in rows], ['2024-02-03T18:00:00Z', '2024-02-02T18:00:00Z'])
+    
+    def test_csv_export(self):
+        response = self.client.get('/api/activities/export/', {'format': 'csv'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], '_id,user_email,activity_type,duration,calories,date')
+        self.assertEqual(len(lines), 4)
+
+
+class SparseFieldsetTest(SimpleTestCase):
+    available = WorkoutSerializer.Meta.fields
+    
+    def request(self, method, params):
+        return Request(getattr(APIRequestFactory(), method)('/api/workouts/', params))
+    
+    def test_fields_and_exclude(self):
+        self.assertEqual(requested_fields(self.request('get', {'fields': 'name,_id'}), self.available), ['_id', 'name'])
+        selected = requested_fields(self.request('get', {'exclude': 'description'}), self.available)
+        self.assertNotIn('description', selected)
+        self.assertIn('category', selected)
+    
+    def test_writes_keep_every_field(self):
+        self.assertEqual(requested_fields(self.request('post', {'fields': 'name'}), self.available), list(self.available))
+
+
+class SparseFieldsetAPITest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        Workout.objects.create(
+            name="Plank Ladder",
+            category="Core",
+            description="A long description nobody reads on the list screen",
+            difficulty="Medium",
+            duration=15,
+            calories_per_session=90
+        )
+    
+    def test_list_returns_only_selected_fields(self):
+        response = self.client.get('/api/workouts/', {'fields': '_id,name'})
+        self.assertEqual(set(response.data['results'][0]), {'_id', 'name'})
+    
+    def test_exclude_on_custom_action(self):
+        response = self.client.get('/api/workouts/by_category/', {'category': 'Core', 'exclude': 'description'})
+        self.assertNotIn('description', response.data[0])
+        self.assertEqual(response.data[0]['name'], "Plank Ladder")
+
+
+class FastRepresentationTest(SimpleTestCase):
+    def assert_same_output(self, serializer_class, instance):
+        columns = [field.attname for field in instance._meta.concrete_fields]
+        row = {column: getattr(instance, column) for column in columns}
+        _, represent = fast_representation(serializer_class())
+        expected = serializer_class(instance).data
+        self.assertEqual(represent(row), expected)
+        self.assertEqual(FastJSONRenderer().render([represent(row)]), JSONRenderer().render([expected]))
+    
+    def test_activity(self):
+        activity = Activity(_id=ObjectId(), user_email='tony@stark.com', activity_type='Running',
+                            duration=30, calories=300, date=timezone.now())
+        self.assert_same_output(ActivitySerializer, activity)
+    
+    def test_team(self):
+        team = Team(_id=ObjectId(), name='Avengers', members=['a@b.com', 'c@d.com'], total_points=42)
+        self.assert_same_output(TeamSerializer, team)
+    
+    def test_line_separators_are_escaped(self):
+        data = {'name': 'Line\u2028Paragraph\u2029Ünïcode'}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+    
+    def test_object_permissions_use_get_object(self):
+        from rest_framework.permissions import AllowAny, DjangoObjectPermissions
+        from .views import UserViewSet
+        view = UserViewSet()
+        self.assertFalse(view.checks_objects())
+        view.permission_classes = [AllowAny, DjangoObjectPermissions]
+        self.assertTrue(view.checks_objects())
+
+
+class PerformanceMiddlewareTest(SimpleTestCase):
+    def setUp(self):
+        metrics.clear()
+        LocalVersions().install(self)
+    
+    def test_histogram_exposition(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', (0.1, 1.0))
+        histogram.observe(0.05, view='A.list')
+        histogram.observe(0.5, view='A.list')
+        text = histogram.exposition()
+        self.assertIn('test_seconds_bucket{view="A.list",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{view="A.list",le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{view="A.list",le="+Inf"} 2', text)
+        self.assertIn('test_seconds_count{view="A.list"} 2', text)
+    
+    @override_settings(OCTOFIT_SLOW_REQUEST_MS=0)
+    def test_server_timing_metrics_and_slow_log(self):
+        with self.assertLogs('octofit_tracker.performance', 'WARNING') as logs:
+            response = self.client.get('/api/stats/by_user/', {'email': 'tony@stark.com', 'days': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="0 queries", serialize;dur=')
+        self.assertIn('StatsViewSet.by_user', logs.output[0])
+        exposition = self.client.get('/metrics').content.decode()
+        self.assertIn('octofit_request_duration_seconds_count{view="StatsViewSet.by_user"} 1', exposition)
+
+
+class RankIndexTest(SimpleTestCase):
+    def test_skiplist_matches_sorted_list(self):
+        keys = list(range(0, 100, 2))
+        ordered = rank_index.IndexableSkiplist(keys)
+        for key in (51, 7, -1, 101):
+            ordered.insert(key)
+            keys = sorted(keys + [key])
+        for key in (7, 0, 98):
+            ordered.remove(key)
+            keys.remove(key)
+        self.assertEqual(len(ordered), len(keys))
+        self.assertEqual(ordered.slice(0, len(keys)), keys)
+        self.assertEqual(ordered.slice(10, 15), keys[10:15])
+        self.assertEqual(ordered.bisect_left(51), keys.index(51))
+        self.assertEqual(ordered[3], keys[3])
+        with self.assertRaises(KeyError):
+            ordered.remove(7)
+    
+    def test_refresh_keeps_updates_made_while_it_reads(self):
+        reading, release = threading.Event(), threading.Event()
+        snapshots = [{'a@example.com': 100, 'b@example.com': 50}, {'a@example.com': 100, 'c@example.com': 70}]
+        
+        def loader():
+            if len(snapshots) == 1:
+                reading.set()
+                release.wait(5)
+            return dict(snapshots.pop(0))
+        index = rank_index.RankIndex(loader=loader)
+        index.load()
+        with override_settings(OCTOFIT_RANK_INDEX_REFRESH=0):
+            self.assertEqual(index.rank_of('b@example.com')['rank'], 2)
+        self.assertTrue(reading.wait(5))
+        # The old snapshot keeps serving reads while the refresh runs
+        index.update('b@example.com', 200)
+        index.remove('a@example.com')
+        self.assertEqual(index.rank_of('b@example.com')['rank'], 1)
+        release.set()
+        index._refresher.join(5)
+        self.assertEqual(index.top(3), [
+            {'user_email': 'b@example.com', 'total_calories': 200, 'rank': 1},
+            {'user_email': 'c@example.com', 'total_calories': 70, 'rank': 2},
+        ])
+    
+    def test_around_the_first_and_last_entries(self):
+        index = rank_index.RankIndex(loader=lambda: {'a@example.com': 300, 'b@example.com': 200,
+                                                     'c@example.com': 200, 'd@example.com': 100})
+        index.load()
+        self.assertEqual([(row['user_email'], row['rank']) for row in index.around('a@example.com', 2)],
+                         [('a@example.com', 1), ('b@example.com', 2), ('c@example.com', 2)])
+        self.assertEqual([(row['user_email'], row['rank']) for row in index.around('d@example.com', 2)],
+                         [('b@example.com', 2), ('c@example.com', 2), ('d@example.com', 4)])
+
+
+class RankIndexAPITest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        for position, calories in enumerate([500, 300, 300, 100]):
+            Leaderboard.objects.create(user_email=f"user{position}@example.com", user_name=f"User {position}",
+                                       team="Team A", total_calories=calories, rank=0)
+    
+    def test_rank_of_uses_competition_ranking(self):
+        response = self.client.get('/api/leaderboard/rank_of/', {'email': 'user2@example.com'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['rank'], 2)
+        self.assertEqual(response.data['total_entries'], 4)
+        response = self.client.get('/api/leaderboard/rank_of/', {'email': 'nobody@example.com'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_around_and_top(self):
+        response = self.client.get('/api/leaderboard/around/', {'email': 'user3@example.com', 'k': 1})
+        self.assertEqual([row['user_email'] for row in response.data], ['user2@example.com', 'user3@example.com'])
+        self.assertEqual([row['rank'] for row in response.data], [2, 4])
+        response = self.client.get('/api/leaderboard/top/', {'limit': 2})
+        self.assertEqual([row['user_email'] for row in response.data], ['user0@example.com', 'user1@example.com'])
+    
+    def test_index_follows_activity_writes(self):
+        self.client.get('/api/leaderboard/rank_of/', {'email': 'user3@example.com'})
+        self.client.post('/api/activities/', {
+            "user_email": "user3@example.com", "activity_type": "Running", "duration": 30,
+            "calories": 450, "date": "2024-01-01T10:00:00Z",
+        }, format='json')
+        response = self.client.get('/api/leaderboard/rank_of/', {'email': 'user3@example.com'})
+        self.assertEqual(response.data['rank'], 1)
+        self.assertEqual(response.data['total_calories'], 550)
+
+
+class PeriodWindowTest(SimpleTestCase):
+    def test_windows(self):
+        now = datetime(2024, 12, 18, 15, 30)
+        self.assertEqual(boards.period_window('day', now), (datetime(2024, 12, 18), datetime(2024, 12, 19)))
+        self.assertEqual(boards.period_window('week', now), (datetime(2024, 12, 16), datetime(2024, 12, 23)))
+        self.assertEqual(boards.period_window('month', now), (datetime(2024, 12, 1), datetime(2025, 1, 1)))
+        self.assertEqual(boards.period_window('all', now), (None, None))
+
+
+class PeriodBoardAPITest(ProcessStateAPITestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.create(name="Runner", email="runner@example.com", team="Team A")
+        User.objects.create(name="Walker", email="walker@example.com", team="Team B")
+    
+    def post_activity(self, email, calories, date):
+        return self.client.post('/api/activities/', {
+            "user_email": email, "activity_type": "Running", "duration": 30,
+            "calories": calories, "date": date.isoformat(),
+        }, format='json')
+    
+    def test_period_and_team_boards(self):
+        now = timezone.now()
+        self.post_activity("runner@example.com", 300, now - timedelta(days=40))
+        self.post_activity("walker@example.com", 100, now)
+        response = self.client.get('/api/leaderboard/board/', {'period': 'day'})
+        self.assertEqual([entry['user_email'] for entry in response.data['entries']], ['walker@example.com'])
+        response = self.client.get('/api/leaderboard/board/', {'period': 'all'})
+        self.assertEqual(response.data['entries'][0]['user_email'], 'runner@example.com')
+        # Loaded boards follow later writes
+        self.post_activity("runner@example.com", 50, now)
+        response = self.client.get('/api/leaderboard/board/', {'period': 'day', 'email': 'runner@example.com'})
+        self.assertEqual(response.data['user'], {'user_email': 'runner@example.com', 'total_calories': 50, 'rank': 2})
+        response = self.client.get('/api/leaderboard/board/', {'period': 'all', 'team': 'Team B'})
+        self.assertEqual([entry['user_email'] for entry in response.data['entries']], ['walker@example.com'])
+    
+    def test_invalid_period(self):
+        response = self.client.get('/api/leaderboard/board/', {'period': 'year'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TaskArgsTest(SimpleTestCase):
+    def test_check_args(self):
+        tasks.check_args('exports.activities', {'output': 'ndjson', 'email': 'tony@stark.com'})
+        with self.assertRaises(ValueError):
+            tasks.check_args('exports.activities', {'format': 'csv'})
+        with self.assertRaises(ValueError):
+            tasks.check_args('no.such.task', {})
+    
+    def test_dedupe_key_ignores_argument_order(self):
+        self.assertEqual(tasks.dedupe_key('t', {'a': 1, 'b': 2}), tasks.dedupe_key('t', {'b': 2, 'a': 1}))
+
+
+@override_settings(OCTOFIT_TASK_WORKERS=0, OCTOFIT_TASK_RETRY_SECONDS=0)
+class TaskAPITest(ProcessStateAPITestCase):
+    def test_duplicate_tasks_coalesce_while_queued(self):
+        first = self.client.post('/api/tasks/', {'name': 'leaderboard.rebuild_ranks'}, format='json')
+        second = self.client.post('/api/tasks/', {'name': 'leaderboard.rebuild_ranks'}, format='json')
+        self.assertEqual(first.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.data['_id'], second.data['_id'])
+        self.assertEqual(tasks.run_pending(), 1)
+        response = self.client.get(f"/api/tasks/{first.data['_id']}/")
+        self.assertEqual(response.data['status'], Task.DONE)
+    
+    def test_unknown_task_is_rejected(self):
+        response = self.client.post('/api/tasks/', {'name': 'no.such.task'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_failures_are_retried_then_marked_failed(self):
+        failing = mock.Mock(side_effect=RuntimeError('boom'))
+        with mock.patch.dict(tasks.TASKS, {'test.fail': failing}):
+            task_id, _ = tasks.enqueue('test.fail', max_attempts=2)
+            self.assertEqual(tasks.run_pending(), 2)
+        task = Task.objects.get(_id=task_id)
+        self.assertEqual(task.status, Task.FAILED)
+        self.assertEqual(task.attempts, 2)
+        self.assertIn('boom', task.error)
+
+
+class MongoClientLifecycleTest(SimpleTestCase):
+    def test_pool_stats(self):
+        stats = monitoring.PoolStats()
+        for event in ('connection_created', 'connection_created', 'connection_check_out_started',
+                      'connection_check_out_started', 'connection_checked_out', 'connection_closed'):
+            getattr(stats, event)(None)
+        self.assertEqual((stats.open, stats.in_use, stats.waiting), (1, 1, 1))
+    
+    def test_reset_after_fork_drops_inherited_clients(self):
+        with mock.patch.dict('djongo.database.clients', {'octofit_db': object()}):
+            mongo_client.reset_after_fork()
+            import djongo.database
+            self.assertEqual(djongo.database.clients, {})
+
+
+class AsyncViewTest(SimpleTestCase):
+    def test_cursors_are_shared_with_the_drf_view(self):
+        document = {'date': datetime(2024, 5, 1, 7, 30), '_id': ObjectId()}
+        paginator = ActivityPagination()
+        position = paginator._get_position_from_instance(document, paginator.ordering)
+        cursor = Cursor(offset=0, reverse=False, position=position)
+        self.assertEqual(async_views._position(cursor), (document['date'], document['_id']))
+        self.assertIsNone(async_views._position(cursor._replace(position='not-a-position')))
+    
+    async def test_parameters_are_validated(self):
+        response = await self.async_client.get('/api/async/users/by_email/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), {'error': 'Email parameter required'})
+        response = await self.async_client.get('/api/async/leaderboard/top/', {'limit': 'many'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = await self.async_client.post('/api/async/leaderboard/top/')
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        # Answered without a query, like the DRF view
+        response = await self.async_client.get('/api/async/leaderboard/top/', {'limit': 0})
+        self.assertEqual((response.status_code, json.loads(response.content)), (status.HTTP_200_OK, []))
+        response = await self.async_client.get('/api/async/activities/by_user/', {'email': 'a@example.com',
+                                                                                  'cursor': 'bad'})
+        self.assertEqual((response.status_code, json.loads(response.content)),
+                         (status.HTTP_404_NOT_FOUND, {'detail': 'Invalid cursor'}))
+    
+    def test_async_requests_pairs_routes(self):
+        requests = [
+            {'name': 'leaderboard-top', 'method': 'get', 'path': '/api/leaderboard/top/', 'params': {}, 'body': None},
+            {'name': 'team-list', 'method': 'get', 'path': '/api/teams/', 'params': {}, 'body': None},
+        ]
+        pairs = benchmark.async_requests(requests)
+        self.assertEqual([(sync['path'], other['path']) for sync, other in pairs],
+                         [('/api/leaderboard/top/', '/api/async/leaderboard/top/')])
+
+
+class IdempotencyTest(ProcessStateMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = {'user_email': 'a@example.com', 'activity_type': 'Running', 'duration': 30,
+                     'date': datetime(2024, 5, 1, 7, 30)}
+        self.create = mock.Mock(return_value=Response({'_id': 'x'}, status=status.HTTP_201_CREATED))
+    
+    def submit(self, data, **headers):
+        request = APIRequestFactory().post('/api/activities/', **headers)
+        return idempotency.submit(request, data, self.create)
+    
+    def test_content_hash_replays_the_first_response(self):
+        first = self.submit(self.data)
+        replay = self.submit(dict(self.data, calories=999))
+        self.assertEqual(self.create.call_count, 1)
+        self.assertEqual((replay.status_code, replay.data), (first.status_code, first.data))
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.submit(dict(self.data, duration=31))
+        self.assertEqual(self.create.call_count, 2)
+    
+    def test_content_identity_expires_sooner_than_keys(self):
+        store = caches[idempotency.IDEMPOTENCY_ALIAS]
+        with mock.patch.object(store, 'set', wraps=store.set) as store_set:
+            self.submit(self.data)
+            self.submit(self.data, HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual([call.kwargs['timeout'] for call in store_set.call_args_list],
+                         [settings.OCTOFIT_IDEMPOTENCY_CONTENT_TTL, DEFAULT_TIMEOUT])
+    
+    def test_idempotency_key(self):
+        first = self.submit(self.data, HTTP_IDEMPOTENCY_KEY='k1')
+        replay = self.submit(dict(self.data, calories=999), HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual((replay.status_code, replay.data), (first.status_code, first.data))
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.submit(dict(self.data, duration=31), HTTP_IDEMPOTENCY_KEY='k2')
+        self.assertEqual(self.create.call_count, 2)
+        response = self.submit(dict(self.data, duration=45), HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        response = self.submit(self.data, HTTP_IDEMPOTENCY_KEY='x' * 300)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_in_flight_and_failed_submissions(self):
+        def create():
+            response = self.submit(self.data)
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+            raise RuntimeError
+        with self.assertRaises(RuntimeError):
+            idempotency.submit(APIRequestFactory().post('/api/activities/'), self.data, create)
+        self.assertEqual(self.submit(self.data).status_code, status.HTTP_201_CREATED)
+
+
+class IdempotentActivityAPITest(ProcessStateAPITestCase):
+    def test_retry_creates_one_activity(self):
+        data = {'user_email': 'retry@example.com', 'activity_type': 'Running', 'duration': 30,
+                'calories': 300, 'date': '2024-05-01T07:30:00Z'}
+        first = self.client.post('/api/activities/', data, format='json', HTTP_IDEMPOTENCY_KEY='retry-1')
+        second = self.client.post('/api/activities/', data, format='json', HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(Activity.objects.filter(user_email='retry@example.com').count(), 1)
+    
+    def test_retry_without_a_key_creates_one_activity(self):
+        data = {'user_email': 'unkeyed@example.com', 'activity_type': 'Running', 'duration': 30,
+                'calories': 300, 'date': '2024-05-01T07:30:00Z'}
+        first = self.client.post('/api/activities/', data, format='json')
+        second = self.client.post('/api/activities/', data, format='json')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(Activity.objects.filter(user_email='unkeyed@example.com').count(), 1)
+
+
+class ThrottlingTest(SimpleTestCase):
+    def test_token_bucket(self):
+        buckets = throttling.TokenBuckets()
+        burst, per_second = throttling.parse_rate('2/s')
+        self.assertEqual((burst, per_second), (2, 2.0))
+        self.assertEqual(buckets.take('a', burst, per_second, now=0), 0)
+        self.assertEqual(buckets.take('a', burst, per_second, now=0), 0)
+        self.assertAlmostEqual(buckets.take('a', burst, per_second, now=0), 0.5)
+        self.assertEqual(buckets.take('b', burst, per_second, now=0), 0)
+        self.assertEqual(buckets.take('a', burst, per_second, now=0.5), 0)
+    
+    def test_scopes(self):
+        throttle = throttling.TokenBucketThrottle()
+        view = mock.Mock(spec=['action'], action='list')
+        self.assertEqual(throttle.get_scope(None, view), 'expensive')
+        view.action = 'by_email'
+        self.assertEqual(throttle.get_scope(None, view), 'standard')
+        view = mock.Mock(spec=['action', 'expensive_actions'], action='bulk', expensive_actions=('bulk',))
+        self.assertEqual(throttle.get_scope(None, view), 'expensive')
+
+
+class LoadSheddingTest(SimpleTestCase):
+    @override_settings(OCTOFIT_SHED_MAX_IN_FLIGHT=1, OCTOFIT_SHED_RETRY_AFTER=2)
+    def test_requests_beyond_the_limit_are_shed(self):
+        from .middleware import LoadSheddingMiddleware
+        inner = []
+        
+        def get_response(request):
+            if request.path == '/api/teams/':
+                inner.append(middleware(APIRequestFactory().get('/api/users/')))
+                inner.append(middleware(APIRequestFactory().get('/metrics')))
+            return HttpResponse()
+        middleware = LoadSheddingMiddleware(get_response)
+        response = middleware(APIRequestFactory().get('/api/teams/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(inner[0].status_code, 503)
+        self.assertEqual(inner[0]['Retry-After'], '2')
+        self.assertEqual(inner[1].status_code, 200)
+        self.assertEqual(middleware.in_flight, 0)
+
+
+class UserDirectoryTest(SimpleTestCase):
+    def setUp(self):
+        users = {
+            'a@example.com': {'_id': ObjectId(), 'name': 'A', 'email': 'a@example.com', 'team': 'Blue'},
+            'b@example.com': {'_id': ObjectId(), 'name': 'B', 'email': 'b@example.com', 'team': ''},
+        }
+        self.find_mock = mock.Mock(side_effect=lambda emails: [users[email] for email in emails if email in users])
+        self.directory = user_directory.UserDirectory(loader=self.find_mock)
+    
+    def test_batch_costs_one_query_then_none(self):
+        found = self.directory.get_many(['a@example.com', 'b@example.com', 'nobody@example.com', 'a@example.com'])
+        self.assertEqual(set(found), {'a@example.com', 'b@example.com'})
+        self.assertEqual(self.find_mock.call_count, 1)
+        self.assertEqual(self.directory.get('a@example.com')['name'], 'A')
+        self.assertEqual(self.find_mock.call_count, 1)
+        # A miss is looked up again, in case the user has been created since
+        self.assertIsNone(self.directory.get('nobody@example.com'))
+        self.find_mock.assert_called_with(['nobody@example.com'])
+        self.directory.invalidate('a@example.com')
+        self.directory.get_many(['a@example.com', 'b@example.com'])
+        self.find_mock.assert_called_with(['a@example.com'])
+    
+    @override_settings(OCTOFIT_USER_DIRECTORY_SIZE=1)
+    def test_least_recently_used_is_evicted(self):
+        self.directory.get('a@example.com')
+        self.directory.get('b@example.com')
+        self.directory.get('a@example.com')
+        self.assertEqual(self.find_mock.call_count, 3)
+
+
+class UserLookupAPITest(ProcessStateAPITestCase):
+    def test_by_emails(self):
+        User.objects.create(name="Lookup User", email="lookup@example.com", team="Team A")
+        response = self.client.get('/api/users/by_emails/', {'emails': 'lookup@example.com,missing@example.com'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['name'] for user in response.data['results']], ['Lookup User'])
+        self.assertEqual(response.data['missing'], ['missing@example.com'])
+        response = self.client.get('/api/users/by_emails/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class LeaderboardRebuildTest(ProcessStateAPITestCase):
+    def test_rebuild_from_activities_and_users(self):
+        Team.objects.create(name="Team A", members=[], total_points=999)
+        Team.objects.create(name="Team B", members=[], total_points=5)
+        User.objects.create(name="Runner", email="runner@example.com", team="Team A")
+        User.objects.create(name="Idle", email="idle@example.com", team="Team A")
+        for email, calories in (("runner@example.com", 300), ("runner@example.com", 100), ("guest@example.com", 400)):
+            Activity.objects.create(user_email=email, activity_type="Running", duration=30, calories=calories,
+                                    date=timezone.now())
+        Leaderboard.objects.create(user_email="gone@example.com", user_name="Gone", team="Team A",
+                                   total_calories=10000, total_activities=5, rank=1)
+        
+        self.assertEqual(leaderboard.rebuild_leaderboard(), 1)
+        # The $merge on user_email needs the unique index, created if missing
+        self.assertTrue(Leaderboard.objects.mongo_index_information()['leaderboard_user_email_uniq']['unique'])
+        entries = {entry.user_email: entry for entry in Leaderboard.objects.all()}
+        # The same entries the incremental path leaves: one per email with activities, none deleted
+        self.assertEqual(set(entries), {"runner@example.com", "guest@example.com", "gone@example.com"})
+        self.assertEqual((entries["runner@example.com"].total_calories, entries["runner@example.com"].total_activities),
+                         (400, 2))
+        self.assertEqual((entries["gone@example.com"].total_calories, entries["gone@example.com"].total_activities),
+                         (0, 0))
+        self.assertEqual([entries[email].rank for email in ("runner@example.com", "guest@example.com",
+                                                            "gone@example.com")], [1, 1, 3])
+        self.assertEqual((entries["runner@example.com"].user_name, entries["runner@example.com"].team),
+                         ("Runner", "Team A"))
+        self.assertEqual((entries["guest@example.com"].user_name, entries["guest@example.com"].team),
+                         ("guest@example.com", ""))
+        self.assertEqual(Team.objects.get(name="Team A").total_points, 400)
+        self.assertEqual(Team.objects.get(name="Team B").total_points, 0)
+
+
+@override_settings(OCTOFIT_WRITE_BEHIND_BATCH=2, OCTOFIT_WRITE_BEHIND_MAX=3)
+class WriteBehindTest(SimpleTestCase):
+    def setUp(self):
+        self.buffer = write_behind.WriteBehindBuffer()
+        # Flushed by hand instead of from the background thread
+        self.buffer.start = mock.Mock()
+        self.write = self.patch('octofit_tracker.write_behind._write', return_value=set())
+        self.events = self.patch('octofit_tracker.activity_events.activities_written')
+    
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+    
+    def activity(self, calories):
+        return Activity(_id=ObjectId(), user_email='a@example.com', activity_type='Running', duration=30,
+                        calories=calories, date=timezone.now())
+    
+    def test_batches_and_back_pressure(self):
+        activities = [self.activity(calories) for calories in (100, 200, 300, 400)]
+        self.assertEqual([self.buffer.submit(activity) for activity in activities], [True, True, True, False])
+        self.assertTrue(self.buffer.flush())
+        documents = self.write.call_args[0][0]
+        self.assertEqual([document['_id'] for document in documents], [activity._id for activity in activities[:2]])
+        self.assertEqual([row['calories'] for row in self.events.call_args[1]['added']], [100, 200])
+        self.assertEqual(self.buffer.pending, 1)
+    
+    def test_failed_batch_is_retried_in_order(self):
+        for calories in (100, 200, 300):
+            self.buffer.submit(self.activity(calories))
+        self.write.side_effect = [AutoReconnect(), {1}, set()]
+        self.assertFalse(self.buffer.flush())
+        self.assertEqual(self.buffer.pending, 3)
+        self.buffer.stop()
+        self.assertEqual(self.buffer.pending, 0)
+        self.assertEqual([row['calories'] for call in self.events.call_args_list for row in call[1]['added']],
+                         [100, 300])
+
+
+class LocalChanges:
+    """The shared live changes in a list, for tests that run without MongoDB"""
+    def __init__(self):
+        self.changes = []
+    
+    def append(self, stamp, entry):
+        self.changes.append({'_id': stamp, **(entry or {'user_email': None})})
+    
+    def latest(self):
+        return max((change['_id'] for change in self.changes), default=0)
+    
+    def since(self, stamp):
+        return sorted((change for change in self.changes if change['_id'] > stamp), key=lambda change: change['_id'])
+
+
+class ConditionalRequestTest(SimpleTestCase):
+    def setUp(self):
+        self.store = LocalVersions().install(self)
+    
+    def test_versions(self):
+        key = versions.collection_key('teams')
+        (epoch, first), modified = versions.current([key])
+        self.assertEqual(versions.current([key]), ([epoch, first], modified))
+        versions.bump('teams')
+        self.assertEqual(versions.current([key])[0], [epoch, first + 1])
+        versions.bump_all()
+        self.assertEqual(versions.current([])[0], [epoch + 1])
+        versions.model_changed(Team, Team(pk=ObjectId('0' * 24)))
+        self.assertIn(versions.object_key('teams', '0' * 24), self.store.versions)
+    
+    def test_writes_in_the_same_nanosecond_change_the_etag(self):
+        key = versions.collection_key('teams')
+        with mock.patch('time.time_ns', return_value=10**18):
+            first = versions.current([key])
+            versions.bump('teams')
+            second = versions.current([key])
+        self.assertNotEqual(second[0], first[0])
+        self.assertEqual(second[1], first[1])
+    
+    def test_writes_by_other_processes_are_read_once_the_local_copy_expires(self):
+        key = versions.collection_key('teams')
+        (_, first), _ = versions.current([key])
+        self.store.advance([key], 0)
+        self.assertEqual(versions.current([key])[0][1], first)
+        caches[versions.VERSIONS_ALIAS].clear()
+        self.assertEqual(versions.current([key])[0][1], first + 1)
+    
+    def test_deferred_bumps_are_written_once(self):
+        with mock.patch.object(self.store, 'advance', wraps=self.store.advance) as advance:
+            with versions.deferred():
+                versions.bump('teams', objects=[('teams', '1')])
+                versions.model_changed(Team, Team(pk='1'))
+                versions.bump('teams', 'leaderboard')
+            self.assertEqual(advance.call_count, 1)
+        self.assertEqual(sorted(advance.call_args[0][0]),
+                         ['collection:leaderboard', 'collection:teams', 'object:teams:1'])
+    
+    @mock.patch('octofit_tracker.rollups.summarize', return_value=[])
+    def test_not_modified_skips_the_query(self, summarize):
+        from .views import StatsViewSet
+        view = StatsViewSet.as_view({'get': 'by_user'})
+        url = '/api/stats/by_user/?email=a@example.com'
+        response = view(APIRequestFactory().get(url))
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+        response = view(APIRequestFactory().get(url, HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(summarize.call_count, 1)
+        versions.bump('activity_rollups')
+        response = view(APIRequestFactory().get(url, HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(OCTOFIT_LIVE_BUFFER=3, OCTOFIT_LIVE_MIN_INTERVAL=0)
+class LiveLeaderboardTest(SimpleTestCase):
+    def entry(self, email, calories, rank):
+        return {'user_email': email, 'total_calories': calories, 'rank': rank}
+    
+    def test_changes_are_coalesced(self):
+        hub = live.LeaderboardHub()
+        hub.publish(1, self.entry('a@example.com', 100, 2))
+        hub.publish(2, self.entry('b@example.com', 150, 1))
+        hub.publish(4, self.entry('a@example.com', 200, 1))
+        sequence, message = hub.changes_since(0)
+        self.assertEqual(sequence, 4)
+        self.assertEqual([(entry['user_email'], entry['rank']) for entry in json.loads(message)],
+                         [('b@example.com', 1), ('a@example.com', 1)])
+        self.assertEqual(hub.changes_since(4), (4, None))
+        hub.publish(5, self.entry('b@example.com', 250, 1))
+        # The first change has left the ring
+        self.assertIs(hub.changes_since(0)[1], live.RESET)
+        self.assertEqual(len(json.loads(hub.changes_since(2)[1])), 2)
+        hub.reset(6)
+        self.assertIs(hub.changes_since(5)[1], live.RESET)
+    
+    def test_shared_changes_are_read_in_order(self):
+        hub, source = live.LeaderboardHub(), LocalChanges()
+        source.append(3, self.entry('old@example.com', 50, 9))
+        hub.poll(source)
+        # A new process starts from the last change
+        self.assertEqual(hub.changes_since(3), (3, None))
+        source.append(4, self.entry('a@example.com', 100, 1))
+        source.append(7, self.entry('b@example.com', 90, 2))
+        hub.poll(source)
+        self.assertEqual(hub.changes_since(3)[0], 4)
+        # Stamp 5 may still be on its way; 6 arrives late, 5 never does
+        source.append(6, self.entry('c@example.com', 80, 3))
+        hub.poll(source)
+        self.assertEqual(hub.changes_since(3)[0], 4)
+        hub.poll(source)
+        sequence, message = hub.changes_since(4)
+        self.assertEqual(sequence, 7)
+        self.assertEqual([entry['user_email'] for entry in json.loads(message)], ['c@example.com', 'b@example.com'])
+        source.append(8, None)
+        hub.poll(source)
+        self.assertEqual(hub.changes_since(7), (8, live.RESET))
+        for stamp in range(9, 12):
+            source.append(stamp, self.entry('a@example.com', stamp, 1))
+        # As many changes as the capped collection holds: some may be lost
+        hub.poll(source)
+        self.assertEqual(hub.changes_since(8), (11, live.RESET))
+    
+    async def test_stream(self):
+        hub, source = live.LeaderboardHub(), LocalChanges()
+        source.append(1, self.entry('old@example.com', 50, 9))
+        sent, closed = [], asyncio.Event()
+        
+        async def receive():
+            await closed.wait()
+            return {'type': 'http.disconnect'}
+        
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 2:
+                # Recorded by another process
+                source.append(2, self.entry('a@example.com', 100, 1))
+            elif len(sent) == 3:
+                closed.set()
+        scope = {'type': 'http', 'method': 'GET', 'path': live.LIVE_PATH, 'query_string': b'', 'headers': []}
+        with mock.patch.object(live, 'hub', hub), mock.patch.object(live, 'changes', source), \
+                override_settings(OCTOFIT_LIVE_POLL=0.01):
+            await asyncio.wait_for(live.stream(scope, receive, send), 5)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), sent[0]['headers'])
+        self.assertIn(b'id: 1\nevent: reset', sent[1]['body'])
+        self.assertEqual(sent[2]['body'], b'id: 2\nevent: ranks\ndata: [{"user_email":"a@example.com",'
+                                          b'"total_calories":100,"rank":1}]\n\n')
+        self.assertEqual(hub.subscribers, 0)
+        self.assertFalse(hub.synced)
+    
+    async def test_rejects_bad_requests(self):
+        sent = []
+        
+        async def send(message):
+            sent.append(message)
+        scope = {'type': 'http', 'method': 'GET', 'path': live.LIVE_PATH, 'query_string': b'interval=soon',
+                 'headers': []}
+        await live.stream(scope, None, send)
+        self.assertEqual(sent[0]['status'], 400)
+        with override_settings(OCTOFIT_LIVE_MAX_SUBSCRIBERS=0):
+            await live.stream(dict(scope, query_string=b''), None, send)
+        self.assertEqual(sent[2]['status'], 503)
@@ -0,0 +1,90 @@
+"""
+Token-bucket rate limiting for the API.
+
+Every API request takes a token from the bucket of its client (DRF's
+``get_ident``: the remote address, or the forwarded one behind
+``NUM_PROXIES`` proxies) for its endpoint class. Expensive calls (list and
+export actions, plus whatever a viewset lists in ``expensive_actions``)
+use the ``expensive`` scope and everything else the ``standard`` one, so a
+client polling a list in a loop runs out of list calls long before it
+affects anyone's cheap reads. Rates come from ``DEFAULT_THROTTLE_RATES``
+in DRF's usual ``'<requests>/<period>'`` form: the number of requests is
+the burst a full bucket allows and the bucket refills at that average.
+Refused requests get 429 with ``Retry-After`` set to when the next token
+is due.
+
+Buckets live in process memory, so under several workers each one limits
+on its own; ``OCTOFIT_THROTTLE_MAX_CLIENTS`` bounds how many buckets are
+kept, dropping the least recently used (a dropped client starts again
+with a full bucket).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+
+EXPENSIVE_ACTIONS = ('list', 'export')
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """``(burst, tokens per second)`` for a ``'<requests>/<period>'`` rate"""
+    requests, period = rate.split('/')
+    requests = int(requests)
+    return requests, requests / PERIODS[period[0]]
+
+
+class TokenBuckets:
+    """Token buckets by key, least recently used dropped beyond the size bound"""
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, per_second, now=None):
+        """Take a token from ``key``'s bucket; returns 0, or the seconds until one is due"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * per_second)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / per_second
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > settings.OCTOFIT_THROTTLE_MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+buckets = TokenBuckets()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    def get_scope(self, request, view):
+        expensive = getattr(view, 'expensive_actions', EXPENSIVE_ACTIONS)
+        return 'expensive' if getattr(view, 'action', None) in expensive else 'standard'
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(request, view)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope)
+        if rate is None:
+            return True
+        self.retry_after = buckets.take(f'{scope}:{self.get_ident(request)}', *parse_rate(rate))
+        if self.retry_after:
+            metrics.THROTTLED_REQUESTS.inc(scope=scope)
+            return False
+        return True
+
+    def wait(self):
+        return self.retry_after
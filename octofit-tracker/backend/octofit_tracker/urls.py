@@ -16,7 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework import routers
-from .views import UserViewSet, TeamViewSet, ActivityViewSet, LeaderboardViewSet, WorkoutViewSet
+from . import async_views
+from .views import (
+    UserViewSet, TeamViewSet, ActivityViewSet, LeaderboardViewSet, WorkoutViewSet, StatsViewSet, TaskViewSet,
+    metrics_view,
+)
 
 # API will be accessible via Codespace URL: https://<codespace-name>-8000.app.github.dev/api/
 # Create a router and register our viewsets
@@ -26,9 +30,22 @@ router.register(r'teams', TeamViewSet)
 router.register(r'activities', ActivityViewSet)
 router.register(r'leaderboard', LeaderboardViewSet)
 router.register(r'workouts', WorkoutViewSet)
+router.register(r'stats', StatsViewSet, basename='stats')
+router.register(r'tasks', TaskViewSet)
+
+# Async versions of the read-heavy endpoints, for ASGI deployments
+async_urlpatterns = [
+    path('leaderboard/top/', async_views.leaderboard_top, name='async-leaderboard-top'),
+    path('activities/by_user/', async_views.activities_by_user, name='async-activities-by-user'),
+    path('users/by_email/', async_views.users_by_email, name='async-users-by-email'),
+    path('workouts/by_category/', async_views.workouts_by_category, name='async-workouts-by-category'),
+    path('workouts/by_difficulty/', async_views.workouts_by_difficulty, name='async-workouts-by-difficulty'),
+]
 
 urlpatterns = [
+    path('api/async/', include(async_urlpatterns)),
     path('', include(router.urls)),
     path('api/', include(router.urls)),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,94 @@
+"""
+In-process directory of users by email.
+
+Activities and leaderboard rows identify users only by ``user_email``, so
+anything that shows names or teams resolves emails to users over and over.
+The directory keeps user documents (``_id``, ``name``, ``email``,
+``team``) in a bounded LRU keyed by email: a batch of emails costs at most
+one ``$in`` query for the ones not already held, and none once they are.
+Emails with no user are not remembered: the user may be created by another
+process at any moment, and a remembered miss would leave activities written
+meanwhile without a team.
+
+It is warmed from the ``users`` collection when a worker starts and
+entries are dropped by ``UserViewSet`` writes. Entries older than
+``OCTOFIT_USER_DIRECTORY_TTL`` seconds are fetched again, which picks up
+writes made by other processes.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import User
+
+FIELDS = ('_id', 'name', 'email', 'team')
+
+
+def find_users(emails):
+    """The user documents for ``emails``, in one query"""
+    return User.objects.mongo_find({'email': {'$in': emails}}, dict.fromkeys(FIELDS, 1))
+
+
+class UserDirectory:
+    """User documents by email; ``loader`` fetches the documents for a list of emails"""
+
+    def __init__(self, loader=find_users):
+        self._loader = loader
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _store(self, documents, now):
+        # Called with the lock held
+        for email, document in documents.items():
+            self._entries.pop(email, None)
+            self._entries[email] = (document, now)
+        while len(self._entries) > settings.OCTOFIT_USER_DIRECTORY_SIZE:
+            self._entries.popitem(last=False)
+
+    def get_many(self, emails):
+        """``{email: user document}`` for the given emails that belong to a user"""
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for email in dict.fromkeys(emails):
+                entry = self._entries.get(email)
+                if entry is None or now - entry[1] > settings.OCTOFIT_USER_DIRECTORY_TTL:
+                    missing.append(email)
+                    continue
+                self._entries.move_to_end(email)
+                found[email] = entry[0]
+        if missing:
+            fetched = {document['email']: document for document in self._loader(missing)}
+            with self._lock:
+                self._store(fetched, now)
+            found.update(fetched)
+        return found
+
+    def get(self, email):
+        """The user document for ``email``, or None"""
+        return self.get_many([email]).get(email)
+
+    def warm(self):
+        """Fill the directory with up to its size in users, in one query"""
+        limit = settings.OCTOFIT_USER_DIRECTORY_SIZE
+        documents = {
+            document['email']: document
+            for document in User.objects.mongo_find({}, dict.fromkeys(FIELDS, 1)).limit(limit)
+        }
+        with self._lock:
+            self._store(documents, time.monotonic())
+        return len(documents)
+
+    def invalidate(self, *emails):
+        with self._lock:
+            for email in emails:
+                self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+directory = UserDirectory()
@@ -0,0 +1,155 @@
+"""
+Version counters behind conditional GETs.
+
+Every collection, and every object of the collections whose documents only
+change through their own viewset, has a version: a counter that every write
+increments, kept with the ``time.time_ns()`` of that write in the
+``versions`` collection of MongoDB as ``{_id: key, version, modified}`` so
+that every process reads and bumps the same counters. Writes through the
+viewsets bump the versions they affect, and so do the code paths that change
+derived data (activity events, rank and team point rebuilds, task state
+changes) and, through ``post_save`` and ``post_delete``, any ORM write made
+outside a viewset, such as the admin's. Inside a viewset write
+(``deferred()``) every bump, the signals' included, is collected and written
+once when the request is done. ``ConditionalMixin`` turns the counters a
+response depends on into a strong ``ETag`` and the latest of their write
+times into a ``Last-Modified`` date, so a client that already has the
+current body gets 304 without querying the collections the body is built
+from. Two writes in the same nanosecond, or on hosts whose clocks disagree,
+still give different ETags.
+
+Versions read from MongoDB are held in the ``versions`` alias of
+``CACHES`` for its ``TIMEOUT`` (``OCTOFIT_VERSIONS_TTL`` seconds), so a hot
+response costs a local cache lookup, and a write made by another process
+(a worker, ``populate_db``, ``run_tasks``) is seen within that time. A counter
+that was never written starts at the current time, like the result cache's
+generations, so a counter recreated after the collection is dropped never
+repeats a value an old ETag was built from; its write time can only make a
+response look newer than it is. The epoch is part of every response's
+version and is bumped when the whole dataset is replaced.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from . import mongo_client
+
+VERSIONS_ALIAS = 'versions'
+VERSIONS_COLLECTION = 'versions'
+EPOCH_KEY = 'epoch'
+
+_deferred = ContextVar('octofit_deferred_versions', default=None)
+
+
+class MongoVersions:
+    """The shared counters, one document per key"""
+
+    def _collection(self):
+        return mongo_client.client()[settings.DATABASES['default']['NAME']][VERSIONS_COLLECTION]
+
+    def _upsert(self, keys, update):
+        requests = [UpdateOne({'_id': key}, update, upsert=True) for key in keys]
+        for attempt in range(2):
+            try:
+                return self._collection().bulk_write(requests, ordered=False)
+            except BulkWriteError:
+                # Concurrent upserts of a new key; the retry updates the document the other one created
+                if attempt:
+                    raise
+
+    def get_many(self, keys):
+        """``{key: (version, modified)}`` for the keys that have one"""
+        # Counters written before ``modified`` was recorded were write times themselves
+        return {document['_id']: (document['version'], document.get('modified', document['version']))
+                for document in self._collection().find({'_id': {'$in': keys}})}
+
+    def seed(self, keys, now):
+        """Start the keys without a version at ``now`` and return every key's version"""
+        self._upsert(keys, {'$setOnInsert': {'version': now, 'modified': now}})
+        return self.get_many(keys)
+
+    def advance(self, keys, now):
+        """Increment the keys' versions, recording ``now`` as their last write"""
+        self._upsert(keys, [{'$set': {
+            'version': {'$add': [{'$ifNull': ['$version', now]}, 1]},
+            'modified': {'$max': ['$modified', now]},
+        }}])
+
+
+store = MongoVersions()
+
+
+def _versions():
+    return caches[VERSIONS_ALIAS]
+
+
+def collection_key(collection):
+    return f'collection:{collection}'
+
+
+def object_key(collection, pk):
+    return f'object:{collection}:{pk}'
+
+
+def current(keys):
+    """
+    ``(counters, modified)``: the versions for ``keys``, preceded by the
+    epoch's, and the ``time.time_ns()`` of the latest write to any of them
+    """
+    keys = [EPOCH_KEY, *keys]
+    cache = _versions()
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        fetched = store.get_many(missing)
+        if len(fetched) < len(missing):
+            fetched = store.seed(missing, time.time_ns())
+        cache.set_many(fetched)
+        versions.update(fetched)
+    return [versions[key][0] for key in keys], max(versions[key][1] for key in keys)
+
+
+def _advance(keys):
+    pending = _deferred.get()
+    if pending is not None:
+        pending.update(dict.fromkeys(keys))
+        return
+    store.advance(keys, time.time_ns())
+    # This process reads its own writes back at once
+    _versions().delete_many(keys)
+
+
+@contextmanager
+def deferred():
+    """Collect the bumps made in this context, and write each key once when it ends"""
+    pending = {}
+    token = _deferred.set(pending)
+    try:
+        yield
+    finally:
+        _deferred.reset(token)
+        if pending:
+            _advance(list(pending))
+
+
+def bump(*collections, objects=()):
+    """Record a write to ``collections`` and to the ``(collection, pk)`` pairs in ``objects``"""
+    keys = [collection_key(collection) for collection in collections]
+    keys += [object_key(collection, pk) for collection, pk in objects]
+    _advance(keys)
+
+
+def bump_all():
+    """Change the version of everything, e.g. after the database is repopulated"""
+    _advance([EPOCH_KEY])
+
+
+def model_changed(sender, instance, **kwargs):
+    """``post_save``/``post_delete`` receiver: bump the instance's collection and object"""
+    collection = sender._meta.db_table
+    bump(collection, objects=[(collection, instance.pk)])
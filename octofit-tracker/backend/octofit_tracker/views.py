@@ -1,100 +1,534 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.permissions import SAFE_METHODS, BasePermission
 from rest_framework.response import Response
-from .models import User, Team, Activity, Leaderboard, Workout
-from .serializers import UserSerializer, TeamSerializer, ActivitySerializer, LeaderboardSerializer, WorkoutSerializer
+from .models import User, Team, Activity, Leaderboard, Workout, Task
+from .serializers import (
+    UserSerializer, TeamSerializer, ActivitySerializer, LeaderboardSerializer, WorkoutSerializer, TaskSerializer,
+    fast_representation, requested_fields,
+)
+from .pagination import ActivityPagination, LeaderboardPagination, TaskPagination
+from .renderers import CSVRenderer, NDJSONRenderer
+from . import (
+    activity_events, boards, exports, idempotency, ingest, leaderboard, metrics, rank_index, result_cache, rollups,
+    tasks, user_directory, versions, write_behind,
+)
+
+
+class ProjectionMixin:
+    """
+    Push the ``fields``/``exclude`` selection down to MongoDB so unselected
+    fields are never fetched. The pagination ordering field is always kept
+    so cursors can be built without extra queries.
+    """
+    
+    def ordering_fields(self):
+        ordering = getattr(self.paginator, 'ordering', None) or ()
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        return [name.lstrip('-') for name in ordering]
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        available = self.get_serializer_class().Meta.fields
+        fields = requested_fields(self.request, available)
+        if len(fields) == len(available):
+            return queryset
+        return queryset.only(*fields, *self.ordering_fields())
+
+
+class FastReadMixin:
+    """
+    Serve list and retrieve (and list-like actions) from ``values()`` rows
+    turned into primitives by a compiled representation, skipping model
+    instances and per-field serializer dispatch. The output is the same as
+    the serializer's. Views with object-level permissions retrieve through
+    ``get_object()`` so the permissions are always checked.
+    """
+    
+    def read_rows(self, queryset, *extra):
+        sources, represent = fast_representation(self.get_serializer())
+        return queryset.values(*dict.fromkeys([*sources, *self.ordering_fields(), *extra])), represent
+    
+    def represent_rows(self, queryset):
+        rows, represent = self.read_rows(queryset)
+        return [represent(row) for row in rows]
+    
+    def list_response(self, queryset):
+        rows, represent = self.read_rows(queryset)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response([represent(row) for row in page])
+        return Response([represent(row) for row in rows])
+    
+    def list(self, request, *args, **kwargs):
+        return self.list_response(self.filter_queryset(self.get_queryset()))
+    
+    def checks_objects(self):
+        """Whether any permission class implements ``has_object_permission``"""
+        return any(
+            type(permission).has_object_permission is not BasePermission.has_object_permission
+            for permission in self.get_permissions()
+        )
+    
+    def retrieve(self, request, *args, **kwargs):
+        if self.checks_objects():
+            # Object permissions are written against model instances, so
+            # go through get_object(), which runs check_object_permissions()
+            return super().retrieve(request, *args, **kwargs)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        rows, represent = self.read_rows(self.filter_queryset(self.get_queryset()))
+        try:
+            row = rows.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]}).first()
+        except InvalidId:
+            row = None
+        if row is None:
+            raise Http404
+        return Response(represent(row))
+
 
+class NotModified(Exception):
+    """Raised from ``initial`` to answer a conditional GET with 304 before the view runs"""
+    
+    def __init__(self, response):
+        self.response = response
+
+
+def _today_ns():
+    midnight = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(midnight.timestamp()) * 10**9
 
-class UserViewSet(viewsets.ModelViewSet):
+
+class ConditionalMixin:
+    """
+    Put a strong ``ETag`` and a ``Last-Modified`` date, derived from the
+    version counters in ``versions``, on every GET (list, detail and custom
+    actions), and answer ``If-None-Match``/``If-Modified-Since`` with 304
+    before the view queries anything. ``version_collections`` are the
+    collections the responses are built from (the viewset's own by
+    default); with ``object_versions`` a detail response depends only on its
+    own object. ``dated_actions`` also depend on the current UTC day.
+    Successful writes through the viewset bump its collection and object,
+    together with every other version the write bumped, in one update.
+    """
+    version_collections = None
+    object_versions = False
+    dated_actions = ()
+    
+    def write_collection(self):
+        return self.queryset.model._meta.db_table
+    
+    def object_pk(self):
+        return self.kwargs.get(getattr(self, 'lookup_url_kwarg', None) or getattr(self, 'lookup_field', 'pk'))
+    
+    def version_keys(self):
+        pk = self.object_pk()
+        if pk is not None and self.object_versions:
+            return [versions.object_key(self.write_collection(), pk)]
+        return [versions.collection_key(name) for name in self.version_collections or (self.write_collection(),)]
+    
+    def validators(self, request):
+        """``(ETag, Last-Modified timestamp)`` of the current response to ``request``"""
+        counters, modified = versions.current(self.version_keys())
+        if self.action in self.dated_actions:
+            today = _today_ns()
+            counters.append(today)
+            modified = max(modified, today)
+        representation = f'{counters}|{request.get_full_path()}|{request.accepted_media_type}'
+        return f'"{hashlib.sha1(representation.encode()).hexdigest()}"', modified // 10**9
+    
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.conditional = None
+        if request.method in ('GET', 'HEAD'):
+            etag, last_modified = self.conditional = self.validators(request)
+            not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if not_modified is not None:
+                raise NotModified(not_modified)
+    
+    def dispatch(self, request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            return super().dispatch(request, *args, **kwargs)
+        # The write's own bumps, its model signals and the one below are written together
+        with versions.deferred():
+            return super().dispatch(request, *args, **kwargs)
+    
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return exc.response
+        return super().handle_exception(exc)
+    
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        conditional = getattr(self, 'conditional', None)
+        if conditional is not None and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = conditional[0]
+            response['Last-Modified'] = http_date(conditional[1])
+        elif request.method not in SAFE_METHODS and status.is_success(response.status_code):
+            collection, pk = self.write_collection(), self.object_pk()
+            versions.bump(collection, objects=[(collection, pk)] if pk is not None else ())
+        return response
+
+
+class UserViewSet(ConditionalMixin, FastReadMixin, ProjectionMixin, viewsets.ModelViewSet):
     """
     API endpoint for users.
     """
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    object_versions = True
+    max_lookup_emails = 1000
+    
+    def perform_create(self, serializer):
+        user = serializer.save()
+        user_directory.directory.invalidate(user.email)
+    
+    def perform_update(self, serializer):
+        previous_email = serializer.instance.email
+        user = serializer.save()
+        user_directory.directory.invalidate(previous_email, user.email)
+    
+    def perform_destroy(self, instance):
+        instance.delete()
+        user_directory.directory.invalidate(instance.email)
     
     @action(detail=False, methods=['get'])
     def by_email(self, request):
         """Get user by email"""
         email = request.query_params.get('email', None)
         if email:
-            try:
-                user = User.objects.get(email=email)
-                serializer = self.get_serializer(user)
-                return Response(serializer.data)
-            except User.DoesNotExist:
+            user = user_directory.directory.get(email)
+            if user is None:
                 return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+            _, represent = fast_representation(self.get_serializer())
+            return Response(represent(user))
         return Response({'error': 'Email parameter required'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=False, methods=['get'])
+    def by_emails(self, request):
+        """Get many users by a comma-separated list of emails; emails with no user are listed as missing"""
+        emails = list(dict.fromkeys(email for email in request.query_params.get('emails', '').split(',') if email))
+        if not emails:
+            return Response({'error': 'Emails parameter required'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(emails) > self.max_lookup_emails:
+            return Response(
+                {'error': f'At most {self.max_lookup_emails} emails per request'}, status=status.HTTP_400_BAD_REQUEST
+            )
+        users = user_directory.directory.get_many(emails)
+        _, represent = fast_representation(self.get_serializer())
+        return Response({
+            'results': [represent(users[email]) for email in emails if email in users],
+            'missing': [email for email in emails if email not in users],
+        })
 
 
-class TeamViewSet(viewsets.ModelViewSet):
+class TeamViewSet(ConditionalMixin, FastReadMixin, ProjectionMixin, viewsets.ModelViewSet):
     """
     API endpoint for teams.
     """
     queryset = Team.objects.all()
     serializer_class = TeamSerializer
     
+    def update_team(self, pk, update):
+        """Apply a single atomic update to one team document; False if it does not exist"""
+        try:
+            team_id = ObjectId(pk)
+        except InvalidId:
+            return False
+        return Team.objects.mongo_update_one({'_id': team_id}, update).matched_count == 1
+    
     @action(detail=True, methods=['post'])
     def add_member(self, request, pk=None):
         """Add a member to the team"""
-        team = self.get_object()
         member_email = request.data.get('email')
         if member_email:
-            if member_email not in team.members:
-                team.members.append(member_email)
-                team.save()
+            if not self.update_team(pk, {'$addToSet': {'members': member_email}}):
+                return Response({'error': 'Team not found'}, status=status.HTTP_404_NOT_FOUND)
             return Response({'status': 'member added'})
         return Response({'error': 'Email required'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=True, methods=['post'])
+    def remove_member(self, request, pk=None):
+        """Remove a member from the team"""
+        member_email = request.data.get('email')
+        if member_email:
+            if not self.update_team(pk, {'$pull': {'members': member_email}}):
+                return Response({'error': 'Team not found'}, status=status.HTTP_404_NOT_FOUND)
+            return Response({'status': 'member removed'})
+        return Response({'error': 'Email required'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=True, methods=['post'])
+    def add_points(self, request, pk=None):
+        """Add (or with a negative value, subtract) points to the team"""
+        try:
+            points = int(request.data.get('points'))
+        except (TypeError, ValueError):
+            return Response({'error': 'Integer points required'}, status=status.HTTP_400_BAD_REQUEST)
+        if not self.update_team(pk, {'$inc': {'total_points': points}}):
+            return Response({'error': 'Team not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'status': 'points added'})
 
 
-class ActivityViewSet(viewsets.ModelViewSet):
+class ActivityViewSet(ConditionalMixin, FastReadMixin, ProjectionMixin, viewsets.ModelViewSet):
     """
     API endpoint for activities.
     """
     queryset = Activity.objects.all()
     serializer_class = ActivitySerializer
+    pagination_class = ActivityPagination
+    expensive_actions = ('list', 'export', 'bulk')
+    object_versions = True
+    
+    def create(self, request, *args, **kwargs):
+        """Create an activity once per Idempotency-Key (or identical content); retries replay the response"""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return idempotency.submit(request, serializer.validated_data, lambda: self.created(serializer))
+    
+    def created(self, serializer):
+        if settings.OCTOFIT_WRITE_BEHIND:
+            return self.buffered(serializer)
+        self.perform_create(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=self.get_success_headers(serializer.data))
+    
+    def buffered(self, serializer):
+        """Queue the activity for a batched insert and acknowledge it with its id"""
+        activity = Activity(_id=ObjectId(), **serializer.validated_data)
+        if not write_behind.buffer.submit(activity):
+            return Response(
+                {'error': 'Too many activities waiting to be written, retry later'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'},
+            )
+        return Response(self.get_serializer(activity).data, status=status.HTTP_202_ACCEPTED)
+    
+    def perform_create(self, serializer):
+        activity = serializer.save()
+        activity_events.activities_written(added=[activity_events.as_row(activity)])
+    
+    def perform_update(self, serializer):
+        old_row = activity_events.as_row(serializer.instance)
+        activity = serializer.save()
+        activity_events.activities_written(added=[activity_events.as_row(activity)], removed=[old_row])
+    
+    def perform_destroy(self, instance):
+        row = activity_events.as_row(instance)
+        instance.delete()
+        activity_events.activities_written(removed=[row])
+    
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Ingest many activities from a JSON array or an NDJSON stream"""
+        if request.content_type.startswith('application/x-ndjson'):
+            rows = ingest.iter_ndjson(request.stream or [])
+        else:
+            rows = request.data
+            if not isinstance(rows, list):
+                return Response({'error': 'Expected a JSON array or NDJSON body'}, status=status.HTTP_400_BAD_REQUEST)
+        summary = ingest.ingest_activities(rows)
+        response_status = status.HTTP_201_CREATED if not summary['failed'] else status.HTTP_207_MULTI_STATUS
+        return Response(summary, status=response_status)
+    
+    @action(detail=False, methods=['get'], renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        """Stream activities as CSV or NDJSON, optionally filtered by email and [since, until) dates"""
+        try:
+            query = exports.activity_query(*(request.query_params.get(param) for param in ('email', 'since', 'until')))
+        except ValueError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        return exports.stream_export(
+            Activity, query, requested_fields(request, ActivitySerializer.Meta.fields), [('date', -1), ('_id', -1)],
+            request.accepted_renderer.format, 'activities'
+        )
     
     @action(detail=False, methods=['get'])
     def by_user(self, request):
         """Get activities by user email"""
         email = request.query_params.get('email', None)
         if email:
-            activities = Activity.objects.filter(user_email=email)
-            serializer = self.get_serializer(activities, many=True)
-            return Response(serializer.data)
+            return self.list_response(self.get_queryset().filter(user_email=email))
         return Response({'error': 'Email parameter required'}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class LeaderboardViewSet(viewsets.ModelViewSet):
+class LeaderboardViewSet(ConditionalMixin, FastReadMixin, ProjectionMixin, viewsets.ModelViewSet):
     """
     API endpoint for leaderboard.
     """
     queryset = Leaderboard.objects.all()
     serializer_class = LeaderboardSerializer
+    pagination_class = LeaderboardPagination
+    # Period boards are built from the rollups and roll over every day
+    version_collections = ('leaderboard', 'activity_rollups')
+    dated_actions = ('board',)
+    
+    def perform_create(self, serializer):
+        entry = serializer.save()
+        # The new entry passes everyone scoring less
+        leaderboard.rerank(high=entry.total_calories)
+        rank_index.index.update(entry.user_email, entry.total_calories)
+        boards.boards.invalidate('all')
+        result_cache.invalidate('leaderboard.top')
+    
+    def perform_update(self, serializer):
+        previous_email, previous = serializer.instance.user_email, serializer.instance.total_calories
+        entry = serializer.save()
+        leaderboard.rerank(min(previous, entry.total_calories), max(previous, entry.total_calories))
+        if entry.user_email != previous_email:
+            rank_index.index.remove(previous_email)
+        rank_index.index.update(entry.user_email, entry.total_calories)
+        boards.boards.invalidate('all')
+        result_cache.invalidate('leaderboard.top')
+    
+    def perform_destroy(self, instance):
+        instance.delete()
+        # Everyone scoring less moves up a place
+        leaderboard.rerank(high=instance.total_calories)
+        rank_index.index.remove(instance.user_email)
+        boards.boards.invalidate('all')
+        result_cache.invalidate('leaderboard.top')
+    
+    def count_param(self, name, default, maximum):
+        try:
+            value = int(self.request.query_params.get(name, default))
+        except ValueError:
+            return None
+        return value if 0 <= value <= maximum else None
+    
+    def indexed_rows(self, entries):
+        """Leaderboard rows for rank index entries, in index order and with the index's ranks"""
+        rows, represent = self.read_rows(
+            self.get_queryset().filter(user_email__in=[entry['user_email'] for entry in entries]), 'user_email'
+        )
+        by_email = {row['user_email']: row for row in rows}
+        result = []
+        for entry in entries:
+            row = by_email.get(entry['user_email'])
+            if row is not None:
+                data = represent(row)
+                if 'rank' in data:
+                    data['rank'] = entry['rank']
+                result.append(data)
+        return result
+    
+    @action(detail=False, methods=['get'], renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        """Stream the leaderboard in rank order as CSV or NDJSON, optionally filtered by email or team"""
+        query = {}
+        for param, field in (('email', 'user_email'), ('team', 'team')):
+            value = request.query_params.get(param, None)
+            if value:
+                query[field] = value
+        return exports.stream_export(
+            Leaderboard, query, requested_fields(request, LeaderboardSerializer.Meta.fields), [('rank', 1)],
+            request.accepted_renderer.format, 'leaderboard'
+        )
     
     @action(detail=False, methods=['get'])
     def top(self, request):
         """Get top users from leaderboard"""
-        limit = int(request.query_params.get('limit', 10))
-        top_users = Leaderboard.objects.all()[:limit]
-        serializer = self.get_serializer(top_users, many=True)
-        return Response(serializer.data)
+        limit = self.count_param('limit', 10, 1000)
+        if limit is None:
+            return Response({'error': 'limit must be between 0 and 1000'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        def compute():
+            return self.indexed_rows(rank_index.index.top(limit))
+        
+        return result_cache.cached_response(request, 'leaderboard.top', '', compute)
+    
+    @action(detail=False, methods=['get'])
+    def board(self, request):
+        """Get the leaderboard for the current day, week, month or all time, optionally for one team"""
+        period = request.query_params.get('period', 'all')
+        if period not in boards.PERIODS:
+            return Response({'error': 'period must be day, week, month or all'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = self.count_param('limit', 10, 1000)
+        if limit is None:
+            return Response({'error': 'limit must be between 0 and 1000'}, status=status.HTTP_400_BAD_REQUEST)
+        team = request.query_params.get('team', '')
+        since, board = boards.boards.get(period, team)
+        data = {
+            'period': period,
+            'team': team or None,
+            'since': since.date().isoformat() if since else None,
+            'entries': board.top(limit),
+        }
+        email = request.query_params.get('email', None)
+        if email:
+            data['user'] = board.rank_of(email)
+        return Response(data)
+    
+    @action(detail=False, methods=['get'])
+    def rank_of(self, request):
+        """Get a user's rank and calories from the rank index"""
+        email = request.query_params.get('email', None)
+        if not email:
+            return Response({'error': 'Email parameter required'}, status=status.HTTP_400_BAD_REQUEST)
+        entry = rank_index.index.rank_of(email)
+        if entry is None:
+            return Response({'error': 'User is not on the leaderboard'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(dict(entry, total_entries=rank_index.index.size()))
+    
+    @action(detail=False, methods=['get'])
+    def around(self, request):
+        """Get a user's leaderboard entry with the k entries above and below it"""
+        email = request.query_params.get('email', None)
+        if not email:
+            return Response({'error': 'Email parameter required'}, status=status.HTTP_400_BAD_REQUEST)
+        k = self.count_param('k', 5, 100)
+        if k is None:
+            return Response({'error': 'k must be between 0 and 100'}, status=status.HTTP_400_BAD_REQUEST)
+        entries = rank_index.index.around(email, k)
+        if entries is None:
+            return Response({'error': 'User is not on the leaderboard'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(self.indexed_rows(entries))
 
 
-class WorkoutViewSet(viewsets.ModelViewSet):
+class WorkoutViewSet(ConditionalMixin, FastReadMixin, ProjectionMixin, viewsets.ModelViewSet):
     """
     API endpoint for workouts.
     """
     queryset = Workout.objects.all()
     serializer_class = WorkoutSerializer
+    object_versions = True
+    
+    def invalidate_filters(self, category, difficulty):
+        result_cache.invalidate('workouts.by_category', category)
+        result_cache.invalidate('workouts.by_difficulty', difficulty)
+    
+    def perform_create(self, serializer):
+        workout = serializer.save()
+        self.invalidate_filters(workout.category, workout.difficulty)
+    
+    def perform_update(self, serializer):
+        old_category = serializer.instance.category
+        old_difficulty = serializer.instance.difficulty
+        workout = serializer.save()
+        self.invalidate_filters(old_category, old_difficulty)
+        self.invalidate_filters(workout.category, workout.difficulty)
+    
+    def perform_destroy(self, instance):
+        instance.delete()
+        self.invalidate_filters(instance.category, instance.difficulty)
     
     @action(detail=False, methods=['get'])
     def by_category(self, request):
         """Get workouts by category"""
         category = request.query_params.get('category', None)
         if category:
-            workouts = Workout.objects.filter(category=category)
-            serializer = self.get_serializer(workouts, many=True)
-            return Response(serializer.data)
+            def compute():
+                return self.represent_rows(self.get_queryset().filter(category=category))
+            
+            return result_cache.cached_response(request, 'workouts.by_category', category, compute)
         return Response({'error': 'Category parameter required'}, status=status.HTTP_400_BAD_REQUEST)
     
     @action(detail=False, methods=['get'])
@@ -102,7 +536,97 @@ class WorkoutViewSet(viewsets.ModelViewSet):
         """Get workouts by difficulty level"""
         difficulty = request.query_params.get('difficulty', None)
         if difficulty:
-            workouts = Workout.objects.filter(difficulty=difficulty)
-            serializer = self.get_serializer(workouts, many=True)
-            return Response(serializer.data)
+            def compute():
+                return self.represent_rows(self.get_queryset().filter(difficulty=difficulty))
+            
+            return result_cache.cached_response(request, 'workouts.by_difficulty', difficulty, compute)
         return Response({'error': 'Difficulty parameter required'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class StatsViewSet(ConditionalMixin, viewsets.ViewSet):
+    """
+    API endpoint for activity statistics, served from the daily rollups.
+    """
+    version_collections = ('activity_rollups',)
+    dated_actions = ('by_user', 'by_team')
+    
+    def summarize(self, request, field, param):
+        value = request.query_params.get(param, None)
+        if not value:
+            return Response({'error': f'{param.capitalize()} parameter required'}, status=status.HTTP_400_BAD_REQUEST)
+        group_by = request.query_params.get('group_by', 'type')
+        if group_by not in rollups.GROUPINGS:
+            return Response({'error': 'group_by must be type or day'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            days = int(request.query_params.get('days', 30))
+        except ValueError:
+            days = 0
+        if not 1 <= days <= 366:
+            return Response({'error': 'days must be between 1 and 366'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(rollups.summarize({field: value}, days, group_by))
+    
+    @action(detail=False, methods=['get'])
+    def by_user(self, request):
+        """Get activity totals for a user over the last N days"""
+        return self.summarize(request, 'user_email', 'email')
+    
+    @action(detail=False, methods=['get'])
+    def by_team(self, request):
+        """Get activity totals for a team over the last N days"""
+        return self.summarize(request, 'team', 'team')
+
+
+class TaskViewSet(ConditionalMixin, FastReadMixin, ProjectionMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint for background tasks: queue one with POST and poll its status.
+    """
+    queryset = Task.objects.all()
+    serializer_class = TaskSerializer
+    pagination_class = TaskPagination
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        for param in ('status', 'name'):
+            value = self.request.query_params.get(param, None)
+            if value:
+                queryset = queryset.filter(**{param: value})
+        return queryset
+    
+    def create(self, request):
+        """Queue a task, or return the identical task that is already queued"""
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Expected a JSON object'}, status=status.HTTP_400_BAD_REQUEST)
+        name = request.data.get('name', None)
+        args = request.data.get('args', {})
+        if not isinstance(args, dict):
+            return Response({'error': 'args must be an object'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            task_id, created = tasks.enqueue(name, args)
+        except ValueError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        task = self.get_serializer(Task.objects.get(_id=task_id)).data
+        response_status = status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK
+        return Response(task, status=response_status, headers={'Location': f'{request.path}{task_id}/'})
+    
+    @action(detail=True, methods=['get'])
+    def download(self, request, pk=None):
+        """Download the file written by a finished export task"""
+        try:
+            task = Task.objects.mongo_find_one({'_id': ObjectId(pk)}, {'status': 1, 'result': 1})
+        except InvalidId:
+            task = None
+        if task is None:
+            raise Http404
+        filename = (task.get('result') or {}).get('file') if task['status'] == Task.DONE else None
+        if not filename:
+            return Response({'error': 'Task has no file to download'}, status=status.HTTP_409_CONFLICT)
+        path = os.path.join(settings.OCTOFIT_EXPORT_DIR, os.path.basename(filename))
+        if not os.path.exists(path):
+            raise Http404
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=filename)
+
+
+@require_GET
+def metrics_view(request):
+    """Request metrics for this process in the Prometheus text format"""
+    return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
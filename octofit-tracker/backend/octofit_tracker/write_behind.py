@@ -0,0 +1,142 @@
+"""
+Write-behind buffering for activity creation.
+
+With ``OCTOFIT_WRITE_BEHIND`` on, ``ActivityViewSet.create`` validates the
+activity, gives it an id and queues it here, answering 202 without waiting
+for MongoDB. A flush thread writes the queue with one ``insert_many`` per
+batch of up to ``OCTOFIT_WRITE_BEHIND_BATCH`` activities, as soon as a
+batch is full and otherwise every ``OCTOFIT_WRITE_BEHIND_INTERVAL``
+seconds, and updates the derived data once per batch through
+``activity_events``. Insert cost then follows the number of batches rather
+than the number of requests.
+
+The queue holds at most ``OCTOFIT_WRITE_BEHIND_MAX`` activities; beyond
+that ``submit`` refuses and the view answers 503, so clients back off
+instead of the process growing without bound. A batch that fails with a
+connection error goes back to the front of the queue and is retried;
+because ids are assigned up front, activities the failed attempt did write
+are recognised by their duplicate key. The queue is flushed when the
+process exits normally. Activities still queued are lost if the process is
+killed, which is the trade made for the throughput.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .models import Activity
+from . import activity_events, ingest, metrics
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+def _write(documents):
+    """Insert ``documents``; return the indexes that were not written"""
+    try:
+        Activity.objects.mongo_insert_many(documents, ordered=False)
+    except BulkWriteError as exc:
+        # A duplicate id means an earlier attempt at this batch wrote it
+        return {error['index'] for error in exc.details['writeErrors'] if error['code'] != DUPLICATE_KEY}
+    return set()
+
+
+class WriteBehindBuffer:
+    def __init__(self):
+        self._pending = deque()
+        self._ready = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._atexit_registered = False
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def submit(self, activity):
+        """Queue an unsaved ``Activity`` that already has its ``_id``; False if the buffer is full"""
+        document = dict(ingest.to_document(activity), _id=activity._id)
+        row = activity_events.as_row(activity)
+        with self._ready:
+            if len(self._pending) >= settings.OCTOFIT_WRITE_BEHIND_MAX:
+                metrics.WRITE_BEHIND_REJECTED.inc()
+                return False
+            self._pending.append((document, row))
+            if len(self._pending) >= settings.OCTOFIT_WRITE_BEHIND_BATCH:
+                self._ready.notify()
+        self.start()
+        return True
+
+    def start(self):
+        """Start the flush thread unless this process already runs it"""
+        with self._ready:
+            # Threads do not survive fork, so a child process starts its own
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='octofit-write-behind', daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.stop)
+                self._atexit_registered = True
+
+    def stop(self, timeout=None):
+        """Stop the flush thread and write whatever is still queued"""
+        with self._ready:
+            self._stopping = True
+            self._ready.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        while self._pending and self.flush():
+            pass
+
+    def _take(self):
+        with self._ready:
+            batch_size = settings.OCTOFIT_WRITE_BEHIND_BATCH
+            return [self._pending.popleft() for _ in range(min(batch_size, len(self._pending)))]
+
+    def flush(self):
+        """Write one batch from the front of the queue; False if it has to be retried"""
+        batch = self._take()
+        if not batch:
+            return True
+        started = time.perf_counter()
+        try:
+            failed = _write([document for document, _ in batch])
+        except PyMongoError:
+            logger.warning('Write-behind flush of %d activities failed; retrying', len(batch), exc_info=True)
+            with self._ready:
+                self._pending.extendleft(reversed(batch))
+            return False
+        if failed:
+            logger.error('Write-behind dropped %d activities that could not be written', len(failed))
+            metrics.WRITE_BEHIND_FAILED.inc(len(failed))
+        activity_events.activities_written(added=[row for index, (_, row) in enumerate(batch) if index not in failed])
+        metrics.WRITE_BEHIND_FLUSH_SIZE.observe(len(batch))
+        metrics.WRITE_BEHIND_FLUSH_SECONDS.observe(time.perf_counter() - started)
+        return True
+
+    def _run(self):
+        while True:
+            with self._ready:
+                if len(self._pending) < settings.OCTOFIT_WRITE_BEHIND_BATCH and not self._stopping:
+                    self._ready.wait(settings.OCTOFIT_WRITE_BEHIND_INTERVAL)
+                if self._stopping:
+                    # stop() writes the rest from the calling thread
+                    return
+            try:
+                if not self.flush():
+                    time.sleep(settings.OCTOFIT_WRITE_BEHIND_INTERVAL)
+            except Exception:
+                logger.exception('Write-behind flush error')
+
+
+buffer = WriteBehindBuffer()
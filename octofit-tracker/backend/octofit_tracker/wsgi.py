@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'octofit_tracker.settings')
 
 application = get_wsgi_application()
+
+# Imported only now: the app registry has to be ready first
+from octofit_tracker.mongo_client import warm_up  # noqa: E402
+
+warm_up()